@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Camera Manager Benchmark
+Runs discovery, activation and health monitor cycles against a simulated network
+of synthetic cameras on 127.x addresses and prints the results as JSON. Cameras,
+portal, ARP sweep, addresses and firewall are all faked, so it runs offline and
+without privileges
+"""
+
+import os
+import sys
+import json
+import time
+import gzip
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import ipaddress
+import threading
+import subprocess
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import main
+
+# Defaults
+SIZES = [10, 1000, 10000]  # Synthetic cameras per run
+FIRST_CAMERA_IP = "127.1.0.1"
+CAMERA_OUI = "44:19:b6"  # Hikvision
+CAMERA_VENDOR = "Hangzhou Hikvision Digital Technology Co.,Ltd."
+LATENCY = 0.01  # Mean seconds a camera takes to answer a request
+FAILURE_RATE = 0.02  # Share of cameras that are down
+ERROR_RATE = 0.01  # Share of requests to live cameras that are reset
+PROBE_TIMEOUT = 1.0
+HEALTH_TIMEOUT = 1.0
+VIRTUAL_IP_POOL = "10.64.0.0/16"
+
+def synthetic_cameras(count: int) -> List[Dict]:
+    """The same (ip, mac) list in every process, one camera per loopback address"""
+    first = ipaddress.IPv4Address(FIRST_CAMERA_IP)
+    return [{'ip': str(first + i), 'mac': f"{CAMERA_OUI}:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}"}
+            for i in range(count)]
+
+def arp_recording(cameras: List[Dict]) -> List[str]:
+    """arp-scan --quiet output listing the cameras"""
+    lines = ["Interface: eth0, type: EN10MB, MAC: 02:00:00:00:00:01, IPv4: 127.0.0.1"]
+    lines += [f"{camera['ip']}\t{camera['mac']}\t{CAMERA_VENDOR}" for camera in cameras]
+    lines.append(f"Ending arp-scan: {len(cameras)} responded")
+    return lines
+
+def quantiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50, p95, p99 and max in milliseconds"""
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None}
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3)
+    return {'p50_ms': pick(0.5), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99),
+            'max_ms': round(values[-1] * 1000, 3)}
+
+class CameraFleet:
+    """
+    Synthetic cameras answering HTTP and RTSP on every 127.x address, plus a stub portal
+    Served from a separate process so the cameras do not compete with the code
+    under test for the GIL. Each camera's latency and whether it is down follow
+    from its address, so runs are repeatable
+    """
+    
+    def __init__(self, count: int, latency: float = LATENCY, failure_rate: float = FAILURE_RATE,
+                 error_rate: float = ERROR_RATE, seed: int = 0):
+        self.config = {'count': count, 'latency': latency, 'failure_rate': failure_rate,
+                       'error_rate': error_rate, 'seed': seed}
+        self.process = None
+        self.ports = None
+    
+    def start(self) -> Dict[str, int]:
+        """Start the fleet, returns the http, rtsp and portal ports"""
+        context = multiprocessing.get_context('spawn')
+        parent, child = context.Pipe()
+        self.process = context.Process(target=_serve_fleet, args=(self.config, child), daemon=True)
+        self.process.start()
+        self.ports = parent.recv()
+        return self.ports
+    
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(5)
+            self.process = None
+
+def _serve_fleet(config: Dict, pipe):
+    """Fleet process entry point"""
+    main.logger.setLevel("WARNING")
+    portal = ThreadingHTTPServer(('127.0.0.1', 0), _StubPortal)
+    portal.request_queue_size = 1024
+    portal.daemon_threads = True
+    _StubPortal.rtsp_port = None
+    threading.Thread(target=portal.serve_forever, daemon=True).start()
+    asyncio.run(_run_cameras(config, portal, pipe))
+
+async def _run_cameras(config: Dict, portal, pipe):
+    profiles = {}
+    
+    def profile(ip: str):
+        if ip not in profiles:
+            rng = random.Random(f"{config['seed']}:{ip}")
+            profiles[ip] = (rng.random() < config['failure_rate'], config['latency'] * rng.uniform(0.5, 1.5), rng)
+        return profiles[ip]
+    
+    async def serve_http(reader, writer):
+        down, latency, rng = profile(writer.get_extra_info('sockname')[0])
+        try:
+            if down or rng.random() < config['error_rate']:
+                return
+            await reader.readuntil(b"\r\n\r\n")
+            await asyncio.sleep(latency)
+            body = b"<html><title>IP Camera</title></html>"
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nConnection: close\r\n"
+                         b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+    
+    async def serve_rtsp(reader, writer):
+        down, latency, rng = profile(writer.get_extra_info('sockname')[0])
+        try:
+            if down or rng.random() < config['error_rate']:
+                return
+            while True:
+                request_line, headers, _ = await main.read_rtsp_message(reader)
+                await asyncio.sleep(latency)
+                body, extra = b"", ""
+                if request_line.startswith("DESCRIBE"):
+                    body = b"v=0\r\ns=synthetic\r\nm=video 0 RTP/AVP 96\r\n"
+                    extra = "Content-Type: application/sdp\r\n"
+                writer.write(f"RTSP/1.0 200 OK\r\nCSeq: {headers.get('cseq', '0')}\r\n{extra}"
+                             f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+    
+    # 0.0.0.0 answers for every loopback address
+    http = await asyncio.start_server(serve_http, '0.0.0.0', 0, backlog=4096)
+    rtsp = await asyncio.start_server(serve_rtsp, '0.0.0.0', 0, backlog=4096)
+    _StubPortal.rtsp_port = rtsp.sockets[0].getsockname()[1]
+    pipe.send({'http': http.sockets[0].getsockname()[1], 'rtsp': _StubPortal.rtsp_port,
+               'portal': portal.server_address[1]})
+    await asyncio.Event().wait()
+
+class _StubPortal(BaseHTTPRequestHandler):
+    """Portal activating every camera registered with it"""
+    protocol_version = "HTTP/1.1"
+    registered = {}  # MAC -> camera
+    statuses = 0
+    rtsp_port = None
+    lock = threading.Lock()
+    
+    def do_GET(self):
+        with self.lock:
+            cameras = [{'camera_id': f"cam-{mac}", 'original_ip': camera['ip'], 'rtsp_port': self.rtsp_port}
+                       for mac, camera in self.registered.items()]
+        self._reply({'activated_cameras': cameras})
+    
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == "gzip":
+            body = gzip.decompress(body)
+        body = json.loads(body)
+        with self.lock:
+            if self.path.endswith("/status"):
+                type(self).statuses += len(body['statuses'])
+            else:
+                for camera in body['cameras']:
+                    self.registered[camera['mac']] = camera
+        self._reply({'ok': True})
+    
+    def _reply(self, body: Dict):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def log_message(self, *args):
+        pass
+
+class SimulatedNetworkManager(main.NetworkManager):
+    """NetworkManager over in-memory addresses and a dry-run nftables firewall"""
+    
+    def __init__(self, directory: str):
+        original = main.CONFIG_FILE
+        main.CONFIG_FILE = os.path.join(directory, "config.json")
+        try:
+            super().__init__({'virtual_ip_pools': {'eth0': [VIRTUAL_IP_POOL]}}, addresses=main.FakeAddresses())
+        finally:
+            main.CONFIG_FILE = original
+        self.firewall = main.NftablesFirewall(dry_run=True)
+    
+    def flush_connections(self, virtual_ips: List[str]):
+        pass  # No kernel connection tracking to flush
+
+def bench_discovery(count: int, ports: Dict[str, int], directory: str, args) -> Dict:
+    """Cold scan (every camera probed) then warm scan (probe cache hits), both streamed to the portal"""
+    discovery = main.CameraDiscovery(
+        probe_engine=main.ProbeEngine(ports=[ports['http']], timeout=args.probe_timeout,
+                                      deadline=max(main.PROBE_DEADLINE, count),
+                                      rtsp_prober=main.RtspProber(port=ports['rtsp'],
+                                                                  timeout=args.probe_timeout)),
+        arp_backend=main.RecordedArpBackend(arp_recording(synthetic_cameras(count))),
+        probe_cache=main.ProbeCache(os.path.join(directory, "probe_cache.json"))
+    )
+    portal = main.PortalClient(f"http://127.0.0.1:{ports['portal']}", "benchmark")
+    results = {}
+    try:
+        for name in ('cold', 'warm'):
+            arrivals, latencies = [], []
+            started = time.monotonic()
+            
+            def scan():
+                for camera in discovery.iter_incremental():
+                    arrivals.append(time.monotonic() - started)
+                    latencies.append(camera['probe_latency'])
+                    yield camera
+            
+            stats = main.RegistrationStream(portal).run(scan())
+            elapsed = time.monotonic() - started
+            results[name] = {
+                'seconds': round(elapsed, 4),
+                'cameras': len(arrivals),
+                'identified_rtsp': sum(1 for e in discovery.probe_cache.entries.values() if e.get('rtsp_url')),
+                'registered': stats['registered'],
+                'cameras_per_second': round(len(arrivals) / elapsed, 1) if elapsed else None,
+                'first_camera_ms': round(arrivals[0] * 1000, 3) if arrivals else None,
+                'arrival': quantiles(arrivals),
+                # Cached cameras carry the latency of the probe that filled the cache
+                'probe_latency': quantiles(latencies) if name == 'cold' else None
+            }
+    finally:
+        portal.close()
+    return results
+
+def bench_activation(ports: Dict[str, int], network: SimulatedNetworkManager) -> Dict:
+    """Portal poll and bulk activation of every registered camera"""
+    portal = main.PortalClient(f"http://127.0.0.1:{ports['portal']}", "benchmark")
+    try:
+        started = time.monotonic()
+        changes = portal.poll_activation_changes() or {'changed': [], 'removed': []}
+        polled = time.monotonic() - started
+        
+        pipeline = main.ActivationPipeline(network)
+        started = time.monotonic()
+        results = pipeline.run(changes['changed'])
+        elapsed = time.monotonic() - started
+    finally:
+        portal.close()
+    activated = sum(1 for virtual_ip in results.values() if virtual_ip)
+    return {
+        'poll_seconds': round(polled, 4),
+        'cameras': len(changes['changed']),
+        'activated': activated,
+        'seconds': round(elapsed, 4),
+        'cameras_per_second': round(activated / elapsed, 1) if elapsed else None,
+        'address_round_trips': network.addresses.round_trips,
+        'firewall_scripts': len(network.firewall.scripts)
+    }
+
+def bench_monitor(ports: Dict[str, int], network: SimulatedNetworkManager, directory: str, args) -> Dict:
+    """One health check of every forwarded camera, then delivery of the status changes"""
+    portal = main.PortalClient(f"http://127.0.0.1:{ports['portal']}", "benchmark")
+    outbox = main.Outbox(portal, path=os.path.join(directory, "outbox.json"))
+    monitor = main.CameraHealthMonitor(outbox, timeout=args.health_timeout)
+    monitor.sync({camera_id: (config['camera_ip'], config.get('rtsp_port', main.RTSP_PORT))
+                  for camera_id, config in network.virtual_ips.items() if config.get('camera_ip')})
+    count = len(monitor.cameras)
+    
+    async def sweep():
+        task = asyncio.ensure_future(monitor.run())
+        deadline = time.monotonic() + args.health_timeout * 2 * (count / monitor.concurrency + 1) + 10
+        while monitor.checks < count and time.monotonic() < deadline:
+            await asyncio.sleep(0.005)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    
+    try:
+        started = time.monotonic()
+        asyncio.run(sweep())
+        elapsed = time.monotonic() - started
+        
+        latencies = [state['latency'].quantile(0.5) for state in monitor.cameras.values()]
+        statuses = {}
+        for state in monitor.cameras.values():
+            statuses[state['status']] = statuses.get(state['status'], 0) + 1
+        
+        queued = len(outbox)
+        started = time.monotonic()
+        while len(outbox) and time.monotonic() - started < 60:
+            outbox.flush_once()
+        delivered = time.monotonic() - started
+    finally:
+        portal.close()
+    return {
+        'cameras': count,
+        'checks': monitor.checks,
+        'seconds': round(elapsed, 4),
+        'checks_per_second': round(monitor.checks / elapsed, 1) if elapsed else None,
+        'check_latency_bucket': quantiles(latencies),  # Upper bounds of the health histogram buckets
+        'statuses': statuses,
+        'status_reports': queued,
+        'report_seconds': round(delivered, 4)
+    }
+
+def run_size(count: int, args) -> Dict:
+    """Discovery, activation, monitoring and teardown of count synthetic cameras"""
+    fleet = CameraFleet(count, args.latency, args.failure_rate, args.error_rate, args.seed)
+    ports = fleet.start()
+    directory = tempfile.mkdtemp(prefix="camera-bench-")
+    try:
+        result = {'cameras': count, 'discovery': bench_discovery(count, ports, directory, args)}
+        network = SimulatedNetworkManager(directory)
+        result['activation'] = bench_activation(ports, network)
+        result['monitor'] = bench_monitor(ports, network, directory, args)
+        
+        started = time.monotonic()
+        removed = network.teardown_cameras(list(network.virtual_ips))
+        elapsed = time.monotonic() - started
+        result['teardown'] = {'cameras': len(removed), 'removed': sum(removed.values()),
+                              'seconds': round(elapsed, 4)}
+        network.close()
+    finally:
+        fleet.stop()
+    return result
+
+def version() -> Optional[str]:
+    """Commit of the code under test, for comparing runs"""
+    try:
+        result = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+def main_benchmark(argv: Optional[List[str]] = None) -> Dict:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="camera counts to run")
+    parser.add_argument('--latency', type=float, default=LATENCY, help="mean camera response seconds")
+    parser.add_argument('--failure-rate', type=float, default=FAILURE_RATE, help="share of cameras down")
+    parser.add_argument('--error-rate', type=float, default=ERROR_RATE, help="share of requests reset")
+    parser.add_argument('--probe-timeout', type=float, default=PROBE_TIMEOUT)
+    parser.add_argument('--health-timeout', type=float, default=HEALTH_TIMEOUT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the JSON here instead of stdout")
+    args = parser.parse_args(argv)
+    
+    main.logger.setLevel("WARNING")  # Per-camera info logging would dominate the numbers
+    report = {
+        'version': version(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        'runs': []
+    }
+    for count in args.sizes:
+        print(f"Benchmarking {count} cameras...", file=sys.stderr)
+        report['runs'].append(run_size(count, args))
+    
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return report
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -6,313 +6,3778 @@ Detects local IP cameras, manages virtual IPs, and handles RTSP streams from AWS
 
 import os
 import sys
+import signal
 import json
 import time
+import errno
+import gzip
+import select
 import socket
+import struct
+import fcntl
+import re
+import ipaddress
+import asyncio
+import queue
+import random
+import heapq
+import bisect
 import subprocess
 import threading
 import logging
+import logging.handlers
+import functools
+import itertools
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
 import netifaces
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configuration
 CONFIG_FILE = "/etc/camera_portal/config.json"
 LOG_FILE = "/var/log/camera_portal.log"
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "text"  # One of: text, json
+LOG_MAX_BYTES = 10 * 1024 * 1024  # Size at which the log file is rotated
+LOG_BACKUP_COUNT = 5  # Rotated log files kept
+LOG_ROTATE_WHEN = None  # Rotate by time instead of size, e.g. "midnight"
+LOG_RATE_LIMIT = 10  # Records per message and subject within the window, 0 disables
+LOG_RATE_WINDOW = 60.0  # Seconds after which a muted message is let through again
 PORTAL_API_URL = "https://your-portal-api.example.com"  # Replace with actual portal URL
 PORTAL_API_KEY = "your-api-key-here"  # Replace with your API key
+PORTAL_CONNECT_TIMEOUT = 3.05  # Seconds to establish a portal connection
+PORTAL_READ_TIMEOUT = 10  # Seconds to wait for portal responses
+PORTAL_POOL_SIZE = 4  # Keep-alive connections held to the portal
+PORTAL_RETRIES = 3  # Retries for failed portal calls
+PORTAL_BACKOFF = 0.5  # Retry backoff factor: 0.5s, 1s, 2s, ...
+
+# Streaming registration
+REGISTER_CHUNK_SIZE = 100  # Cameras per registration request
+REGISTER_WINDOW = 2.0  # Seconds a partial chunk waits before it is sent
+REGISTER_MAX_IN_FLIGHT = 2  # Concurrent registration requests
+REGISTER_COMPRESS = True  # Gzip registration bodies
+
+# Service loop
+SERVICE_WORKERS = 4  # Threads running blocking discovery, portal and network calls
+DISCOVERY_INTERVAL = 300.0  # Seconds between network rescans
+SYNC_MIN_INTERVAL = 2.0  # Portal poll interval right after a change
+SYNC_MAX_INTERVAL = 30.0  # Poll interval once nothing has changed for a while
+ACTIVATION_RETRY_DELAY = 30.0  # Seconds before a failed activation is retried
+ADDRESS_CHECK_INTERVAL = 60.0  # Seconds between checks that virtual IPs are still configured
+# Settings a reload (SIGHUP) applies; changes to any other key need a restart
+RELOADABLE_SETTINGS = frozenset({
+    'arp_backend', 'camera_vendors', 'camera_ouis', 'oui_file', 'verify_activations',
+    'log_level', 'trace_file', 'trace_slow_seconds', 'trace_sample_rate', 'profile_cycles'
+})
+
+# Camera health
+HEALTH_MIN_INTERVAL = 5.0  # Seconds between checks of failing or flapping cameras
+HEALTH_BASE_INTERVAL = 30.0  # First interval after a camera comes online
+HEALTH_MAX_INTERVAL = 300.0  # Healthy cameras back off to this
+HEALTH_TIMEOUT = 3.0  # Seconds for the TCP connect and the RTSP OPTIONS answer each
+HEALTH_CONCURRENCY = 256  # Checks in flight at once
+HEALTH_OFFLINE_AFTER = 2  # Consecutive failures before a camera is reported offline
+HEALTH_FLAP_WINDOW = 600.0  # Seconds over which status changes count as flapping
+HEALTH_FLAP_LIMIT = 3  # Changes within the window that keep a camera on the short interval
+HEALTH_HISTORY = 100  # Latency samples per camera in the rolling histogram
+
+# Activation
+ACTIVATION_WORKERS = 32  # Concurrent per-camera checks while activating a batch
+ACTIVATION_VERIFY = False  # Check cameras answer on their RTSP port before forwarding them
+ACTIVATION_VERIFY_TIMEOUT = 2.0
+
+# Metrics
+METRICS_HOST = "127.0.0.1"  # Only local scrapers by default
+METRICS_PORT = 9108  # Set metrics_port to null to disable the endpoint
+
+# Tracing and profiling
+TRACE_FILE = "/var/log/camera_portal_traces.jsonl"
+TRACE_SLOW_SECONDS = 5.0  # Cycles taking longer are written to the trace file
+TRACE_SAMPLE_RATE = 0.0  # Share of the remaining cycles written anyway
+TRACE_MAX_SPANS = 2000  # Spans kept per cycle, the rest are only counted
+TRACE_FILE_MAX_BYTES = 50 * 1024 * 1024  # Size at which the trace file is rotated
+PROFILE_DIR = "/var/log/camera_portal_profiles"
+PROFILE_CYCLES = 5  # Cycles profiled after SIGUSR1
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples
+
+# Portal outbox
+OUTBOX_FILE = "/etc/camera_portal/outbox.json"
+OUTBOX_BATCH_SIZE = 200  # Entries per portal request
+OUTBOX_BASE_BACKOFF = 1.0  # Seconds before the first retry, doubled per failure
+OUTBOX_MAX_BACKOFF = 300.0
+OUTBOX_IDLE_WAIT = 60.0  # Seconds between checks when nothing is queued
+PORTAL_BREAKER_THRESHOLD = 5  # Consecutive failures that pause portal calls
+PORTAL_BREAKER_RESET = 30.0  # Seconds before a paused portal is tried again
 
 # Network configuration
 VIRTUAL_IP_BASE = "192.168.1.200"  # Starting IP for virtual interfaces
 VIRTUAL_NETMASK = "255.255.255.0"
-VIRTUAL_INTERFACE_PREFIX = "eth0:cam"  # Will become eth0:cam0, eth0:cam1, etc.
+VIRTUAL_PREFIXLEN = ipaddress.IPv4Network(f"0.0.0.0/{VIRTUAL_NETMASK}").prefixlen
+VIRTUAL_INTERFACE_PREFIX = "cam"  # Labels become eth0:cam0, eth0:cam1, etc.
+IP_BATCH_TIMEOUT = 10.0  # Seconds a change set may take on the long-lived ip -batch process
 RTSP_PORT = 554
+FIREWALL_BACKEND = "iptables"  # One of: iptables, nftables
+FIREWALL_COMMENT = "camera_portal"  # Marks the iptables rules this service owns
+NFT_TABLE = "camera_portal"  # nftables table holding the forwarding maps
+FORWARDING_MODE = "dnat"  # dnat (firewall rules) or relay (userspace TCP relay)
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+# Userspace relay
+RELAY_BUFFER_SIZE = 65536  # Bytes in flight per connection direction
+RELAY_CONNECT_TIMEOUT = 5.0  # Seconds to reach the camera
+RELAY_BACKLOG = 128
+RELAY_BASE_PORT = 20000  # With relay_bind, each camera gets its own port from base port on
+RELAY_PORT_SPAN = 10000  # Ports available to relays
+IP_FREEBIND = getattr(socket, 'IP_FREEBIND', 15)  # Linux, lets the relay bind before the address exists
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+RELAY_FANOUT = False  # Share one camera session between all viewers of a stream
+FANOUT_BUFFER_SIZE = 4 * 1024 * 1024  # Bytes of the latest group of pictures kept for new viewers
+FANOUT_CLIENT_BUFFER = 8 * 1024 * 1024  # Unsent bytes after which a slow viewer is dropped
+FANOUT_SOCKET_BUFFER = 512 * 1024  # Kernel send buffer per viewer, bounds what hides from the check above
+FANOUT_KEEPALIVE = 30.0  # Seconds between keepalives on the camera session
+
+# State persistence
+STATE_BACKEND = "json"  # One of: json, journal
+STATE_FLUSH_INTERVAL = 2.0  # Seconds changes are coalesced before writing
+STATE_JOURNAL_COMPACT_AFTER = 1000  # Journal entries before the snapshot is rewritten
+
+# Camera probing
+PROBE_HTTP_PORTS = [80, 8080, 8000]  # Common camera web ports
+PROBE_TIMEOUT = 2  # Seconds per HTTP request
+PROBE_MAX_WORKERS = 64  # Global limit of concurrent probes
+PROBE_PER_HOST_LIMIT = 2  # Concurrent probes against a single camera
+PROBE_DEADLINE = 30  # Seconds allowed for a whole probing pass
+
+# RTSP stream discovery
+RTSP_PROBE_TIMEOUT = 3  # Seconds per RTSP request
+
+# Host discovery
+ARP_BACKEND = "native"  # One of: arp-scan, native, proc
+ARP_REPLY_TIMEOUT = 1.0  # Seconds of silence that end a native sweep
+ARP_MAX_HOSTS = 65536  # Largest subnet a native sweep will cover
+
+# Probe cache
+PROBE_CACHE_FILE = "/etc/camera_portal/probe_cache.json"
+PROBE_CACHE_TTL = 24 * 3600  # Seconds before a camera is fingerprinted again
+PROBE_CACHE_RETRY_TTL = 600  # Seconds before a host that could not be identified is probed again
+PROBE_CACHE_MAX_ENTRIES = 100000
+
+# Camera classification
+OUI_FILES = [  # IEEE-format vendor lists, first one found is loaded
+    "/usr/share/arp-scan/ieee-oui.txt",
+    "/usr/share/ieee-data/oui.txt"
+]
+CAMERA_OUIS = {  # Bundled MAC prefixes of common camera vendors
+    "00408C": "Axis Communications AB",
+    "ACCC8E": "Axis Communications AB",
+    "B8A44F": "Axis Communications AB",
+    "4419B6": "Hangzhou Hikvision Digital Technology Co.,Ltd.",
+    "C056E3": "Hangzhou Hikvision Digital Technology Co.,Ltd.",
+    "BCAD28": "Hangzhou Hikvision Digital Technology Co.,Ltd.",
+    "4CBD8F": "Hangzhou Hikvision Digital Technology Co.,Ltd.",
+    "54C415": "Hangzhou Hikvision Digital Technology Co.,Ltd.",
+    "C42F90": "Hangzhou Hikvision Digital Technology Co.,Ltd.",
+    "3CEF8C": "Zhejiang Dahua Technology Co., Ltd.",
+    "9002A9": "Zhejiang Dahua Technology Co., Ltd.",
+    "E0508B": "Zhejiang Dahua Technology Co., Ltd.",
+    "14A78B": "Zhejiang Dahua Technology Co., Ltd.",
+    "38AF29": "Zhejiang Dahua Technology Co., Ltd.",
+    "4C11BF": "Zhejiang Dahua Technology Co., Ltd.",
+    "0002D1": "Vivotek Inc.",
+    "001A07": "Arecont Vision",
+    "000463": "Bosch Security Systems",
+    "000918": "Samsung Techwin Co.,Ltd",
+    "008045": "Panasonic (Matsushita Electric Industrial Co.)"
+}
+
+# Handlers are installed by setup_logging() when the service starts
 logger = logging.getLogger(__name__)
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
-class CameraDiscovery:
-    """Handles discovery of IP cameras in local network"""
+class JsonLogFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most limit records per message and subject through every window seconds
+    The subject is the first argument, usually a camera ID or address, so a
+    flapping camera is muted without hiding the others. The first record let
+    through again says how many were suppressed
+    """
+    
+    def __init__(self, limit: int = LOG_RATE_LIMIT, window: float = LOG_RATE_WINDOW,
+                 max_keys: int = 10000):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.counts = {}  # (logger, message, subject) -> [window start, passed, suppressed]
+        self.lock = threading.Lock()
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.limit <= 0:
+            return True
+        args = record.args if isinstance(record.args, tuple) else ()
+        key = (record.name, str(record.msg), str(args[0]) if args else None)
+        now = record.created
+        with self.lock:
+            entry = self.counts.get(key)
+            if entry is not None and now - entry[0] < self.window:
+                if entry[1] < self.limit:
+                    entry[1] += 1
+                    return True
+                entry[2] += 1
+                return False
+            
+            if len(self.counts) >= self.max_keys:
+                self.counts = {k: e for k, e in self.counts.items() if now - e[0] < self.window}
+            self.counts[key] = [now, 1, 0]
+        if entry is not None and entry[2]:
+            record.suppressed = entry[2]
+            record.msg = f"{record.getMessage()} ({entry[2]} similar messages suppressed)"
+            record.args = None
+        return True
+
+def setup_logging(settings: Optional[Dict] = None) -> logging.handlers.QueueListener:
+    """
+    Route all logging through a queue to a writer thread, returns the started listener
+    Logging calls only enqueue the record; console and file writes and rotation
+    happen on the listener thread. Stop the listener to flush it on exit
+    """
+    settings = {} if settings is None else settings
+    if settings.get('log_format', LOG_FORMAT) == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter(LOG_TEXT_FORMAT)
+    
+    handlers = [logging.StreamHandler()]
+    path = settings.get('log_file', LOG_FILE)
+    backups = settings.get('log_backup_count', LOG_BACKUP_COUNT)
+    file_error = None
+    try:
+        when = settings.get('log_rotate_when', LOG_ROTATE_WHEN)
+        if when:
+            handlers.append(logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backups))
+        else:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                path, maxBytes=settings.get('log_max_bytes', LOG_MAX_BYTES), backupCount=backups
+            ))
+    except OSError as e:
+        file_error = e
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter(settings.get('log_rate_limit', LOG_RATE_LIMIT),
+                                            settings.get('log_rate_window', LOG_RATE_WINDOW)))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(settings.get('log_level', LOG_LEVEL))
+    
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    if file_error is not None:
+        logger.warning("Logging to the console only, cannot open %s: %s", path, file_error)
+    return listener
+
+class Metric:
+    """Registry metric holding one value per combination of label values"""
+    
+    kind = 'untyped'
+    
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}  # Label values -> value
+        self.lock = threading.Lock()
+    
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+    
+    def samples(self) -> List[Tuple[str, Tuple, float]]:
+        """(name suffix, label values, value) for rendering"""
+        with self.lock:
+            return [("", key, value) for key, value in self.values.items()]
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+    
+    kind = 'counter'
+    
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """Value that goes up and down, either set directly or computed at scrape time"""
+    
+    kind = 'gauge'
+    
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), function=None):
+        super().__init__(name, help, labels)
+        self.function = function  # Returns a value, or {label values: value}
+    
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+    
+    def samples(self) -> List[Tuple[str, Tuple, float]]:
+        if self.function is None:
+            return super().samples()
+        try:
+            values = self.function()
+        except Exception as e:
+            logger.error("Error computing metric %s: %s", self.name, e)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [("", tuple(map(str, key)), value) for key, value in values.items()]
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets"""
+    
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with block"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+    
+    def samples(self) -> List[Tuple[str, Tuple, float]]:
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                samples.append(("_bucket", key + (('le', le),), cumulative))
+            samples.append(("_sum", key, total))
+            samples.append(("_count", key, cumulative))
+        return samples
+
+class MetricsRegistry:
+    """Named metrics of the service, rendered in the Prometheus text format"""
+    
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def _register(self, metric_class, name: str, help: str, **kwargs) -> Metric:
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, help, **kwargs)
+            return self.metrics[name]
+    
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter, name, help, labels=labels)
+    
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...] = (), function=None) -> Gauge:
+        gauge = self._register(Gauge, name, help, labels=labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+    
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labels=labels, buckets=buckets)
+    
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, key, value in metric.samples():
+                pairs = list(zip(metric.labels, key[:len(metric.labels)])) + list(key[len(metric.labels):])
+                labels = ",".join(f'{name}="{self._escape(value_)}"' for name, value_ in pairs)
+                lines.append(f"{metric.name}{suffix}{{{labels}}} {value}" if labels
+                             else f"{metric.name}{suffix} {value}")
+        return "\n".join(lines) + "\n"
+    
+    @staticmethod
+    def _escape(value: str) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class MetricsServer:
+    """Serves a registry on /metrics from a background thread"""
+    
+    def __init__(self, registry: MetricsRegistry, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+    
+    def start(self) -> Optional[int]:
+        """Start serving, returns the bound port or None if the port is unavailable"""
+        registry = self.registry
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass
+        
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            logger.error("Metrics endpoint unavailable on %s:%s: %s", self.host, self.port, e)
+            return None
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("Serving metrics on http://%s:%s/metrics", self.host, self.server.server_address[1])
+        return self.server.server_address[1]
+    
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+# Metrics of the hot paths, cheap enough to stay on: a dict lookup and a lock per update
+METRICS = MetricsRegistry()
+SCAN_SECONDS = METRICS.histogram("camera_portal_scan_seconds",
+                                 "Duration of discovery scans by stage", ('stage',))
+SCAN_CAMERAS = METRICS.counter("camera_portal_scan_cameras_total",
+                               "Cameras found by discovery scans", ('source',))
+PROBES = METRICS.counter("camera_portal_probes_total", "Hosts fingerprinted", ('result',))
+PROBE_SECONDS = METRICS.histogram("camera_portal_probe_seconds", "Time to fingerprint one host")
+PROBE_HTTP_ERRORS = METRICS.counter("camera_portal_probe_http_errors_total",
+                                    "Failed HTTP probe requests", ('reason',))
+PORTAL_SECONDS = METRICS.histogram("camera_portal_portal_request_seconds",
+                                   "Portal request latency", ('method', 'endpoint'))
+PORTAL_RESPONSES = METRICS.counter("camera_portal_portal_responses_total",
+                                   "Portal responses by status", ('endpoint', 'status'))
+PORTAL_CONNECT_SECONDS = METRICS.histogram("camera_portal_portal_connect_seconds",
+                                           "Connection setup per portal request, 0 when reused",
+                                           ('endpoint',))
+SUBPROCESS_SECONDS = METRICS.histogram("camera_portal_subprocess_seconds",
+                                       "Time spent in helper commands", ('command',))
+SUBPROCESS_FAILURES = METRICS.counter("camera_portal_subprocess_failures_total",
+                                      "Helper commands exiting non-zero", ('command',))
+ACTIVATION_SECONDS = METRICS.histogram("camera_portal_activation_stage_seconds",
+                                       "Duration of activation pipeline stages", ('stage',))
+ACTIVATION_LATENCY = METRICS.histogram("camera_portal_activation_latency_seconds",
+                                       "Time from a portal change to the camera being forwarded")
+ACTIVATIONS = METRICS.counter("camera_portal_activations_total",
+                              "Cameras activated or torn down", ('action', 'result'))
+
+CYCLE_SECONDS = METRICS.histogram("camera_portal_cycle_seconds", "Duration of service cycles", ('cycle',))
+
+class Trace:
+    """Spans recorded during one service cycle, shared by the threads working on it"""
+    
+    def __init__(self, name: str, max_spans: int = TRACE_MAX_SPANS):
+        self.trace_id = os.urandom(8).hex()
+        self.name = name
+        self.started = time.monotonic()
+        self.wall = time.time()
+        self.spans = []
+        self.dropped = 0
+        self.max_spans = max_spans
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+    
+    def add(self, name: str, started: float, finished: float, parent: Optional[int] = None,
+            span_id: Optional[int] = None, error: Optional[str] = None, **attrs):
+        """Record a finished span, times are time.monotonic() values"""
+        span = {'id': span_id or next(self.ids), 'parent': parent, 'name': name,
+                'start': round(started - self.started, 6), 'duration': round(finished - started, 6)}
+        if error:
+            span['error'] = error
+        if attrs:
+            span['attrs'] = attrs
+        with self.lock:
+            if len(self.spans) < self.max_spans:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+    
+    def to_dict(self, duration: float, error: Optional[str] = None) -> Dict:
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        return {
+            'trace_id': self.trace_id,
+            'cycle': self.name,
+            'started_at': datetime.fromtimestamp(self.wall).isoformat(),
+            'duration': round(duration, 6),
+            'error': error,
+            'dropped_spans': self.dropped,
+            'spans': spans
+        }
+
+_current_trace = contextvars.ContextVar('camera_portal_trace', default=None)
+_current_span = contextvars.ContextVar('camera_portal_span', default=None)
+
+class Tracer:
+    """
+    Span tracing per service cycle with slow-cycle sampling to a JSONL file
+    Spans outside a cycle cost one context variable lookup. Blocking calls made
+    for a cycle must run in a copy of its context to be part of its trace
+    """
+    
+    def __init__(self, path: str = TRACE_FILE, slow: float = TRACE_SLOW_SECONDS,
+                 sample_rate: float = TRACE_SAMPLE_RATE, max_spans: int = TRACE_MAX_SPANS,
+                 max_bytes: int = TRACE_FILE_MAX_BYTES):
+        self.path = path
+        self.slow = slow
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self.max_bytes = max_bytes
+        self.observers = []  # Called with (trace, duration) after every cycle
+        self.lock = threading.Lock()
+    
+    def configure(self, settings: Dict):
+        self.path = settings.get('trace_file', TRACE_FILE)
+        self.slow = settings.get('trace_slow_seconds', TRACE_SLOW_SECONDS)
+        self.sample_rate = settings.get('trace_sample_rate', TRACE_SAMPLE_RATE)
     
     @staticmethod
-    def scan_local_network(interface: str = "eth0") -> List[Dict]:
+    def current() -> Optional[Trace]:
+        """Trace of the cycle running in this context, if any"""
+        return _current_trace.get()
+    
+    @contextmanager
+    def cycle(self, name: str):
+        """Trace one iteration of a service task under a new trace ID"""
+        trace = Trace(name, self.max_spans)
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(None)
+        error = None
+        try:
+            yield trace
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+            duration = time.monotonic() - trace.started
+            CYCLE_SECONDS.observe(duration, cycle=name)
+            if duration >= self.slow or random.random() < self.sample_rate:
+                if duration >= self.slow:
+                    logger.warning("Slow %s cycle took %.2fs (trace %s)", name, duration, trace.trace_id)
+                self._write(trace.to_dict(duration, error))
+            for observer in list(self.observers):
+                try:
+                    observer(trace, duration)
+                except Exception as e:
+                    logger.error("Error in cycle observer: %s", e)
+    
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Time a block as a child of the current span"""
+        trace = _current_trace.get()
+        if trace is None:
+            yield attrs
+            return
+        span_id = next(trace.ids)
+        parent = _current_span.get()
+        token = _current_span.set(span_id)
+        started = time.monotonic()
+        error = None
+        try:
+            yield attrs  # The block may add attributes, e.g. a response status
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            trace.add(name, started, time.monotonic(), parent, span_id, error, **attrs)
+    
+    def _write(self, record: Dict):
+        try:
+            line = json.dumps(record, default=str) + "\n"
+            with self.lock:
+                if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, 'a') as f:
+                    f.write(line)
+        except Exception as e:
+            logger.error("Error writing trace: %s", e)
+
+TRACER = Tracer()
+
+def traced(func):
+    """Run a method inside a span named after it"""
+    name = func.__qualname__
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with TRACER.span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread for a number of service cycles
+    Work is spread over the event loop, the service pool and probe threads, which
+    cProfile (one thread at a time) would miss. Stacks are written in the folded
+    format flame graph tools read, busiest functions are logged
+    """
+    
+    IDLE_FILES = ('threading.py', 'selectors.py', 'queue.py', 'socketserver.py', 'thread.py')
+    
+    def __init__(self, directory: str = PROFILE_DIR, interval: float = PROFILE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.remaining = 0
+        self.started = 0.0
+        self.samples = {}  # Folded stack -> sample count
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+    
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+    
+    def toggle(self, cycles: int = PROFILE_CYCLES):
+        """Start profiling the next cycles, or stop and dump a running profile"""
+        if self.running:
+            self.stop()
+        else:
+            self.start(cycles)
+    
+    def start(self, cycles: int = PROFILE_CYCLES):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.remaining = cycles
+            self.samples = {}
+            self.started = time.monotonic()
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self.thread.start()
+        logger.info("Profiling the next %s cycles", cycles)
+    
+    def cycle_done(self, trace: Trace, duration: float):
+        """Tracer observer counting down the cycles left to profile"""
+        if self.thread is None:
+            return
+        with self.lock:
+            self.remaining -= 1
+            done = self.remaining <= 0
+        if done:
+            self.stop()
+    
+    def stop(self) -> Optional[str]:
+        """Stop sampling, returns the path of the profile written"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return None
+        self.stopped.set()
+        if thread is not threading.current_thread():
+            thread.join(5)
+        return self.dump(time.monotonic() - self.started)
+    
+    def _sample(self):
+        own = threading.get_ident()
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+    
+    def dump(self, elapsed: float) -> Optional[str]:
+        """Write the folded stacks and log the functions most samples were busy in"""
+        samples = dict(self.samples)
+        leaves = {}
+        busy = 0
+        for stack, count in samples.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            if leaf.split(":")[0].split("(")[-1] in self.IDLE_FILES:
+                continue
+            busy += count
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        top = sorted(leaves.items(), key=lambda item: item[1], reverse=True)[:10]
+        logger.info("Profiled %.1fs, %s of %s samples busy", elapsed, busy, sum(samples.values()))
+        for leaf, count in top:
+            logger.info("  %5.1f%% %s", 100 * count / max(busy, 1), leaf)
+        
+        path = os.path.join(self.directory, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, 'w') as f:
+                for stack, count in sorted(samples.items()):
+                    f.write(f"{stack} {count}\n")
+        except Exception as e:
+            logger.error("Error writing profile: %s", e)
+            return None
+        logger.info("Profile written to %s", path)
+        return path
+
+class RtspConnection:
+    """Minimal RTSP client connection that sends requests and reads status codes"""
+    
+    def __init__(self, host: str, port: int = RTSP_PORT, timeout: float = RTSP_PROBE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.cseq = 0
+        self.sock = None
+        self.reader = None
+    
+    def request(self, method: str, url: str, headers: Optional[Dict] = None) -> Optional[int]:
         """
-        Scan local network for IP cameras using arp-scan
-        Returns list of detected cameras with their details
+        Send a request, reconnecting once if the camera closed a kept-alive connection
+        Returns the response status code or None if the camera is unreachable
         """
-        cameras = []
+        for attempt in range(2):
+            reused = self.sock is not None
+            try:
+                if not reused:
+                    self._connect()
+                return self._exchange(method, url, headers or {})
+            except (OSError, ValueError) as e:
+                logger.debug("RTSP %s %s failed: %s", method, url, e)
+                self.close()
+                # Only a kept-alive connection the camera closed is worth a second try;
+                # connect errors and timeouts would just be paid twice
+                if not (reused and isinstance(e, ConnectionError)):
+                    return None
+        return None
+    
+    def close(self):
+        """Close the connection"""
+        if self.reader:
+            self.reader.close()
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.reader = None
+    
+    def _connect(self):
+        """Open the TCP connection"""
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.reader = self.sock.makefile('rb')
+    
+    def _exchange(self, method: str, url: str, headers: Dict) -> int:
+        """Send one request and read the complete response"""
+        self.cseq += 1
+        lines = [f"{method} {url} RTSP/1.0", f"CSeq: {self.cseq}",
+                 "User-Agent: camera-portal"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        self.sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode())
+        
+        status_line = self.reader.readline().decode('latin-1')
+        if not status_line:
+            raise ConnectionError("connection closed by camera")
+        parts = status_line.split()
+        if len(parts) < 2 or not parts[0].startswith('RTSP/'):
+            raise ValueError(f"bad status line {status_line.strip()!r}")
         
+        response_headers = {}
+        while True:
+            line = self.reader.readline().decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        
+        # Skip the body (SDP) so the next response starts cleanly
+        length = int(response_headers.get('content-length', 0))
+        if length:
+            self.reader.read(length)
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return int(parts[1])
+
+class RtspProber:
+    """Finds a working RTSP path per camera and remembers which path each model uses"""
+    
+    def __init__(self, paths: Optional[List[str]] = None, port: int = RTSP_PORT,
+                 timeout: float = RTSP_PROBE_TIMEOUT):
+        self.paths = paths
+        self.port = port
+        self.timeout = timeout
+        self.preferred = {}  # (vendor, model) or (vendor, None) -> path that answered 200
+        self.lock = threading.Lock()
+    
+    def learn(self, vendor: str, model: str, path: str):
+        """Remember that cameras of this vendor and model serve path"""
+        with self.lock:
+            self.preferred[(vendor, model)] = path
+            self.preferred[(vendor, None)] = path
+    
+    def candidates(self, vendor: str, model: str) -> List[str]:
+        """Candidate paths with the ones known to work for this camera type first"""
+        paths = list(self.paths or CameraDiscovery.RTSP_PATHS)
+        with self.lock:
+            hints = [self.preferred.get((vendor, model)), self.preferred.get((vendor, None))]
+        for hint in reversed(hints):
+            if hint:
+                if hint in paths:
+                    paths.remove(hint)
+                paths.insert(0, hint)
+        return paths
+    
+    def find_stream(self, ip: str, vendor: str = "Unknown",
+                    model: str = "Unknown") -> Optional[str]:
+        """
+        Check candidate paths with DESCRIBE over one reused connection
+        Returns the first path answering 200, else the first one asking for
+        authentication, else None
+        """
+        base = f"rtsp://{ip}:{self.port}"
+        connection = RtspConnection(ip, self.port, self.timeout)
         try:
-            # Run arp-scan to discover devices
-            cmd = f"sudo arp-scan --localnet --interface={interface} --quiet"
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+            if connection.request('OPTIONS', f"{base}/") is None:
+                logger.debug("No RTSP service on %s:%s", ip, self.port)
+                return None
             
-            if result.returncode == 0:
-                lines = result.stdout.strip().split('\n')
-                
-                # Parse arp-scan output
-                for line in lines:
-                    if not line.startswith(('Starting', 'Ending', 'Interface')) and line.strip():
-                        parts = line.split('\t')
-                        if len(parts) >= 2:
-                            ip = parts[0].strip()
-                            mac = parts[1].strip()
-                            vendor = parts[2].strip() if len(parts) > 2 else "Unknown"
-                            
-                            # Check if device might be a camera (common camera vendors)
-                            camera_vendors = [
-                                'hikvision', 'dahua', 'axis', 'bosch', 'sony',
-                                'panasonic', 'samsung', 'vivotek', 'arecont'
-                            ]
-                            
-                            is_camera = any(vendor.lower().find(v) != -1 
-                                          for v in camera_vendors)
-                            
-                            if is_camera:
-                                # Try to detect camera model via ONVIF or HTTP
-                                camera_info = CameraDiscovery._probe_camera(ip)
-                                cameras.append({
-                                    'ip': ip,
-                                    'mac': mac,
-                                    'vendor': vendor,
-                                    'model': camera_info.get('model', 'Unknown'),
-                                    'rtsp_url': camera_info.get('rtsp_url'),
-                                    'discovered_at': datetime.now().isoformat()
-                                })
-            
-            logger.info(f"Discovered {len(cameras)} potential cameras")
-            return cameras
-            
-        except Exception as e:
-            logger.error(f"Error scanning network: {e}")
-            return []
+            auth_required = None
+            for path in self.candidates(vendor, model):
+                status = connection.request('DESCRIBE', f"{base}{path}",
+                                            {'Accept': 'application/sdp'})
+                if status == 200:
+                    self.learn(vendor, model, path)
+                    return f"{base}{path}"
+                if status == 401 and auth_required is None:
+                    auth_required = f"{base}{path}"
+                if status is None:
+                    break
+            return auth_required
+        finally:
+            connection.close()
+
+class ProbeEngine:
+    """Probes many camera hosts concurrently with bounded parallelism"""
+    
+    def __init__(self, max_workers: int = PROBE_MAX_WORKERS,
+                 per_host_limit: int = PROBE_PER_HOST_LIMIT,
+                 deadline: float = PROBE_DEADLINE,
+                 ports: List[int] = None, timeout: float = PROBE_TIMEOUT,
+                 rtsp_prober: Optional[RtspProber] = None):
+        self.max_workers = max_workers
+        self.per_host_limit = max(1, per_host_limit)
+        self.deadline = deadline
+        self.ports = ports or list(PROBE_HTTP_PORTS)
+        self.timeout = timeout
+        self.rtsp_prober = rtsp_prober or RtspProber()
+    
+    def probe_hosts(self, hosts: Iterable[Dict]) -> List[Dict]:
+        """
+        Probe every host on every port in parallel
+        Hosts are dicts with ip, mac and vendor and may come from a generator;
+        each host is probed as soon as it arrives. Returns camera dicts in arrival order
+        """
+        started = time.monotonic()
+        results = sorted(self._iter_probe(hosts), key=lambda result: result[0])
+        logger.debug("Probed %s hosts in %.2fs", len(results), time.monotonic() - started)
+        return [camera for _, camera in results]
+    
+    def iter_probe(self, hosts: Iterable[Dict]) -> Iterator[Dict]:
+        """
+        Probe hosts like probe_hosts, yielding each camera as soon as it is done
+        Hosts carrying a 'cached' camera dict are passed through without probing
+        """
+        for _, camera in self._iter_probe(hosts):
+            yield camera
+    
+    def _iter_probe(self, hosts: Iterable[Dict]) -> Iterator[Tuple[int, Dict]]:
+        """Yield (arrival order, camera) in completion order until the deadline"""
+        started = time.monotonic()
+        trace = TRACER.current()  # Probe threads record into the caller's trace
+        executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                      thread_name_prefix="probe")
+        results = queue.Queue()
+        pending = {}  # IP -> state of hosts still being probed
+        pending_lock = threading.Lock()
+        stop = threading.Event()
+        feed = {'count': 0, 'error': None}
+        
+        def report(state):
+            with pending_lock:
+                if state['reported']:
+                    return
+                state['reported'] = True
+                pending.pop(state['host']['ip'], None)
+            camera = self._camera(state)
+            if trace is not None:
+                trace.add('probe', state['started'], time.monotonic(), ip=camera['ip'], model=camera['model'])
+            PROBES.inc(result='identified' if camera['model'] != 'Unknown' or camera['rtsp_url'] else 'unidentified')
+            PROBE_SECONDS.observe(time.monotonic() - state['started'])
+            results.put((state['order'], camera))
+        
+        def feeder():
+            seen = set()
+            try:
+                for host in hosts:
+                    if stop.is_set():
+                        logger.warning("Probe deadline of %ss reached while hosts were still arriving",
+                                       self.deadline)
+                        break
+                    ip = host['ip']
+                    if ip in seen:
+                        continue
+                    seen.add(ip)
+                    order = feed['count']
+                    feed['count'] += 1
+                    
+                    if host.get('cached'):
+                        results.put((order, host['cached']))
+                        continue
+                    
+                    lanes = min(self.per_host_limit, len(self.ports))
+                    state = {
+                        'host': host,
+                        'order': order,
+                        'ports': iter(self.ports),
+                        'lock': threading.Lock(),
+                        'identified': threading.Event(),
+                        'vendor': host.get('vendor', 'Unknown'),
+                        'model': 'Unknown',
+                        'rtsp_url': None,
+                        'lanes': lanes,
+                        'started': time.monotonic(),
+                        'finished': None,
+                        'reported': False
+                    }
+                    with pending_lock:
+                        pending[ip] = state
+                    
+                    # Lanes share the port list, so at most per_host_limit probes hit one camera
+                    for _ in range(lanes):
+                        executor.submit(self._probe_lane, ip, state, report)
+            except Exception as e:
+                feed['error'] = e
+            finally:
+                results.put(None)
+        
+        threading.Thread(target=feeder, name="probe-feeder", daemon=True).start()
+        
+        yielded = 0
+        total = None
+        try:
+            while total is None or yielded < total:
+                remaining = self.deadline - (time.monotonic() - started)
+                try:
+                    item = results.get(timeout=max(0.001, remaining))
+                except queue.Empty:
+                    logger.warning("Probe deadline of %ss reached, %s hosts unfinished",
+                                   self.deadline, len(pending))
+                    break
+                if item is None:
+                    if feed['error'] is not None:
+                        raise feed['error']
+                    total = feed['count']
+                    continue
+                yielded += 1
+                yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        # Report hosts that missed the deadline with whatever was learned so far
+        with pending_lock:
+            leftovers = list(pending.values())
+            for state in leftovers:
+                state['reported'] = True
+            pending.clear()
+        for state in leftovers:
+            PROBES.inc(result='deadline')
+            results.put((state['order'], self._camera(state)))
+        while True:
+            try:
+                item = results.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                yield item
     
     @staticmethod
-    def _probe_camera(ip: str) -> Dict:
-        """Probe camera for more information"""
-        info = {'model': 'Unknown', 'rtsp_url': None}
-        
-        # Common RTSP URLs to try
-        rtsp_paths = [
-            '/live/main', '/live', '/stream', '/video', '/h264',
-            '/cam/realmonitor', '/MediaInput/h264'
-        ]
+    def _camera(state: Dict) -> Dict:
+        """Build the camera dict for a probed host"""
+        host = state['host']
+        latency = None
+        if state['finished'] is not None:
+            latency = round(state['finished'] - state['started'], 3)
+        return {
+            'ip': host['ip'],
+            'mac': host.get('mac'),
+            'vendor': host.get('vendor', 'Unknown'),
+            'model': state['model'],
+            'rtsp_url': state['rtsp_url'],
+            'probe_latency': latency,
+            'discovered_at': datetime.now().isoformat()
+        }
+    
+    def _probe_lane(self, ip: str, state: Dict, report):
+        """
+        Probe the host's remaining ports one by one until one identifies it
+        The last lane to finish looks for the RTSP stream, once the model is known
+        """
+        while not state['identified'].is_set():
+            with state['lock']:
+                port = next(state['ports'], None)
+            if port is None:
+                break
+            model = CameraDiscovery._probe_http(ip, port, self.timeout)
+            if model:
+                state['model'] = model
+                state['identified'].set()
         
-        # Try to get basic info via HTTP
+        with state['lock']:
+            state['lanes'] -= 1
+            if state['lanes']:
+                return
+        state['rtsp_url'] = self.rtsp_prober.find_stream(ip, state['vendor'], state['model'])
+        state['finished'] = time.monotonic()
+        report(state)
+
+def parse_arp_scan_line(line: str) -> Optional[Tuple[str, str, str]]:
+    """Parse one line of arp-scan output into (ip, mac, vendor)"""
+    if line.startswith(('Starting', 'Ending', 'Interface')) or not line.strip():
+        return None
+    parts = line.split('\t')
+    if len(parts) < 2:
+        return None
+    vendor = parts[2].strip() if len(parts) > 2 else "Unknown"
+    return parts[0].strip(), parts[1].strip().lower(), vendor or "Unknown"
+
+class ArpScanBackend:
+    """Discovers hosts by running the arp-scan tool"""
+    
+    def sweep(self, interface: str) -> Iterator[Tuple[str, str, str]]:
+        """Yield (ip, mac, vendor) for each line arp-scan prints"""
+        cmd = ["sudo", "arp-scan", "--localnet", f"--interface={interface}", "--quiet"]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   text=True, bufsize=1)
+        try:
+            for line in process.stdout:
+                entry = parse_arp_scan_line(line.rstrip('\n'))
+                if entry:
+                    yield entry
+        finally:
+            process.stdout.close()
+            if process.wait() != 0:
+                logger.error("arp-scan failed: %s", process.stderr.read().strip())
+            process.stderr.close()
+
+class ProcArpBackend:
+    """Reads hosts the kernel already resolved from /proc/net/arp"""
+    
+    ATF_COM = 0x2  # Entry is complete
+    
+    def __init__(self, path: str = "/proc/net/arp"):
+        self.path = path
+    
+    def sweep(self, interface: str) -> Iterator[Tuple[str, str, str]]:
+        """Yield (ip, mac, vendor) for complete ARP cache entries on interface"""
+        with open(self.path, 'r') as f:
+            next(f, None)  # Header
+            for line in f:
+                fields = line.split()
+                if len(fields) < 6 or fields[5] != interface:
+                    continue
+                if int(fields[2], 16) & self.ATF_COM:
+                    yield fields[0], fields[3].lower(), "Unknown"
+
+class NativeArpBackend:
+    """Sweeps the local subnet with ARP requests over a raw AF_PACKET socket"""
+    
+    ETH_P_ARP = 0x0806
+    ARP_REQUEST = 1
+    ARP_REPLY = 2
+    
+    def __init__(self, reply_timeout: float = ARP_REPLY_TIMEOUT,
+                 max_hosts: int = ARP_MAX_HOSTS, fallback=None):
+        self.reply_timeout = reply_timeout
+        self.max_hosts = max_hosts
+        self.fallback = fallback or ProcArpBackend()
+    
+    def sweep(self, interface: str) -> Iterator[Tuple[str, str, str]]:
+        """
+        Yield (ip, mac, vendor) as replies arrive, while requests are still being sent
+        Falls back to the ARP cache when raw sockets are unavailable
+        """
         try:
-            # Common camera web ports
-            ports = [80, 8080, 8000]
+            own_mac, network, own_ip = self._interface_addresses(interface)
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                 socket.htons(self.ETH_P_ARP))
+            sock.bind((interface, 0))
+        except (OSError, AttributeError, KeyError, ValueError) as e:
+            logger.warning("Raw ARP sweep unavailable on %s (%s), using the ARP cache instead", interface, e)
+            yield from self.fallback.sweep(interface)
+            return
+        
+        with sock:
+            sock.setblocking(False)
+            seen = set()
+            sent = 0
             
-            for port in ports:
-                try:
-                    response = requests.get(f"http://{ip}:{port}", timeout=2)
-                    if response.status_code == 200:
-                        # Parse HTML for camera info (simplified)
-                        if 'camera' in response.text.lower() or 'ip' in response.text.lower():
-                            info['model'] = 'Generic IP Camera'
-                            break
-                except:
+            for target in network.hosts():
+                if target == own_ip:
                     continue
+                if sent >= self.max_hosts:
+                    logger.warning("ARP sweep of %s truncated at %s hosts", network, self.max_hosts)
+                    break
+                self._send(sock, self._request_frame(own_mac, own_ip, target))
+                sent += 1
+                if sent % 64 == 0:
+                    yield from self._drain(sock, network, seen, 0)
+            
+            # Collect late replies until the network goes quiet
+            while True:
+                before = len(seen)
+                yield from self._drain(sock, network, seen, self.reply_timeout)
+                if len(seen) == before:
+                    break
+    
+    def _interface_addresses(self, interface: str):
+        """Return the interface's MAC, IPv4 network and IPv4 address"""
+        addresses = netifaces.ifaddresses(interface)
+        inet = addresses[netifaces.AF_INET][0]
+        mac = bytes.fromhex(addresses[netifaces.AF_LINK][0]['addr'].replace(':', ''))
+        network = ipaddress.IPv4Network(f"{inet['addr']}/{inet['netmask']}", strict=False)
+        return mac, network, ipaddress.IPv4Address(inet['addr'])
+    
+    def _request_frame(self, own_mac: bytes, own_ip, target) -> bytes:
+        """Build a broadcast Ethernet frame carrying an ARP who-has request"""
+        return struct.pack(
+            '!6s6sHHHBBH6s4s6s4s',
+            b'\xff' * 6, own_mac, self.ETH_P_ARP,
+            1, 0x0800, 6, 4, self.ARP_REQUEST,
+            own_mac, own_ip.packed, b'\x00' * 6, target.packed
+        )
+    
+    def _send(self, sock: socket.socket, frame: bytes):
+        """Send a frame, waiting briefly when the socket buffer is full"""
+        while True:
+            try:
+                sock.send(frame)
+                return
+            except BlockingIOError:
+                select.select([], [sock], [], 0.1)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                time.sleep(0.001)
+    
+    def _drain(self, sock: socket.socket, network, seen: set,
+               timeout: float) -> Iterator[Tuple[str, str, str]]:
+        """Yield new ARP replies, waiting up to timeout for the first one"""
+        while select.select([sock], [], [], timeout)[0]:
+            timeout = 0
+            try:
+                frame = sock.recv(2048)
+            except BlockingIOError:
+                return
+            if len(frame) < 42 or struct.unpack('!H', frame[12:14])[0] != self.ETH_P_ARP:
+                continue
+            if struct.unpack('!H', frame[20:22])[0] != self.ARP_REPLY:
+                continue
+            ip = ipaddress.IPv4Address(frame[28:32])
+            if ip in network and ip not in seen:
+                seen.add(ip)
+                yield str(ip), frame[22:28].hex(':'), "Unknown"
+
+class RecordedArpBackend:
+    """Replays recorded arp-scan output, stands in for a live sweep in tests"""
+    
+    def __init__(self, lines: Iterable[str]):
+        self.lines = list(lines)
+    
+    @classmethod
+    def from_file(cls, path: str) -> 'RecordedArpBackend':
+        """Load a recording made with arp-scan --quiet"""
+        with open(path, 'r') as f:
+            return cls(f.read().splitlines())
+    
+    def sweep(self, interface: str) -> Iterator[Tuple[str, str, str]]:
+        """Yield (ip, mac, vendor) for each recorded reply"""
+        for line in self.lines:
+            entry = parse_arp_scan_line(line)
+            if entry:
+                yield entry
+
+ARP_BACKENDS = {
+    'arp-scan': ArpScanBackend,
+    'native': NativeArpBackend,
+    'proc': ProcArpBackend
+}
+
+def create_arp_backend(name: str):
+    """Create the ARP sweep backend registered under name"""
+    if name not in ARP_BACKENDS:
+        logger.error("Unknown ARP backend '%s', using %s", name, ARP_BACKEND)
+        name = ARP_BACKEND
+    return ARP_BACKENDS[name]()
+
+def load_settings() -> Dict:
+    """Load service settings from the config file"""
+    try:
+        if os.path.exists(CONFIG_FILE):
+            with open(CONFIG_FILE, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        logger.error("Error loading settings: %s", e)
+    return {}
+
+def atomic_write_json(path: str, data, indent: Optional[int] = None):
+    """Write JSON so readers see either the old or the new file, never a partial one"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    
+    # Persist the rename itself
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class VendorIndex:
+    """Classifies devices as cameras by MAC OUI prefix, with vendor name matching as fallback"""
+    
+    def __init__(self, camera_ouis: Optional[Dict[str, str]] = None,
+                 keywords: Optional[List[str]] = None):
+        self.vendors = {}  # OUI -> vendor name for every known manufacturer
+        self.camera_ouis = {}  # OUI -> vendor name for camera manufacturers
+        self.add_camera_ouis(CAMERA_OUIS if camera_ouis is None else camera_ouis)
+        
+        keywords = keywords if keywords is not None else CameraDiscovery.CAMERA_VENDORS
+        self.keyword_pattern = re.compile(
+            '|'.join(re.escape(k.lower()) for k in keywords) or '(?!)'
+        )
+        self._vendor_matches = {}  # Vendor name -> keyword match result
+    
+    @classmethod
+    def from_settings(cls, settings: Dict) -> 'VendorIndex':
+        """Build the index from the bundled prefixes plus config.json overrides"""
+        keywords = CameraDiscovery.CAMERA_VENDORS + settings.get('camera_vendors', [])
+        index = cls(keywords=keywords)
+        index.add_camera_ouis(settings.get('camera_ouis', {}))
         
+        oui_files = [settings['oui_file']] if settings.get('oui_file') else OUI_FILES
+        for path in oui_files:
+            if os.path.exists(path):
+                index.load_oui_file(path)
+                break
+        return index
+    
+    @staticmethod
+    def oui(mac: str) -> str:
+        """Normalise a MAC address or prefix to its six hex digit OUI"""
+        return re.sub(r'[^0-9A-Fa-f]', '', mac)[:6].upper()
+    
+    def add_camera_ouis(self, camera_ouis: Dict[str, str]):
+        """Register extra camera prefixes, keyed by any MAC prefix notation"""
+        for prefix, vendor in camera_ouis.items():
+            oui = self.oui(prefix)
+            self.camera_ouis[oui] = vendor
+            self.vendors.setdefault(oui, vendor)
+    
+    def load_oui_file(self, path: str):
+        """
+        Load vendor names from an IEEE oui.txt or arp-scan ieee-oui.txt file
+        Lines look like "00-40-8C   (hex)\t\tAxis" or "00408C\tAxis"
+        """
+        entry = re.compile(r'^([0-9A-Fa-f]{2}[-:]?[0-9A-Fa-f]{2}[-:]?[0-9A-Fa-f]{2})'
+                           r'(?:\s+\((?:hex|base 16)\))?\s+(\S.*)$')
+        count = 0
+        try:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    match = entry.match(line)
+                    if match:
+                        self.vendors[self.oui(match.group(1))] = match.group(2).strip()
+                        count += 1
+            logger.info("Loaded %s vendor prefixes from %s", count, path)
         except Exception as e:
-            logger.debug(f"HTTP probe failed for {ip}: {e}")
+            logger.error("Error loading OUI file %s: %s", path, e)
+    
+    def classify(self, mac: str, vendor: str = "Unknown") -> Optional[str]:
+        """
+        Return the vendor name if the device looks like a camera, None otherwise
+        Devices without a vendor name are resolved through their MAC prefix
+        """
+        oui = self.oui(mac)
+        if oui in self.camera_ouis:
+            return vendor if vendor != "Unknown" else self.camera_ouis[oui]
         
-        # Try common RTSP URLs
-        for path in rtsp_paths:
-            rtsp_url = f"rtsp://{ip}:{RTSP_PORT}{path}"
-            # Note: Actual RTSP connection test would go here
-            info['rtsp_url'] = rtsp_url
-            break
+        if vendor == "Unknown":
+            vendor = self.vendors.get(oui, vendor)
         
-        return info
+        matches = self._vendor_matches.get(vendor)
+        if matches is None:
+            matches = self.keyword_pattern.search(vendor.lower()) is not None
+            self._vendor_matches[vendor] = matches
+        return vendor if matches else None
+
+class ProbeCache:
+    """Remembers probe results per MAC so rescans only probe what changed"""
+    
+    def __init__(self, path: Optional[str] = PROBE_CACHE_FILE, ttl: float = PROBE_CACHE_TTL,
+                 max_entries: int = PROBE_CACHE_MAX_ENTRIES, retry_ttl: float = PROBE_CACHE_RETRY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.retry_ttl = retry_ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # MAC -> entry, least recently seen first
+        self.lock = threading.Lock()
+        self.load()
+    
+    def load(self):
+        """Load cached entries from file"""
+        try:
+            if self.path and os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    entries = json.load(f).get('entries', [])
+                self.entries = OrderedDict((e['mac'], e) for e in entries)
+        except Exception as e:
+            logger.error("Error loading probe cache: %s", e)
+    
+    def save(self):
+        """Save cached entries to file"""
+        if not self.path:
+            return
+        try:
+            atomic_write_json(self.path, {'entries': list(self.entries.values())})
+        except Exception as e:
+            logger.error("Error saving probe cache: %s", e)
+    
+    def lookup(self, mac: str, ip: str) -> Optional[Dict]:
+        """Return the entry for mac if it is still valid for ip, None if it needs probing"""
+        entry = self.entries.get(mac)
+        if entry is None or entry['ip'] != ip:
+            return None
+        if time.time() - entry['probed_at'] > entry.get('ttl', self.ttl):
+            return None
+        return entry
+    
+    def store(self, camera: Dict):
+        """
+        Record a freshly probed camera
+        Probes cut off by the scan deadline are not cached, and hosts that could
+        not be identified are cached only for retry_ttl
+        """
+        if camera.get('probe_latency') is None:
+            return  # Probe never finished
+        now = time.time()
+        identified = camera['model'] != 'Unknown' or camera['rtsp_url']
+        entry = {
+            'mac': camera['mac'],
+            'ip': camera['ip'],
+            'vendor': camera['vendor'],
+            'model': camera['model'],
+            'rtsp_url': camera['rtsp_url'],
+            'probe_latency': camera.get('probe_latency'),
+            'probed_at': now,
+            'ttl': self.ttl if identified else self.retry_ttl,
+            'last_seen': now,
+            'present': True
+        }
+        with self.lock:
+            self.entries[camera['mac']] = entry
+            self.entries.move_to_end(camera['mac'])
+            
+            # Evict least recently seen cameras
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def touch(self, mac: str):
+        """Mark a cached camera as seen in the current sweep"""
+        with self.lock:
+            entry = self.entries[mac]
+            entry['last_seen'] = time.time()
+            entry['present'] = True
+            self.entries.move_to_end(mac)
+    
+    def mark_absent(self, seen: set) -> List[Dict]:
+        """Flag cameras that were present but not seen now, returns them"""
+        removed = []
+        with self.lock:
+            for mac, entry in self.entries.items():
+                if entry.get('present') and mac not in seen:
+                    entry['present'] = False
+                    removed.append(entry)
+        return removed
+    
+    @staticmethod
+    def to_camera(entry: Dict) -> Dict:
+        """Build a camera dict from a cache entry"""
+        return {
+            'ip': entry['ip'],
+            'mac': entry['mac'],
+            'vendor': entry['vendor'],
+            'model': entry['model'],
+            'rtsp_url': entry['rtsp_url'],
+            'probe_latency': entry.get('probe_latency'),
+            'discovered_at': datetime.now().isoformat()
+        }
+
+class CameraDiscovery:
+    """Handles discovery of IP cameras in local network"""
+    
+    # Common camera vendors
+    CAMERA_VENDORS = [
+        'hikvision', 'dahua', 'axis', 'bosch', 'sony',
+        'panasonic', 'samsung', 'vivotek', 'arecont'
+    ]
+    
+    # Common RTSP URLs to try
+    RTSP_PATHS = [
+        '/live/main', '/live', '/stream', '/video', '/h264',
+        '/cam/realmonitor', '/MediaInput/h264'
+    ]
+    
+    def __init__(self, probe_engine: Optional[ProbeEngine] = None, arp_backend=None,
+                 vendor_index: Optional[VendorIndex] = None,
+                 probe_cache: Optional[ProbeCache] = None):
+        self.probe_engine = probe_engine or ProbeEngine()
+        self.arp_backend = arp_backend or create_arp_backend(ARP_BACKEND)
+        self.vendor_index = vendor_index or VendorIndex.from_settings({})
+        self.probe_cache = probe_cache
+        if probe_cache is not None:
+            self._learn_rtsp_paths(probe_cache)
+    
+    def scan_local_network(self, interface: str = "eth0") -> List[Dict]:
+        """
+        Scan local network for IP cameras with the configured ARP backend
+        Returns list of detected cameras with their details
+        """
+        try:
+            # Probing starts while the sweep is still collecting replies
+            cameras = self.probe_engine.probe_hosts(self._iter_candidates(interface))
+            
+            logger.info("Discovered %s potential cameras", len(cameras))
+            return cameras
+            
+        except Exception as e:
+            logger.error("Error scanning network: %s", e)
+            return []
+    
+    def scan_incremental(self, interface: str = "eth0") -> Tuple[List[Dict], Dict]:
+        """
+        Scan local network, probing only new MACs, changed IPs and expired cache entries
+        Returns the detected cameras and a delta with added, changed and removed cameras
+        """
+        delta = {}
+        try:
+            cameras = list(self.iter_incremental(interface, delta))
+        except Exception as e:
+            logger.error("Error scanning network: %s", e)
+            return [], {'added': [], 'changed': [], 'removed': []}
+        return cameras, delta
+    
+    def iter_incremental(self, interface: str = "eth0",
+                         delta: Optional[Dict] = None) -> Iterator[Dict]:
+        """
+        Incremental scan yielding each camera as soon as it is known
+        Cached cameras come out while the sweep runs, probed ones as their probes
+        finish. The delta dict is filled in once the scan completes
+        """
+        if self.probe_cache is None:
+            self.probe_cache = ProbeCache()
+        cache = self.probe_cache
+        delta = {} if delta is None else delta
+        delta.update({'added': [], 'changed': [], 'removed': []})
+        seen = set()
+        cached = set()
+        previous = {}
+        counts = {'cameras': 0, 'probed': 0}
+        started = time.monotonic()
+        trace = TRACER.current()
+        
+        def candidates():
+            yield from sweep()
+            SCAN_SECONDS.observe(time.monotonic() - started, stage='sweep')
+            if trace is not None:
+                trace.add('scan.sweep', started, time.monotonic(), hosts=len(seen))
+        
+        def sweep():
+            for host in self._iter_candidates(interface):
+                mac = host['mac']
+                seen.add(mac)
+                entry = cache.entries.get(mac)
+                if entry is not None and entry.get('present'):
+                    previous[mac] = dict(entry)
+                
+                if cache.lookup(mac, host['ip']) is not None:
+                    cache.touch(mac)
+                    cached.add(mac)
+                    host = dict(host, cached=ProbeCache.to_camera(cache.entries[mac]))
+                yield host
+        
+        for camera in self.probe_engine.iter_probe(candidates()):
+            counts['cameras'] += 1
+            if camera['mac'] not in cached:
+                counts['probed'] += 1
+                cache.store(camera)
+                before = previous.get(camera['mac'])
+                if before is None:
+                    delta['added'].append(camera)
+                elif any(before[k] != camera[k] for k in ('ip', 'model', 'rtsp_url')):
+                    delta['changed'].append(camera)
+            yield camera
+        
+        delta['removed'] = [ProbeCache.to_camera(e) for e in cache.mark_absent(seen)]
+        cache.save()
+        SCAN_SECONDS.observe(time.monotonic() - started, stage='total')
+        SCAN_CAMERAS.inc(counts['cameras'] - counts['probed'], source='cached')
+        SCAN_CAMERAS.inc(counts['probed'], source='probed')
+        
+        logger.info("Discovered %s cameras (%s probed): %s added, %s changed, %s removed",
+                    counts['cameras'], counts['probed'],
+                    len(delta['added']), len(delta['changed']), len(delta['removed']))
+    
+    def _learn_rtsp_paths(self, cache: ProbeCache):
+        """Seed the RTSP path hints with the paths cached cameras use"""
+        for entry in cache.entries.values():
+            if entry.get('rtsp_url'):
+                path = '/' + entry['rtsp_url'].split('/', 3)[-1]
+                self.probe_engine.rtsp_prober.learn(entry['vendor'], entry['model'], path)
+    
+    def _iter_candidates(self, interface: str) -> Iterator[Dict]:
+        """Yield swept hosts that look like cameras"""
+        for ip, mac, vendor in self.arp_backend.sweep(interface):
+            # Check if device might be a camera
+            camera_vendor = self.vendor_index.classify(mac, vendor)
+            
+            if camera_vendor:
+                yield {'ip': ip, 'mac': mac, 'vendor': camera_vendor}
+    
+    @staticmethod
+    def _probe_http(ip: str, port: int, timeout: float) -> Optional[str]:
+        """Fetch the camera web page on one port, returns a model guess or None"""
+        try:
+            response = requests.get(f"http://{ip}:{port}", timeout=timeout)
+            if response.status_code == 200:
+                # Parse HTML for camera info (simplified)
+                if 'camera' in response.text.lower() or 'ip' in response.text.lower():
+                    return 'Generic IP Camera'
+        except requests.Timeout as e:
+            PROBE_HTTP_ERRORS.inc(reason='timeout')
+            logger.debug("HTTP probe failed for %s:%s: %s", ip, port, e)
+        except Exception as e:
+            PROBE_HTTP_ERRORS.inc(reason='connection' if isinstance(e, requests.ConnectionError) else 'other')
+            logger.debug("HTTP probe failed for %s:%s: %s", ip, port, e)
+        return None
+
+def run_command(cmd: List[str], input: Optional[str] = None) -> subprocess.CompletedProcess:
+    """Run a command without a shell, capturing its output"""
+    program = cmd[1] if cmd[0] == "sudo" and len(cmd) > 1 else cmd[0]
+    started = time.monotonic()
+    try:
+        with TRACER.span('exec', command=program) as span:
+            result = subprocess.run(cmd, input=input, capture_output=True, text=True)
+            span['returncode'] = result.returncode
+    except OSError:
+        SUBPROCESS_FAILURES.inc(command=program)
+        raise
+    SUBPROCESS_SECONDS.observe(time.monotonic() - started, command=program)
+    if result.returncode != 0:
+        SUBPROCESS_FAILURES.inc(command=program)
+    return result
+
+class IptablesFirewall:
+    """Applies camera forwarding rules in atomic iptables-restore transactions"""
+    
+    def camera_rules(self, virtual_ip: str, camera_ip: str,
+                     rtsp_port: int = RTSP_PORT) -> List[Tuple[str, str]]:
+        """
+        Rules forwarding one camera, as (table, rule) in iptables-save syntax
+        Every rule carries a comment so the service can recognise its own rules
+        """
+        tag = f"-m comment --comment {FIREWALL_COMMENT}"
+        return [
+            # Forward RTSP traffic
+            ('nat', f"PREROUTING -d {virtual_ip}/32 -p tcp -m tcp --dport {rtsp_port} {tag} "
+                    f"-j DNAT --to-destination {camera_ip}:{rtsp_port}"),
+            
+            # Masquerade return traffic
+            ('nat', f"POSTROUTING -s {camera_ip}/32 {tag} -j MASQUERADE"),
+            
+            # Allow forwarding
+            ('filter', f"FORWARD -d {camera_ip}/32 -p tcp -m tcp --dport {rtsp_port} {tag} -j ACCEPT"),
+            ('filter', f"FORWARD -s {camera_ip}/32 -p tcp -m tcp --sport {rtsp_port} {tag} -j ACCEPT")
+        ]
+    
+    @staticmethod
+    def render(changes: List[Tuple[str, str]]) -> str:
+        """Render (table, '-A ...' or '-D ...') changes as an iptables-restore script"""
+        script = []
+        for table in ('nat', 'filter'):
+            lines = [change for t, change in changes if t == table]
+            if lines:
+                script += [f"*{table}"] + lines + ["COMMIT"]
+        return "\n".join(script) + "\n"
+    
+    def apply_forwarding(self, mappings: List[Tuple[str, str, int]]) -> Dict[str, bool]:
+        """
+        Append missing forwarding rules for all mappings in one transaction
+        If the transaction fails, each camera is retried alone to find the bad ones
+        """
+        if not mappings:
+            return {}
+        
+        # Rules already in place are not appended again
+        present = {(table, self.rule_key(rule)) for table, rule in self.current_rules()}
+        per_camera = {}
+        for virtual_ip, camera_ip, port in mappings:
+            per_camera[virtual_ip] = []
+            for table, rule in self.camera_rules(virtual_ip, camera_ip, port):
+                if (table, self.rule_key(rule)) not in present:
+                    present.add((table, self.rule_key(rule)))
+                    per_camera[virtual_ip].append((table, f"-A {rule}"))
+        
+        if self.restore([c for changes in per_camera.values() for c in changes]):
+            return {virtual_ip: True for virtual_ip in per_camera}
+        
+        logger.warning("Batched firewall update of %s cameras failed, applying cameras one by one",
+                       len(mappings))
+        return {virtual_ip: self.restore(changes) for virtual_ip, changes in per_camera.items()}
+    
+    def remove_forwarding(self, mappings: List[Tuple[str, str, int]]) -> Dict[str, bool]:
+        """
+        Delete the forwarding rules of all mappings in one transaction
+        Every copy of a rule is deleted and rules already gone are skipped; if the
+        transaction fails, each camera is retried alone
+        """
+        if not mappings:
+            return {}
+        
+        owners = {}
+        for virtual_ip, camera_ip, port in mappings:
+            for table, rule in self.camera_rules(virtual_ip, camera_ip, port):
+                owners[(table, self.rule_key(rule))] = virtual_ip
+        
+        per_camera = {virtual_ip: [] for virtual_ip, _, _ in mappings}
+        for table, rule in self.current_rules(known_keys=set(owners)):
+            virtual_ip = owners.get((table, self.rule_key(rule)))
+            if virtual_ip:
+                per_camera[virtual_ip].append((table, f"-D {rule}"))
+        
+        if self.restore([c for changes in per_camera.values() for c in changes]):
+            return {virtual_ip: True for virtual_ip in per_camera}
+        
+        logger.warning("Batched removal of %s cameras failed, removing cameras one by one", len(mappings))
+        return {virtual_ip: self.restore(changes) for virtual_ip, changes in per_camera.items()}
+    
+    @staticmethod
+    def rule_key(rule: str) -> str:
+        """Rule text without the ownership comment, for comparing rules"""
+        return " ".join(rule.replace(f"-m comment --comment {FIREWALL_COMMENT}", "").split())
+    
+    def current_rules(self, known_keys: Optional[set] = None) -> List[Tuple[str, str]]:
+        """
+        Read the live nat and filter tables once, returns (table, rule) in iptables-save syntax
+        Includes rules tagged by this service, plus untagged rules matching known_keys
+        (left behind by versions that did not tag their rules)
+        """
+        result = run_command(["sudo", "iptables-save"])
+        if result.returncode != 0:
+            raise RuntimeError(f"iptables-save failed: {result.stderr.strip()}")
+        
+        rules = []
+        table = None
+        for line in result.stdout.splitlines():
+            if line.startswith('*'):
+                table = line[1:].strip()
+            elif line.startswith('-A ') and table in ('nat', 'filter'):
+                rule = line[3:].strip()
+                if FIREWALL_COMMENT in rule or (known_keys and (table, self.rule_key(rule)) in known_keys):
+                    rules.append((table, rule))
+        return rules
+    
+    def reconcile(self, mappings: List[Tuple[str, str, int]], dry_run: bool = False) -> Dict:
+        """
+        Make the live rules match the desired mappings, touching only the difference
+        Returns a report with missing, duplicate and orphaned rules and whether
+        the changes were applied
+        """
+        desired = {}
+        for virtual_ip, camera_ip, port in mappings:
+            for table, rule in self.camera_rules(virtual_ip, camera_ip, port):
+                desired[(table, self.rule_key(rule))] = (table, rule)
+        
+        seen = set()
+        report = {'missing': [], 'duplicates': [], 'orphaned': [], 'applied': True}
+        for table, rule in self.current_rules(known_keys=set(desired)):
+            key = (table, self.rule_key(rule))
+            if key not in desired:
+                report['orphaned'].append((table, rule))
+            elif key in seen:
+                report['duplicates'].append((table, rule))
+            seen.add(key)
+        report['missing'] = [desired[key] for key in desired if key not in seen]
+        
+        # -D removes the first match, so one delete per extra copy
+        changes = [(table, f"-D {rule}") for table, rule in report['duplicates'] + report['orphaned']]
+        changes += [(table, f"-A {rule}") for table, rule in report['missing']]
+        if changes and not dry_run:
+            report['applied'] = self.restore(changes)
+        
+        logger.info("Firewall reconcile: %s missing, %s duplicate, %s orphaned rules",
+                    len(report['missing']), len(report['duplicates']), len(report['orphaned']))
+        return report
+    
+    def restore(self, changes: List[Tuple[str, str]]) -> bool:
+        """Apply changes atomically without flushing existing rules"""
+        if not changes:
+            return True
+        result = run_command(["sudo", "iptables-restore", "--noflush"], input=self.render(changes))
+        if result.returncode != 0:
+            logger.error("iptables-restore failed: %s", result.stderr.strip())
+            return False
+        return True
+
+class NftablesFirewall:
+    """
+    Forwards cameras through one nftables table with a DNAT verdict map
+    Adding a camera is a map element update and packet classification is a
+    hash lookup, however many cameras are forwarded
+    """
+    
+    def __init__(self, table: str = NFT_TABLE, dry_run: bool = False):
+        self.table = table
+        self.dry_run = dry_run
+        self.scripts = []  # Scripts rendered in dry-run mode
+        self._ready = False
+    
+    @staticmethod
+    def _elements(mappings: List[Tuple[str, str, int]]) -> Dict[str, List[str]]:
+        """Map and set elements for the mappings"""
+        return {
+            'rtsp_dnat': sorted({f"{virtual_ip} . {port} : {camera_ip} . {port}"
+                                 for virtual_ip, camera_ip, port in mappings}),
+            'camera_endpoints': sorted({f"{camera_ip} . {port}" for _, camera_ip, port in mappings}),
+            'camera_hosts': sorted({camera_ip for _, camera_ip, _ in mappings})
+        }
+    
+    def render_ruleset(self, mappings: List[Tuple[str, str, int]]) -> str:
+        """Render the complete table for the mappings, replacing any previous version"""
+        elements = self._elements(mappings)
+        
+        def element_block(name):
+            if not elements[name]:
+                return ""
+            return f"\t\telements = {{ {', '.join(elements[name])} }}\n"
+        
+        return (
+            f"table ip {self.table} {{}}\n"
+            f"delete table ip {self.table}\n"
+            f"table ip {self.table} {{\n"
+            f"\tmap rtsp_dnat {{\n"
+            f"\t\ttype ipv4_addr . inet_service : ipv4_addr . inet_service\n"
+            f"{element_block('rtsp_dnat')}"
+            f"\t}}\n"
+            f"\tset camera_endpoints {{\n"
+            f"\t\ttype ipv4_addr . inet_service\n"
+            f"{element_block('camera_endpoints')}"
+            f"\t}}\n"
+            f"\tset camera_hosts {{\n"
+            f"\t\ttype ipv4_addr\n"
+            f"{element_block('camera_hosts')}"
+            f"\t}}\n"
+            f"\tchain prerouting {{\n"
+            f"\t\ttype nat hook prerouting priority dstnat; policy accept;\n"
+            f"\t\tmeta l4proto tcp dnat to ip daddr . tcp dport map @rtsp_dnat\n"
+            f"\t}}\n"
+            f"\tchain postrouting {{\n"
+            f"\t\ttype nat hook postrouting priority srcnat; policy accept;\n"
+            f"\t\tip saddr @camera_hosts masquerade\n"
+            f"\t}}\n"
+            f"\tchain forward {{\n"
+            f"\t\ttype filter hook forward priority filter; policy accept;\n"
+            f"\t\tip daddr . tcp dport @camera_endpoints accept\n"
+            f"\t\tip saddr . tcp sport @camera_endpoints accept\n"
+            f"\t}}\n"
+            f"}}\n"
+        )
+    
+    def render_elements(self, command: str, mappings: List[Tuple[str, str, int]],
+                        elements: Optional[Dict[str, List[str]]] = None) -> str:
+        """Render add or delete element commands for the mappings (or given elements)"""
+        lines = []
+        if elements is None:
+            elements = self._elements(mappings)
+        for name, values in elements.items():
+            if values:
+                lines.append(f"{command} element ip {self.table} {name} {{ {', '.join(values)} }}")
+        return "\n".join(lines) + "\n"
+    
+    def apply_forwarding(self, mappings: List[Tuple[str, str, int]]) -> Dict[str, bool]:
+        """
+        Add map and set elements for all mappings in one transaction
+        If the transaction fails, each camera is retried alone to find the bad ones
+        """
+        if not mappings:
+            return {}
+        if not self._ready:
+            self._ready = self._table_exists() or self.run_script(self.render_ruleset([]))
+        
+        if self.run_script(self.render_elements("add", mappings)):
+            return {virtual_ip: True for virtual_ip, _, _ in mappings}
+        
+        logger.warning("Batched nftables update of %s cameras failed, applying cameras one by one",
+                       len(mappings))
+        return {m[0]: self.run_script(self.render_elements("add", [m])) for m in mappings}
+    
+    def remove_forwarding(self, mappings: List[Tuple[str, str, int]]) -> Dict[str, bool]:
+        """
+        Delete the map and set elements of all mappings in one transaction
+        Endpoints still used by other mappings stay in the sets, and mappings
+        already gone count as removed
+        """
+        if not mappings:
+            return {}
+        current = set(mappings) if self.dry_run else set(self.current_mappings())
+        gone = [m for m in mappings if m in current]
+        if not gone:
+            return {virtual_ip: True for virtual_ip, _, _ in mappings}
+        
+        elements = self._elements(gone)
+        kept = self._elements(list(current.difference(gone)))
+        for name in ('camera_endpoints', 'camera_hosts'):
+            elements[name] = [e for e in elements[name] if e not in kept[name]]
+        
+        ok = self.run_script(self.render_elements("delete", gone, elements))
+        return {virtual_ip: ok for virtual_ip, _, _ in mappings}
+    
+    def current_mappings(self) -> List[Tuple[str, str, int]]:
+        """Read the DNAT map from the live table"""
+        if self.dry_run:
+            return []
+        result = run_command(["sudo", "nft", "-j", "list", "map", "ip", self.table, "rtsp_dnat"])
+        if result.returncode != 0:
+            return []
+        
+        mappings = []
+        for item in json.loads(result.stdout).get('nftables', []):
+            for key, value in item.get('map', {}).get('elem', []):
+                virtual_ip, port = key['concat']
+                camera_ip, _ = value['concat']
+                mappings.append((virtual_ip, camera_ip, int(port)))
+        return mappings
+    
+    def reconcile(self, mappings: List[Tuple[str, str, int]], dry_run: bool = False) -> Dict:
+        """
+        Replace the table with the desired mappings in one atomic transaction
+        Sets cannot hold duplicates, so the report only has missing and orphaned entries
+        """
+        desired = set(mappings)
+        current = set(self.current_mappings())
+        report = {
+            'missing': sorted(desired - current),
+            'duplicates': [],
+            'orphaned': sorted(current - desired),
+            'applied': True
+        }
+        if not dry_run and (report['missing'] or report['orphaned'] or not self._ready):
+            report['applied'] = self._ready = self.run_script(self.render_ruleset(mappings))
+        
+        logger.info("Firewall reconcile: %s missing, %s orphaned map entries",
+                    len(report['missing']), len(report['orphaned']))
+        return report
+    
+    def run_script(self, script: str) -> bool:
+        """Apply an nft script atomically, or record it in dry-run mode"""
+        if self.dry_run:
+            self.scripts.append(script)
+            return True
+        result = run_command(["sudo", "nft", "-f", "-"], input=script)
+        if result.returncode != 0:
+            logger.error("nft failed: %s", result.stderr.strip())
+            return False
+        return True
+    
+    def _table_exists(self) -> bool:
+        """Check whether the table is already loaded"""
+        if self.dry_run:
+            return bool(self.scripts)
+        return run_command(["sudo", "nft", "list", "table", "ip", self.table]).returncode == 0
+
+FIREWALL_BACKENDS = {
+    'iptables': IptablesFirewall,
+    'nftables': NftablesFirewall
+}
+
+def create_firewall(name: str):
+    """Create the firewall backend registered under name"""
+    if name not in FIREWALL_BACKENDS:
+        logger.error("Unknown firewall backend '%s', using %s", name, FIREWALL_BACKEND)
+        name = FIREWALL_BACKEND
+    return FIREWALL_BACKENDS[name]()
+
+def relay_listener(listen: Tuple[str, int]) -> socket.socket:
+    """Non-blocking listening socket, bound even if the address is not configured yet"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if sys.platform.startswith('linux'):
+            listener.setsockopt(socket.IPPROTO_IP, IP_FREEBIND, 1)
+        listener.bind(listen)
+        listener.listen(RELAY_BACKLOG)
+        listener.setblocking(False)
+        return listener
+    except OSError:
+        listener.close()
+        raise
+
+class TcpRelay:
+    """
+    Asyncio TCP forwarder moving bytes between sockets without copying them into Python
+    On Linux each direction is spliced through a kernel pipe sized to the buffer
+    limit; elsewhere each direction reuses one preallocated buffer
+    """
+    
+    def __init__(self, buffer_size: int = RELAY_BUFFER_SIZE,
+                 connect_timeout: float = RELAY_CONNECT_TIMEOUT):
+        self.buffer_size = buffer_size
+        self.connect_timeout = connect_timeout
+        self.use_splice = hasattr(os, 'splice')
+        self.routes = {}  # Listening (host, port) -> route
+        self.stats = {}  # Listening (host, port) -> counters
+    
+    async def add_route(self, listen: Tuple[str, int], target: Tuple[str, int]) -> Tuple[str, int]:
+        """
+        Start relaying connections on listen to target, returns the bound address
+        Raises ValueError if listen already relays to another target
+        """
+        if listen in self.routes:
+            if self.routes[listen]['target'] != target:
+                raise ValueError(f"{listen[0]}:{listen[1]} already relays to {self.routes[listen]['target']}")
+            return listen
+        
+        listener = relay_listener(listen)
+        bound = listener.getsockname()
+        route = {'target': target, 'listener': listener, 'sessions': set()}
+        self.routes[bound] = route
+        self.stats[bound] = {'connections': 0, 'active': 0, 'connect_failures': 0,
+                             'connect_seconds': 0.0, 'bytes_up': 0, 'bytes_down': 0}
+        route['task'] = asyncio.ensure_future(self._accept(route, self.stats[bound]))
+        return bound
+    
+    async def remove_route(self, listen: Tuple[str, int]):
+        """Stop listening on listen and close its open sessions"""
+        route = self.routes.pop(listen, None)
+        self.stats.pop(listen, None)
+        if route is None:
+            return
+        tasks = [route['task']] + list(route['sessions'])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        route['listener'].close()
+    
+    async def close(self):
+        """Remove every route"""
+        for listen in list(self.routes):
+            await self.remove_route(listen)
+    
+    async def _accept(self, route: Dict, stats: Dict):
+        loop = asyncio.get_running_loop()
+        while True:
+            client, _ = await loop.sock_accept(route['listener'])
+            session = asyncio.ensure_future(self._session(client, route['target'], stats))
+            route['sessions'].add(session)
+            session.add_done_callback(route['sessions'].discard)
+    
+    async def _session(self, client: socket.socket, target: Tuple[str, int], stats: Dict):
+        """Connect to the target and relay both directions until both are closed"""
+        loop = asyncio.get_running_loop()
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        pumps = []
+        try:
+            client.setblocking(False)
+            upstream.setblocking(False)
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(loop.sock_connect(upstream, target), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                stats['connect_failures'] += 1
+                logger.debug("Relay could not reach %s:%s: %r", target[0], target[1], e)
+                return
+            stats['connect_seconds'] += time.monotonic() - started
+            stats['connections'] += 1
+            stats['active'] += 1
+            
+            pumps = [asyncio.ensure_future(self._pump(client, upstream, stats, 'bytes_up')),
+                     asyncio.ensure_future(self._pump(upstream, client, stats, 'bytes_down'))]
+            await asyncio.wait(pumps, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for pump in pumps:
+                pump.cancel()
+            if pumps:
+                await asyncio.gather(*pumps, return_exceptions=True)
+                stats['active'] -= 1
+            client.close()
+            upstream.close()
+    
+    async def _pump(self, src: socket.socket, dst: socket.socket, stats: Dict, counter: str):
+        """Move bytes from src to dst until src closes, then half-close dst"""
+        if self.use_splice:
+            await self._splice(src, dst, stats, counter)
+        else:
+            await self._copy(src, dst, stats, counter)
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+    
+    async def _splice(self, src: socket.socket, dst: socket.socket, stats: Dict, counter: str):
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        read_end, write_end = os.pipe2(os.O_NONBLOCK)
+        try:
+            try:
+                fcntl.fcntl(write_end, F_SETPIPE_SZ, self.buffer_size)
+            except OSError:
+                pass  # Keep the default pipe size
+            
+            while True:
+                try:
+                    pending = os.splice(src.fileno(), write_end, self.buffer_size, flags=flags)
+                except BlockingIOError:
+                    await self._ready(src, writable=False)
+                    continue
+                if pending == 0:
+                    return
+                
+                while pending:
+                    try:
+                        sent = os.splice(read_end, dst.fileno(), pending, flags=flags)
+                    except BlockingIOError:
+                        await self._ready(dst, writable=True)
+                        continue
+                    pending -= sent
+                    stats[counter] += sent
+                
+                # Let other sessions run between chunks of a busy stream
+                await asyncio.sleep(0)
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+    
+    async def _copy(self, src: socket.socket, dst: socket.socket, stats: Dict, counter: str):
+        loop = asyncio.get_running_loop()
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        while True:
+            received = await loop.sock_recv_into(src, buffer)
+            if not received:
+                return
+            await loop.sock_sendall(dst, view[:received])
+            stats[counter] += received
+    
+    @staticmethod
+    async def _ready(sock: socket.socket, writable: bool):
+        """Wait until the socket is readable or writable"""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        add, remove = (loop.add_writer, loop.remove_writer) if writable else (loop.add_reader, loop.remove_reader)
+        add(sock.fileno(), lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(sock.fileno())
+
+async def read_rtsp_message(reader: asyncio.StreamReader, first: bytes = b"") -> Tuple[str, Dict[str, str], bytes]:
+    """Read one RTSP request or response, returns (start line, lowercased headers, body)"""
+    head = first + await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode('latin-1').split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length') or 0)
+    body = await reader.readexactly(length) if length else b""
+    return lines[0], headers, body
+
+def is_h264_keyframe(rtp: bytes) -> bool:
+    """Whether an RTP packet carries H.264 SPS, PPS or the start of an IDR picture"""
+    try:
+        offset = 12 + 4 * (rtp[0] & 0x0f)
+        if rtp[0] & 0x10:
+            offset += 4 + 4 * struct.unpack('!H', rtp[offset + 2:offset + 4])[0]
+        nal_type = rtp[offset] & 0x1f
+        if nal_type == 24:  # STAP-A, look at the first aggregated unit
+            nal_type = rtp[offset + 3] & 0x1f
+        elif nal_type == 28:  # FU-A, only the first fragment starts a picture
+            if not rtp[offset + 1] & 0x80:
+                return False
+            nal_type = rtp[offset + 1] & 0x1f
+        return nal_type in (5, 7, 8)
+    except (IndexError, struct.error):
+        return False
+
+class GopRingBuffer:
+    """
+    Preallocated ring of interleaved RTP frames since the latest keyframe
+    Frames are copied into one fixed bytearray, and the buffer is restarted
+    whenever a new group of pictures begins, so late joiners can decode at once
+    """
+    
+    def __init__(self, capacity: int = FANOUT_BUFFER_SIZE):
+        self.buffer = bytearray(capacity)
+        self.capacity = capacity
+        self.frames = deque()  # (offset, length), oldest first
+        self.head = 0  # Where the next frame is written
+        self.complete = False  # Whether the frames start at a keyframe
+        self.in_keyframe = False
+    
+    def append(self, frame: bytes, keyframe: Optional[bool] = None):
+        """
+        Store a frame; keyframe is None for frames of other tracks such as audio
+        A group starts at the first key packet following a non-key video packet
+        """
+        if keyframe is not None:
+            if keyframe and not self.in_keyframe:
+                self.frames.clear()
+                self.complete = True
+            self.in_keyframe = keyframe
+        if not self.complete:
+            return
+        
+        size = len(frame)
+        start = self.head
+        if start + size > self.capacity:
+            # Wrapping onto frames past the old head means the group outgrew the buffer
+            if size > self.capacity or (self.frames and self.frames[0][0] >= start):
+                return self._overflow()
+            start = 0
+        if self.frames:
+            oldest, length = self.frames[0]
+            if oldest < start + size and oldest + length > start:
+                return self._overflow()
+        
+        self.buffer[start:start + size] = frame
+        self.frames.append((start, size))
+        self.head = start + size
+    
+    def _overflow(self):
+        """Forget a group too large for the buffer, new viewers then wait for the next one"""
+        self.frames.clear()
+        self.complete = False
+    
+    def snapshot(self) -> bytes:
+        """All buffered frames, from the keyframe on"""
+        view = memoryview(self.buffer)
+        return b"".join(view[offset:offset + size] for offset, size in self.frames)
+
+class RtspAuthError(ConnectionError):
+    """Raised when a camera rejects the credentials of a fan-out session"""
+    
+    def __init__(self, challenge: Optional[str]):
+        super().__init__("camera answered 401 Unauthorized")
+        self.challenge = challenge  # WWW-Authenticate header of the camera
+
+class RtspFanout:
+    """
+    One upstream RTSP session to a camera, shared by any number of viewers
+    Interleaved frames from the camera go to every playing viewer and into a
+    GOP ring buffer, so new viewers start at the last keyframe. Viewers whose
+    socket backs up past client_limit are dropped without slowing the others
+    """
+    
+    def __init__(self, url: str, stats: Dict, buffer_size: int = FANOUT_BUFFER_SIZE,
+                 client_limit: int = FANOUT_CLIENT_BUFFER, socket_buffer: int = FANOUT_SOCKET_BUFFER,
+                 authorization: Optional[str] = None):
+        self.url = url
+        self.stats = stats
+        self.client_limit = client_limit
+        self.socket_buffer = socket_buffer
+        self.authorization = authorization
+        self.ring = GopRingBuffer(buffer_size)
+        self.viewers = set()  # Writers of playing viewers
+        self.users = 0  # Viewer connections using this stream
+        self.sdp = None
+        self.controls = []  # a=control of each media section
+        self.video_channel = None
+        self.task = None
+        self.ready = None
+        self.upstream = None
+        self.cseq = 0
+    
+    async def start(self) -> str:
+        """Open the upstream session unless it is already open, returns its SDP"""
+        if self.task is None:
+            self.ready = asyncio.get_running_loop().create_future()
+            self.task = asyncio.ensure_future(self._run())
+        return await asyncio.shield(self.ready)
+    
+    def subscribe(self, writer: asyncio.StreamWriter):
+        """Start sending frames to a viewer, beginning with the buffered group of pictures"""
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer)
+        backlog = self.ring.snapshot()
+        if backlog:
+            writer.write(backlog)
+        self.viewers.add(writer)
+        self.stats['viewers'] += 1
+    
+    def unsubscribe(self, writer: asyncio.StreamWriter):
+        if writer in self.viewers:
+            self.viewers.discard(writer)
+            self.stats['viewers'] -= 1
+    
+    async def close(self):
+        """Close the upstream session and disconnect the viewers"""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+    
+    def track(self, url: str) -> int:
+        """Index of the media section a SETUP URL refers to"""
+        segment = url.rstrip('/').rsplit('/', 1)[-1]
+        for index, control in enumerate(self.controls):
+            if control and control.rstrip('/').rsplit('/', 1)[-1] == segment:
+                return index
+        return 0
+    
+    async def _request(self, reader, method: str, url: str, headers: Dict) -> Tuple[int, Dict, bytes]:
+        """Send an upstream request and read its response"""
+        self.cseq += 1
+        lines = [f"{method} {url} RTSP/1.0", f"CSeq: {self.cseq}", "User-Agent: camera-portal"]
+        if self.authorization:
+            lines.append(f"Authorization: {self.authorization}")
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        self.upstream.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        status_line, response_headers, body = await read_rtsp_message(reader)
+        parts = status_line.split()
+        if len(parts) >= 2 and parts[1] == "401":
+            raise RtspAuthError(response_headers.get('www-authenticate'))
+        if len(parts) < 2 or not parts[0].startswith('RTSP/') or parts[1] != "200":
+            raise ConnectionError(f"{method} answered {status_line.strip()!r}")
+        return int(parts[1]), response_headers, body
+    
+    def _parse_sdp(self):
+        self.controls = []
+        for line in self.sdp.splitlines():
+            if line.startswith('m='):
+                if line.startswith('m=video') and self.video_channel is None:
+                    self.video_channel = 2 * len(self.controls)
+                self.controls.append(None)
+            elif line.startswith('a=control:') and self.controls:
+                self.controls[-1] = line[len('a=control:'):].strip()
+    
+    async def _run(self):
+        """Set up the upstream session, then relay its frames until it ends"""
+        parts = urlsplit(self.url)
+        try:
+            reader, self.upstream = await asyncio.wait_for(
+                asyncio.open_connection(parts.hostname, parts.port or RTSP_PORT), RELAY_CONNECT_TIMEOUT)
+            _, headers, body = await self._request(reader, 'DESCRIBE', self.url, {'Accept': "application/sdp"})
+            self.sdp = body.decode('latin-1')
+            self._parse_sdp()
+            
+            base = headers.get('content-base', self.url).rstrip('/')
+            session = None
+            for index, control in enumerate(self.controls):
+                if control and control.startswith('rtsp://'):
+                    track_url = control
+                elif control and control != '*':
+                    track_url = f"{base}/{control}"
+                else:
+                    track_url = base
+                setup = {'Transport': f"RTP/AVP/TCP;unicast;interleaved={2 * index}-{2 * index + 1}"}
+                if session:
+                    setup['Session'] = session
+                _, headers, _ = await self._request(reader, 'SETUP', track_url, setup)
+                session = headers.get('session', "").split(';')[0]
+            await self._request(reader, 'PLAY', self.url, {'Session': session, 'Range': "npt=0.000-"})
+            
+            self.stats['sessions'] += 1
+            self.ready.set_result(self.sdp)
+            await self._relay(reader, session)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Fan-out session to %s ended: %r", self.url, e)
+            if not self.ready.done():
+                self.ready.set_exception(e)
+        finally:
+            if self.upstream is not None:
+                self.upstream.close()
+                self.upstream = None
+            for writer in list(self.viewers):
+                writer.close()
+                self.unsubscribe(writer)
+            self.task = None
+    
+    async def _relay(self, reader: asyncio.StreamReader, session: str):
+        """Copy interleaved frames to the ring buffer and the viewers"""
+        keepalive = time.monotonic() + FANOUT_KEEPALIVE
+        while True:
+            first = await reader.readexactly(1)
+            if first != b"$":
+                await read_rtsp_message(reader, first)  # Answer to a keepalive
+                continue
+            header = first + await reader.readexactly(3)
+            frame = header + await reader.readexactly(struct.unpack('!H', header[2:])[0])
+            
+            keyframe = is_h264_keyframe(frame[4:]) if header[1] == self.video_channel else None
+            self.ring.append(frame, keyframe)
+            self.stats['frames'] += 1
+            self.stats['bytes'] += len(frame)
+            
+            for writer in list(self.viewers):
+                if writer.transport.get_write_buffer_size() > self.client_limit:
+                    logger.info("Dropping slow viewer of %s", self.url)
+                    self.stats['dropped'] += 1
+                    self.unsubscribe(writer)
+                    writer.close()
+                else:
+                    writer.write(frame)
+            
+            if time.monotonic() > keepalive:
+                self.cseq += 1
+                self.upstream.write(f"OPTIONS {self.url} RTSP/1.0\r\nCSeq: {self.cseq}\r\n"
+                                    f"Session: {session}\r\n\r\n".encode())
+                keepalive = time.monotonic() + FANOUT_KEEPALIVE
+
+class FanoutRelay:
+    """
+    Relay serving RTSP viewers from one shared upstream session per stream
+    Drop-in for TcpRelay; viewers must use RTP over the RTSP connection (TCP).
+    Sessions are shared only between viewers sending the same credentials, and
+    the camera's 401 challenge is passed on to viewers it rejects
+    """
+    
+    def __init__(self, buffer_size: int = FANOUT_BUFFER_SIZE, client_limit: int = FANOUT_CLIENT_BUFFER,
+                 socket_buffer: int = FANOUT_SOCKET_BUFFER):
+        self.buffer_size = buffer_size
+        self.client_limit = client_limit
+        self.socket_buffer = socket_buffer
+        self.routes = {}  # Listening (host, port) -> route
+        self.stats = {}  # Listening (host, port) -> counters
+    
+    async def add_route(self, listen: Tuple[str, int], target: Tuple[str, int]) -> Tuple[str, int]:
+        """
+        Serve viewers on listen from the camera at target, returns the bound address
+        Raises ValueError if listen already serves another camera
+        """
+        if listen in self.routes:
+            if self.routes[listen]['target'] != target:
+                raise ValueError(f"{listen[0]}:{listen[1]} already serves {self.routes[listen]['target']}")
+            return listen
+        
+        listener = relay_listener(listen)
+        bound = listener.getsockname()
+        route = {'target': target, 'fanouts': {}, 'viewers': set()}
+        self.routes[bound] = route
+        self.stats[bound] = {'viewers': 0, 'sessions': 0, 'frames': 0, 'bytes': 0, 'dropped': 0}
+        route['server'] = await asyncio.start_server(
+            lambda reader, writer: self._viewer(route, self.stats[bound], reader, writer), sock=listener)
+        return bound
+    
+    async def remove_route(self, listen: Tuple[str, int]):
+        """Stop listening, close the upstream sessions and disconnect the viewers"""
+        route = self.routes.pop(listen, None)
+        self.stats.pop(listen, None)
+        if route is None:
+            return
+        route['server'].close()
+        for fanout in list(route['fanouts'].values()):
+            await fanout.close()
+        for writer in list(route['viewers']):
+            writer.close()
+    
+    async def close(self):
+        """Remove every route"""
+        for listen in list(self.routes):
+            await self.remove_route(listen)
+    
+    async def _viewer(self, route: Dict, stats: Dict, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        """Answer one viewer's RTSP requests and subscribe it to the stream on PLAY"""
+        session = f"{random.getrandbits(32):08x}"
+        fanout = None
+        key = None  # (path, Authorization header) the fanout is shared under
+        route['viewers'].add(writer)
+        
+        async def release():
+            nonlocal fanout
+            fanout.unsubscribe(writer)
+            fanout.users -= 1
+            if fanout.users == 0:
+                # Last viewer gone, release the camera's session
+                if route['fanouts'].get(key) is fanout:
+                    del route['fanouts'][key]
+                await fanout.close()
+            fanout = None
+        
+        def reply(cseq, status="200 OK", headers=None, body=b""):
+            lines = [f"RTSP/1.0 {status}", f"CSeq: {cseq}"]
+            lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+            lines.append(f"Content-Length: {len(body)}")
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        
+        try:
+            while True:
+                first = await reader.readexactly(1)
+                if first == b"$":
+                    # RTCP from the viewer, not forwarded
+                    header = await reader.readexactly(3)
+                    await reader.readexactly(struct.unpack('!H', header[1:])[0])
+                    continue
+                
+                request_line, headers, _ = await read_rtsp_message(reader, first)
+                method, url = (request_line.split() + ["", ""])[:2]
+                cseq = headers.get('cseq', "0")
+                
+                if method == 'DESCRIBE':
+                    parts = urlsplit(url)
+                    path = parts.path + (f"?{parts.query}" if parts.query else "")
+                    if fanout is not None and key != (path, headers.get('authorization')):
+                        await release()
+                    if fanout is None:
+                        # Viewers with other credentials get their own session, so the
+                        # camera checks everyone's credentials
+                        key = (path, headers.get('authorization'))
+                        fanout = route['fanouts'].get(key)
+                        if fanout is None:
+                            host, port = route['target']
+                            fanout = route['fanouts'][key] = RtspFanout(
+                                f"rtsp://{host}:{port}{path}", stats, self.buffer_size,
+                                self.client_limit, self.socket_buffer, key[1])
+                        fanout.users += 1
+                    try:
+                        sdp = (await fanout.start()).encode('latin-1')
+                    except RtspAuthError as e:
+                        await release()
+                        reply(cseq, "401 Unauthorized",
+                              headers={'WWW-Authenticate': e.challenge} if e.challenge else None)
+                        continue
+                    except Exception:
+                        reply(cseq, "503 Service Unavailable")
+                        continue
+                    reply(cseq, headers={'Content-Type': "application/sdp",
+                                         'Content-Base': url.rstrip('/') + "/"}, body=sdp)
+                elif method == 'SETUP':
+                    if fanout is None or "TCP" not in headers.get('transport', "").upper():
+                        reply(cseq, "461 Unsupported Transport")
+                        continue
+                    track = fanout.track(url)
+                    reply(cseq, headers={'Transport': f"RTP/AVP/TCP;unicast;interleaved={2 * track}-{2 * track + 1}",
+                                         'Session': session})
+                elif method == 'PLAY' and fanout is not None and fanout.task is not None:
+                    reply(cseq, headers={'Session': session, 'Range': "npt=0.000-"})
+                    fanout.subscribe(writer)
+                elif method == 'TEARDOWN':
+                    reply(cseq, headers={'Session': session})
+                    break
+                elif method == 'OPTIONS':
+                    reply(cseq, headers={'Public': "OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER"})
+                elif method in ('GET_PARAMETER', 'SET_PARAMETER'):
+                    reply(cseq, headers={'Session': session})
+                else:
+                    reply(cseq, "455 Method Not Valid In This State")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            route['viewers'].discard(writer)
+            writer.close()
+            if fanout is not None:
+                await release()
+
+class RelayForwarder:
+    """
+    Forwarding backend relaying camera connections in userspace instead of DNAT
+    Needs no firewall access or ip_forward. The relay runs on its own event loop
+    thread; with bind set, all cameras share that address on a port each.
+    A virtual IP keeps its port while ports remain, so endpoints stay put
+    """
+    
+    def __init__(self, bind: Optional[str] = None, base_port: int = RELAY_BASE_PORT,
+                 relay=None, fanout: bool = False):
+        self.bind = bind
+        self.base_port = base_port
+        self.relay = relay or (FanoutRelay() if fanout else TcpRelay())
+        self.routes = {}  # Virtual IP -> (listen address, camera_ip, port)
+        self.ports = {}  # Virtual IP -> relay port, with bind set
+        self.used_ports = set()
+        self.next_port = base_port
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def from_settings(cls, settings: Dict) -> 'RelayForwarder':
+        """Create the relay from the relay_bind, relay_base_port and relay_fanout settings"""
+        return cls(bind=settings.get('relay_bind'),
+                   base_port=settings.get('relay_base_port', RELAY_BASE_PORT),
+                   fanout=settings.get('relay_fanout', RELAY_FANOUT))
+    
+    def endpoint(self, virtual_ip: str, rtsp_port: int = RTSP_PORT) -> Tuple[str, int]:
+        """Address clients connect to for the camera behind virtual_ip"""
+        if self.bind is None:
+            return (virtual_ip, rtsp_port)
+        return (self.bind, self.port(virtual_ip))
+    
+    def port(self, virtual_ip: str) -> int:
+        """
+        Relay port of virtual_ip, assigning the next free one on first use
+        Once the range is used up, ports of virtual IPs without a relay are reused
+        """
+        with self.lock:
+            port = self.ports.get(virtual_ip)
+            if port is not None:
+                return port
+            while self.next_port in self.used_ports:
+                self.next_port += 1
+            if self.next_port < self.base_port + RELAY_PORT_SPAN:
+                port = self.next_port
+                self.used_ports.add(port)
+            else:
+                idle = next((ip for ip in self.ports if ip not in self.routes), None)
+                if idle is None:
+                    raise RuntimeError(f"All {RELAY_PORT_SPAN} relay ports are in use")
+                port = self.ports.pop(idle)
+            self.ports[virtual_ip] = port
+            return port
+    
+    def reserve(self, ports: Dict[str, int]):
+        """Give virtual IPs back the relay ports they had before a restart"""
+        with self.lock:
+            for virtual_ip, port in ports.items():
+                if port not in self.used_ports:
+                    self.ports[virtual_ip] = port
+                    self.used_ports.add(port)
+    
+    def _run(self, coro, timeout: float = 10):
+        """Run a coroutine on the relay loop, starting the loop on first use"""
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name="relay", daemon=True)
+                self.thread.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+    
+    def apply_forwarding(self, mappings: List[Tuple[str, str, int]]) -> Dict[str, bool]:
+        """Start relays for the mappings, returns success per virtual IP"""
+        results = {}
+        for virtual_ip, camera_ip, port in mappings:
+            try:
+                listen = self._run(self.relay.add_route(self.endpoint(virtual_ip, port), (camera_ip, port)))
+                self.routes[virtual_ip] = (listen, camera_ip, port)
+                results[virtual_ip] = True
+            except Exception as e:
+                logger.error("Error starting relay for %s: %s", virtual_ip, e)
+                results[virtual_ip] = False
+        return results
+    
+    def remove_forwarding(self, mappings: List[Tuple[str, str, int]]) -> Dict[str, bool]:
+        """Stop the relays for the mappings and close their sessions"""
+        results = {}
+        for virtual_ip, _, _ in mappings:
+            route = self.routes.pop(virtual_ip, None)
+            try:
+                if route is not None:
+                    self._run(self.relay.remove_route(route[0]))
+                results[virtual_ip] = True
+            except Exception as e:
+                logger.error("Error stopping relay for %s: %s", virtual_ip, e)
+                results[virtual_ip] = False
+        return results
+    
+    def reconcile(self, mappings: List[Tuple[str, str, int]], dry_run: bool = False) -> Dict:
+        """Start missing relays and stop ones without a mapping"""
+        desired = set(mappings)
+        current = {(virtual_ip, camera_ip, port) for virtual_ip, (_, camera_ip, port) in self.routes.items()}
+        report = {
+            'missing': sorted(desired - current),
+            'duplicates': [],
+            'orphaned': sorted(current - desired),
+            'applied': True
+        }
+        if not dry_run:
+            removed = self.remove_forwarding(report['orphaned'])
+            added = self.apply_forwarding(report['missing'])
+            report['applied'] = all(removed.values()) and all(added.values())
+        
+        logger.info("Relay reconcile: %s missing, %s orphaned relays",
+                    len(report['missing']), len(report['orphaned']))
+        return report
+    
+    def stats(self) -> Dict[str, Dict]:
+        """Byte, session and connect latency counters per virtual IP"""
+        return {virtual_ip: dict(self.relay.stats.get(listen, {}))
+                for virtual_ip, (listen, _, _) in self.routes.items()}
+    
+    def close(self):
+        """Stop all relays and the relay loop"""
+        if self.loop is None:
+            return
+        try:
+            self._run(self.relay.close())
+        except Exception as e:
+            logger.error("Error stopping relays: %s", e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop = None
+
+class AddressPool:
+    """
+    Range of virtual addresses with O(1) allocate and release
+    Addresses below the high-water mark are tracked in a bitmap and released
+    ones are reused from a free list before the range grows
+    """
+    
+    def __init__(self, spec: str, slot_base: int = 0):
+        if '-' in spec:
+            first, last = (ipaddress.IPv4Address(a.strip()) for a in spec.split('-'))
+            prefixlen = VIRTUAL_PREFIXLEN
+        else:
+            network = ipaddress.IPv4Network(spec, strict=False)
+            first, last = network.network_address, network.broadcast_address
+            if network.num_addresses > 2:
+                first, last = first + 1, last - 1  # Skip network and broadcast
+            prefixlen = network.prefixlen
+        
+        self.spec = spec
+        self.first = int(first)
+        self.size = int(last) - int(first) + 1
+        self.prefixlen = prefixlen
+        self.slot_base = slot_base  # Label number of the first address
+        self.used = bytearray(self.size)
+        self.free = deque()  # Released offsets below next_offset
+        self.next_offset = 0
+        self.in_use = 0
+    
+    def __contains__(self, address: int) -> bool:
+        return 0 <= address - self.first < self.size
+    
+    def allocate(self) -> Optional[int]:
+        """Take a free address, None if the pool is exhausted"""
+        while self.free:
+            offset = self.free.popleft()
+            if not self.used[offset]:
+                return self._take(offset)
+        if self.next_offset < self.size:
+            self.next_offset += 1
+            return self._take(self.next_offset - 1)
+        return None
+    
+    def release(self, address: int):
+        """Return an address to the pool"""
+        offset = address - self.first
+        if self.used[offset]:
+            self.used[offset] = 0
+            self.in_use -= 1
+            self.free.append(offset)
+    
+    def reserve(self, address: int):
+        """Mark an address that is already in use, when rebuilding state"""
+        offset = address - self.first
+        if offset >= self.next_offset:
+            self.free.extend(range(self.next_offset, offset))
+            self.next_offset = offset + 1
+        if not self.used[offset]:
+            self.used[offset] = 1
+            self.in_use += 1
+    
+    def _take(self, offset: int) -> int:
+        self.used[offset] = 1
+        self.in_use += 1
+        return self.first + offset
+
+class VirtualIpAllocator:
+    """Hands out virtual IPs from per-interface address pools, reusing released ones"""
+    
+    def __init__(self, pools: Optional[Dict[str, List[str]]] = None):
+        self.default_specs = [f"{VIRTUAL_IP_BASE}-{self._default_last()}"]
+        self.pools = {}  # Interface -> list of AddressPool
+        for interface, specs in (pools or {}).items():
+            self._create_pools(interface, specs)
+    
+    @classmethod
+    def from_settings(cls, settings: Dict) -> 'VirtualIpAllocator':
+        """Build pools from the virtual_ip_pools setting, e.g. {"eth0": ["10.20.0.0/20"]}"""
+        return cls(settings.get('virtual_ip_pools'))
+    
+    @staticmethod
+    def _default_last() -> str:
+        """Last usable address of the subnet VIRTUAL_IP_BASE belongs to"""
+        network = ipaddress.IPv4Network(f"{VIRTUAL_IP_BASE}/{VIRTUAL_PREFIXLEN}", strict=False)
+        return str(network.broadcast_address - 1)
+    
+    def _create_pools(self, interface: str, specs: List[str]) -> List[AddressPool]:
+        pools = []
+        slot_base = 0
+        for spec in specs:
+            pool = AddressPool(spec, slot_base)
+            slot_base += pool.size
+            pools.append(pool)
+        self.pools[interface] = pools
+        return pools
+    
+    def _pools_for(self, interface: str) -> List[AddressPool]:
+        return self.pools.get(interface) or self._create_pools(interface, self.default_specs)
+    
+    def allocate(self, interface: str) -> Optional[Tuple[str, int, str]]:
+        """
+        Take a free address on interface
+        Returns (virtual_ip, prefixlen, label) or None if every pool is exhausted
+        """
+        for pool in self._pools_for(interface):
+            address = pool.allocate()
+            if address is not None:
+                slot = pool.slot_base + address - pool.first
+                label = f"{interface}:{VIRTUAL_INTERFACE_PREFIX}{slot}"
+                return str(ipaddress.IPv4Address(address)), pool.prefixlen, label
+        return None
+    
+    def release(self, interface: str, virtual_ip: str):
+        """Return an address so it can be handed out again"""
+        address = int(ipaddress.IPv4Address(virtual_ip))
+        for pool in self._pools_for(interface):
+            if address in pool:
+                pool.release(address)
+                return
+    
+    def rebuild(self, virtual_ips: Dict):
+        """Mark the addresses recorded in virtual_ips as taken"""
+        for config in virtual_ips.values():
+            interface = config.get('base_interface', 'eth0')
+            address = int(ipaddress.IPv4Address(config['virtual_ip']))
+            for pool in self._pools_for(interface):
+                if address in pool:
+                    pool.reserve(address)
+                    break
+            else:
+                logger.warning("Virtual IP %s is outside the pools of %s", config['virtual_ip'], interface)
+
+class IpBatchAddresses:
+    """
+    Manages interface addresses through one long-lived `ip -force -batch -` process
+    Each change set is written to its stdin followed by a marker command, whose
+    error on stderr shows the set is done. If the process exits or hangs it is
+    restarted, and that change set runs in a one-off process instead
+    """
+    
+    def __init__(self, command: Optional[List[str]] = None, timeout: float = IP_BATCH_TIMEOUT):
+        self.command = command or ["sudo", "ip", "-force", "-batch", "-"]
+        self.timeout = timeout
+        self.process = None
+        self.errors = None  # Queue of stderr lines of the running process, None at its end
+        self.lines = 0  # Commands written to the running process
+        self.markers = 0
+        self.lock = threading.Lock()
+    
+    def add_addresses(self, entries: List[Tuple[str, int, str, str]]) -> Dict[str, bool]:
+        """Add (ip, prefixlen, device, label) entries, returns success per IP"""
+        commands = [f"address add {ip}/{prefixlen} dev {device} label {label}"
+                    for ip, prefixlen, device, label in entries]
+        commands += [f"link set dev {device} up" for device in sorted({e[2] for e in entries})]
+        return self._apply(entries, commands, expect_present=True)
+    
+    def remove_addresses(self, entries: List[Tuple[str, int, str, str]]) -> Dict[str, bool]:
+        """Remove (ip, prefixlen, device, label) entries, returns success per IP"""
+        commands = [f"address del {ip}/{prefixlen} dev {device}"
+                    for ip, prefixlen, device, _ in entries]
+        return self._apply(entries, commands, expect_present=False)
+    
+    def list_addresses(self, device: str) -> Dict[str, str]:
+        """Read every IPv4 address on device in one call, returns ip -> label"""
+        result = run_command(["ip", "-o", "-4", "address", "show", "dev", device])
+        if result.returncode != 0:
+            raise RuntimeError(f"Failed to list addresses on {device}: {result.stderr.strip()}")
+        
+        addresses = {}
+        for line in result.stdout.splitlines():
+            fields = line.split('\\')[0].split()
+            if 'inet' in fields:
+                ip = fields[fields.index('inet') + 1].split('/')[0]
+                addresses[ip] = fields[-1]
+        return addresses
+    
+    def _apply(self, entries: List[Tuple[str, int, str, str]], commands: List[str],
+               expect_present: bool) -> Dict[str, bool]:
+        """
+        Run the commands in one batch; -force keeps going past failed lines
+        Failed entries are checked against the live address list, so adding an
+        address that exists or removing one that is gone still counts as success
+        """
+        if not entries:
+            return {}
+        failed_lines, stderr = self._run_batch(commands)
+        
+        results = {}
+        for line, (ip, _, _, _) in enumerate(entries, start=1):
+            results[ip] = line not in failed_lines
+        
+        failed = [e for e in entries if not results[e[0]]]
+        if failed:
+            logger.debug("ip -batch errors: %s", stderr.strip())
+            listed = {}
+            for ip, _, device, _ in failed:
+                if device not in listed:
+                    listed[device] = self.list_addresses(device)
+                results[ip] = (ip in listed[device]) == expect_present
+        return results
+    
+    def _run_batch(self, commands: List[str]) -> Tuple[set, str]:
+        """Run commands, returns the numbers (from 1) of the ones that failed and the error output"""
+        with self.lock:
+            try:
+                return self._send(commands)
+            except (OSError, RuntimeError) as e:
+                logger.warning("ip -batch process failed (%s), restarting it", e)
+                self._stop()
+        
+        result = run_command(self.command, input="\n".join(commands) + "\n")
+        failed_lines = {int(n) for n in re.findall(r'Command failed -:(\d+)', result.stderr)}
+        if result.returncode != 0 and not failed_lines:
+            failed_lines = set(range(1, len(commands) + 1))
+        return failed_lines, result.stderr
+    
+    def _send(self, commands: List[str]) -> Tuple[set, str]:
+        """Write commands to the long-lived process and wait for its marker"""
+        if self.process is None or self.process.poll() is not None:
+            self._start()
+        self.markers += 1
+        marker = f"cpsync{self.markers}"  # Never an existing device, so its lookup fails
+        first = self.lines + 1
+        self.lines += len(commands) + 1
+        
+        started = time.monotonic()
+        with TRACER.span('exec', command='ip', commands=len(commands)):
+            self.process.stdin.write("\n".join(commands + [f"address show dev {marker}"]) + "\n")
+            self.process.stdin.flush()
+            failed_lines, errors = set(), []
+            deadline = started + self.timeout
+            while True:
+                try:
+                    line = self.errors.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    raise RuntimeError(f"no answer within {self.timeout}s")
+                if line is None:
+                    raise RuntimeError(f"exited with status {self.process.wait()}")
+                match = re.match(r'Command failed -:(\d+)', line)
+                if match and int(match.group(1)) == self.lines:
+                    break
+                if match:
+                    failed_lines.add(int(match.group(1)) - first + 1)
+                elif marker not in line:
+                    errors.append(line)
+        SUBPROCESS_SECONDS.observe(time.monotonic() - started, command='ip')
+        if failed_lines:
+            SUBPROCESS_FAILURES.inc(command='ip')
+        return failed_lines, "".join(errors)
+    
+    def _start(self):
+        self._stop()
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE, text=True, bufsize=1)
+        self.errors = queue.Queue()
+        self.lines = 0
+        
+        def read_errors(stream, errors):
+            for line in stream:
+                errors.put(line)
+            errors.put(None)
+        
+        threading.Thread(target=read_errors, args=(self.process.stderr, self.errors),
+                         name="ip-batch", daemon=True).start()
+    
+    def _stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+    
+    def close(self):
+        """End the long-lived ip process"""
+        with self.lock:
+            self._stop()
+
+class FakeAddresses:
+    """In-memory address backend for benchmarks and unprivileged tests"""
+    
+    def __init__(self, fail: Iterable[str] = ()):
+        self.devices = {}  # Device -> {ip: (prefixlen, label)}
+        self.fail = set(fail)  # Addresses whose changes fail
+        self.round_trips = 0
+    
+    def add_addresses(self, entries: List[Tuple[str, int, str, str]]) -> Dict[str, bool]:
+        """Add (ip, prefixlen, device, label) entries, returns success per IP"""
+        self.round_trips += 1
+        results = {}
+        for ip, prefixlen, device, label in entries:
+            results[ip] = ip not in self.fail
+            if results[ip]:
+                self.devices.setdefault(device, {})[ip] = (prefixlen, label)
+        return results
+    
+    def remove_addresses(self, entries: List[Tuple[str, int, str, str]]) -> Dict[str, bool]:
+        """Remove (ip, prefixlen, device, label) entries, returns success per IP"""
+        self.round_trips += 1
+        results = {}
+        for ip, _, device, _ in entries:
+            results[ip] = ip not in self.fail
+            if results[ip]:
+                self.devices.get(device, {}).pop(ip, None)
+        return results
+    
+    def list_addresses(self, device: str) -> Dict[str, str]:
+        """Addresses on device, ip -> label"""
+        self.round_trips += 1
+        return {ip: label for ip, (_, label) in self.devices.get(device, {}).items()}
+
+class NullAddresses:
+    """
+    Address backend for relays sharing one bind address
+    Virtual IPs there only name relays, so nothing is ever configured
+    """
+    
+    def add_addresses(self, entries: List[Tuple[str, int, str, str]]) -> Dict[str, bool]:
+        """Accept (ip, prefixlen, device, label) entries without configuring them"""
+        return {ip: True for ip, _, _, _ in entries}
+    
+    def remove_addresses(self, entries: List[Tuple[str, int, str, str]]) -> Dict[str, bool]:
+        """Accept (ip, prefixlen, device, label) entries without touching the interface"""
+        return {ip: True for ip, _, _, _ in entries}
+    
+    def list_addresses(self, device: str) -> Dict[str, str]:
+        """No address is ever configured"""
+        return {}
+
+class JsonStateStore:
+    """
+    Keeps a dict of entries (by default the virtual IPs) under one key of a JSON file
+    Changes are coalesced and written atomically once per flush interval
+    """
+    
+    def __init__(self, path: str, flush_interval: float = STATE_FLUSH_INTERVAL,
+                 key: str = 'virtual_ips'):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.key = key
+        self.state = {}  # Entries shared with the owner, e.g. camera id -> virtual IP config
+        self.extra = {}  # Other keys of the config file, preserved on write
+        self.lock = threading.RLock()
+        self.timer = None
+        self.dirty = False
+        self.writes = 0
+    
+    def load(self) -> Dict:
+        """Load the state, returns the dict that callers should mutate"""
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                config = json.load(f)
+            self.state.update(config.pop(self.key, {}))
+            config.pop('last_updated', None)
+            self.extra = config
+        return self.state
+    
+    def record(self, keys: Optional[Iterable[str]] = None):
+        """Note that keys (default: everything) changed, scheduling a flush"""
+        with self.lock:
+            self._record(keys)
+            if self.flush_interval <= 0:
+                self.flush()
+            elif self.timer is None:
+                self._schedule()
+    
+    def _schedule(self):
+        self.timer = threading.Timer(self.flush_interval, self._flush_later)
+        self.timer.daemon = True
+        self.timer.start()
+    
+    def _flush_later(self):
+        """Timer callback, a failed write is logged and retried after another interval"""
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Error writing state to %s, retrying in %ss", self.path, self.flush_interval)
+            with self.lock:
+                if self.timer is None:
+                    self._schedule()
+    
+    def _record(self, keys: Optional[Iterable[str]]):
+        self.dirty = True
+    
+    def flush(self):
+        """Write pending changes now"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.dirty:
+                self._write_snapshot()
+                self.dirty = False
+    
+    def close(self):
+        """Flush pending changes and stop the timer"""
+        self.flush()
+    
+    def _copy(self, value):
+        """Copy an entry so it can be serialised while its owner keeps mutating it"""
+        return dict(value) if isinstance(value, dict) else value
+    
+    def _write_snapshot(self):
+        config = dict(self.extra)
+        config[self.key] = {k: self._copy(v) for k, v in list(self.state.items())}
+        config['last_updated'] = datetime.now().isoformat()
+        atomic_write_json(self.path, config, indent=2)
+        self.writes += 1
+
+class JournalStateStore(JsonStateStore):
+    """
+    Appends changed entries to a journal next to the config file
+    The config file is rewritten only when the journal is compacted, so a flush
+    costs one small append however large the fleet is
+    """
+    
+    def __init__(self, path: str, flush_interval: float = STATE_FLUSH_INTERVAL,
+                 key: str = 'virtual_ips', compact_after: int = STATE_JOURNAL_COMPACT_AFTER):
+        super().__init__(path, flush_interval, key)
+        self.journal_path = f"{path}.journal"
+        self.compact_after = compact_after
+        self.pending = set()
+        self.full = False
+        self.journal_entries = 0
+    
+    def load(self) -> Dict:
+        """Load the snapshot and replay the journal on top of it"""
+        super().load()
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        break  # Torn final line from a crash
+                    if op['value'] is None:
+                        self.state.pop(op['key'], None)
+                    else:
+                        self.state[op['key']] = op['value']
+                    self.journal_entries += 1
+        return self.state
+    
+    def _record(self, keys: Optional[Iterable[str]]):
+        if keys is None:
+            self.full = True
+        else:
+            self.pending.update(keys)
+    
+    def flush(self):
+        """Append pending changes to the journal, compacting it when it grows too long"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not (self.pending or self.full):
+                return
+            
+            if self.full or self.journal_entries + len(self.pending) > self.compact_after:
+                self._write_snapshot()
+                if os.path.exists(self.journal_path):
+                    os.remove(self.journal_path)
+                self.journal_entries = 0
+            else:
+                lines = [json.dumps({'key': key, 'value': self._copy(self.state.get(key))}) + "\n"
+                         for key in sorted(self.pending)]
+                with open(self.journal_path, 'a') as f:
+                    f.writelines(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.journal_entries += len(lines)
+                self.writes += 1
+            
+            self.pending.clear()
+            self.full = False
+
+STATE_BACKENDS = {
+    'json': JsonStateStore,
+    'journal': JournalStateStore
+}
+
+def create_state_store(settings: Dict) -> JsonStateStore:
+    """Create the state store selected by the state_backend setting"""
+    name = settings.get('state_backend', STATE_BACKEND)
+    if name not in STATE_BACKENDS:
+        logger.error("Unknown state backend '%s', using %s", name, STATE_BACKEND)
+        name = STATE_BACKEND
+    return STATE_BACKENDS[name](
+        CONFIG_FILE, settings.get('state_flush_interval', STATE_FLUSH_INTERVAL)
+    )
 
 class NetworkManager:
     """Manages virtual IP addresses and network configuration"""
     
-    def __init__(self):
+    def __init__(self, settings: Optional[Dict] = None, addresses=None):
         self.virtual_ips = {}
+        settings = load_settings() if settings is None else settings
+        if settings.get('forwarding_mode', FORWARDING_MODE) == 'relay':
+            self.firewall = RelayForwarder.from_settings(settings)
+            if self.firewall.bind and addresses is None:
+                # Cameras share one listening address, virtual IPs only name their relays
+                addresses = NullAddresses()
+        else:
+            self.firewall = create_firewall(settings.get('firewall_backend', FIREWALL_BACKEND))
+        self.addresses = addresses or IpBatchAddresses()
+        self.allocator = VirtualIpAllocator.from_settings(settings)
+        self.store = create_state_store(settings)
         self.load_config()
+        self.allocator.rebuild(self.virtual_ips)
+        if isinstance(self.firewall, RelayForwarder):
+            self.firewall.reserve({c['virtual_ip']: c['relay_port']
+                                   for c in self.virtual_ips.values() if 'relay_port' in c})
     
     def load_config(self):
         """Load configuration from file"""
         try:
-            if os.path.exists(CONFIG_FILE):
-                with open(CONFIG_FILE, 'r') as f:
-                    config = json.load(f)
-                    self.virtual_ips = config.get('virtual_ips', {})
+            self.virtual_ips = self.store.load()
         except Exception as e:
-            logger.error(f"Error loading config: {e}")
+            logger.error("Error loading config: %s", e)
+            self.virtual_ips = self.store.state
     
-    def save_config(self):
-        """Save configuration to file"""
+    def save_config(self, camera_ids: Optional[Iterable[str]] = None):
+        """Schedule saving the given cameras (default: all) to the state store"""
         try:
-            os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
-            config = {
-                'virtual_ips': self.virtual_ips,
-                'last_updated': datetime.now().isoformat()
-            }
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(config, f, indent=2)
+            self.store.record(camera_ids)
+        except Exception as e:
+            logger.error("Error saving config: %s", e)
+    
+    def close(self):
+        """Write any pending state, stop userspace relays and the ip -batch process"""
+        if isinstance(self.firewall, RelayForwarder):
+            self.firewall.close()
+        if isinstance(self.addresses, IpBatchAddresses):
+            self.addresses.close()
+        try:
+            self.store.close()
         except Exception as e:
-            logger.error(f"Error saving config: {e}")
+            logger.error("Error saving config: %s", e)
     
+    @traced
     def create_virtual_ip(self, camera_id: str, base_interface: str = "eth0") -> Optional[str]:
         """
         Create a virtual IP address for a camera
         Returns the created IP address or None if failed
         """
+        return self.create_virtual_ips([camera_id], base_interface)[camera_id]
+    
+    @traced
+    def create_virtual_ips(self, camera_ids: List[str],
+                           base_interface: str = "eth0") -> Dict[str, Optional[str]]:
+        """
+        Create virtual IP addresses for many cameras in one round trip
+        Returns the created IP address per camera, None for failures
+        """
+        results = {}
+        pending = {}
         try:
-            # Generate next available IP
-            ip_parts = list(map(int, VIRTUAL_IP_BASE.split('.')))
-            existing_count = len(self.virtual_ips)
-            ip_parts[3] += existing_count  # Increment last octet
-            
-            virtual_ip = ".".join(map(str, ip_parts))
-            interface_name = f"{VIRTUAL_INTERFACE_PREFIX}{existing_count}"
-            
-            # Create virtual interface
-            cmd_add_ip = f"sudo ip addr add {virtual_ip}/{VIRTUAL_NETMASK} dev {base_interface} label {interface_name}"
-            cmd_up = f"sudo ip link set {interface_name} up"
-            
-            # Execute commands
-            for cmd in [cmd_add_ip, cmd_up]:
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-                if result.returncode != 0:
-                    logger.error(f"Failed to execute: {cmd}\nError: {result.stderr}")
-                    return None
+            # Take the next free addresses from the interface's pools
+            for camera_id in camera_ids:
+                allocation = self.allocator.allocate(base_interface)
+                if allocation is None:
+                    logger.error("No free virtual IP left on %s for camera %s", base_interface, camera_id)
+                    results[camera_id] = None
+                else:
+                    pending[camera_id] = allocation
             
-            # Store configuration
-            self.virtual_ips[camera_id] = {
-                'virtual_ip': virtual_ip,
-                'interface': interface_name,
-                'base_interface': base_interface,
-                'created_at': datetime.now().isoformat(),
-                'camera_id': camera_id
-            }
+            added = self.addresses.add_addresses([
+                (virtual_ip, prefixlen, base_interface, label)
+                for virtual_ip, prefixlen, label in pending.values()
+            ])
             
-            self.save_config()
-            logger.info(f"Created virtual IP {virtual_ip} for camera {camera_id}")
+            for camera_id, (virtual_ip, prefixlen, interface_name) in pending.items():
+                if not added.get(virtual_ip):
+                    logger.error("Failed to add virtual IP %s for camera %s", virtual_ip, camera_id)
+                    self.allocator.release(base_interface, virtual_ip)
+                    results[camera_id] = None
+                    continue
+                
+                # Store configuration
+                self.virtual_ips[camera_id] = {
+                    'virtual_ip': virtual_ip,
+                    'prefixlen': prefixlen,
+                    'interface': interface_name,
+                    'base_interface': base_interface,
+                    'created_at': datetime.now().isoformat(),
+                    'camera_id': camera_id
+                }
+                results[camera_id] = virtual_ip
+                logger.info("Created virtual IP %s for camera %s", virtual_ip, camera_id)
             
-            return virtual_ip
+            self.save_config(pending)
+            return results
             
         except Exception as e:
-            logger.error(f"Error creating virtual IP: {e}")
-            return None
+            logger.error("Error creating virtual IPs: %s", e)
+            for camera_id, (virtual_ip, _, _) in pending.items():
+                if camera_id not in self.virtual_ips:
+                    self.allocator.release(base_interface, virtual_ip)
+            return {camera_id: self.virtual_ips.get(camera_id, {}).get('virtual_ip')
+                    for camera_id in camera_ids}
     
+    @traced
     def remove_virtual_ip(self, camera_id: str):
         """Remove virtual IP address"""
+        self.remove_virtual_ips([camera_id])
+    
+    @traced
+    def remove_virtual_ips(self, camera_ids: List[str]) -> Dict[str, bool]:
+        """Remove the virtual IP addresses of many cameras in one round trip"""
         try:
-            if camera_id in self.virtual_ips:
-                config = self.virtual_ips[camera_id]
+            configs = {c: self.virtual_ips[c] for c in camera_ids if c in self.virtual_ips}
+            removed = self.addresses.remove_addresses([
+                (config['virtual_ip'], config.get('prefixlen', VIRTUAL_PREFIXLEN),
+                 config['base_interface'], config['interface'])
+                for config in configs.values()
+            ])
+            
+            results = {}
+            for camera_id, config in configs.items():
                 virtual_ip = config['virtual_ip']
-                interface = config['interface']
-                
-                # Remove IP address
-                cmd = f"sudo ip addr del {virtual_ip}/32 dev {config['base_interface']} label {interface}"
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-                
-                if result.returncode == 0:
+                results[camera_id] = bool(removed.get(virtual_ip))
+                if results[camera_id]:
                     del self.virtual_ips[camera_id]
-                    self.save_config()
-                    logger.info(f"Removed virtual IP {virtual_ip} for camera {camera_id}")
+                    self.allocator.release(config['base_interface'], virtual_ip)
+                    logger.info("Removed virtual IP %s for camera %s", virtual_ip, camera_id)
                 else:
-                    logger.error(f"Failed to remove IP: {result.stderr}")
+                    logger.error("Failed to remove virtual IP %s for camera %s", virtual_ip, camera_id)
+            
+            self.save_config(configs)
+            return results
                     
         except Exception as e:
-            logger.error(f"Error removing virtual IP: {e}")
+            logger.error("Error removing virtual IPs: %s", e)
+            return {camera_id: False for camera_id in camera_ids}
+    
+    @traced
+    def restore_virtual_ips(self, camera_ids: List[str]) -> Dict[str, bool]:
+        """Add the recorded virtual IPs of cameras back to their interfaces in one round trip"""
+        try:
+            configs = {c: self.virtual_ips[c] for c in camera_ids if c in self.virtual_ips}
+            added = self.addresses.add_addresses([
+                (config['virtual_ip'], config.get('prefixlen', VIRTUAL_PREFIXLEN),
+                 config['base_interface'], config['interface'])
+                for config in configs.values()
+            ])
+            return {camera_id: bool(added.get(config['virtual_ip']))
+                    for camera_id, config in configs.items()}
+        except Exception as e:
+            logger.error("Error restoring virtual IPs: %s", e)
+            return {camera_id: False for camera_id in camera_ids}
     
+    @traced
+    def missing_virtual_ips(self) -> List[str]:
+        """Cameras whose virtual IP is no longer configured on its interface"""
+        if isinstance(self.addresses, NullAddresses):
+            return []  # Shared-address relays never configure their virtual IPs
+        present = {}
+        missing = []
+        for camera_id, config in self.virtual_ips.items():
+            interface = config['base_interface']
+            if interface not in present:
+                present[interface] = self.addresses.list_addresses(interface)
+            if config['virtual_ip'] not in present[interface]:
+                missing.append(camera_id)
+        return missing
+    
+    @traced
     def setup_port_forwarding(self, virtual_ip: str, camera_ip: str, 
                             rtsp_port: int = RTSP_PORT) -> bool:
         """
         Setup port forwarding from virtual IP to camera IP
         Returns True if successful
         """
+        return self.setup_port_forwarding_bulk([(virtual_ip, camera_ip, rtsp_port)])[virtual_ip]
+    
+    @traced
+    def setup_port_forwarding_bulk(self, mappings: List[Tuple[str, str, int]]) -> Dict[str, bool]:
+        """
+        Setup port forwarding for many cameras in one firewall transaction
+        Takes (virtual_ip, camera_ip, rtsp_port) tuples, returns success per virtual IP.
+        Cameras that moved to a new IP lose their old forwarding first
+        """
+        by_virtual_ip = {c['virtual_ip']: c for c in self.virtual_ips.values()}
+        moved = {}
+        for virtual_ip, camera_ip, rtsp_port in mappings:
+            config = by_virtual_ip.get(virtual_ip)
+            if config and config.get('camera_ip'):
+                old = (virtual_ip, config['camera_ip'], config.get('rtsp_port', RTSP_PORT))
+                if old != (virtual_ip, camera_ip, rtsp_port):
+                    moved[virtual_ip] = old
+        
         try:
-            # Setup iptables rules for port forwarding
-            rules = [
-                # Forward RTSP traffic
-                f"sudo iptables -t nat -A PREROUTING -d {virtual_ip} -p tcp --dport {rtsp_port} "
-                f"-j DNAT --to-destination {camera_ip}:{rtsp_port}",
-                
-                # Masquerade return traffic
-                f"sudo iptables -t nat -A POSTROUTING -s {camera_ip} -j MASQUERADE",
-                
-                # Allow forwarding
-                f"sudo iptables -A FORWARD -d {camera_ip} -p tcp --dport {rtsp_port} -j ACCEPT",
-                f"sudo iptables -A FORWARD -s {camera_ip} -p tcp --sport {rtsp_port} -j ACCEPT"
-            ]
-            
-            for rule in rules:
-                result = subprocess.run(rule, shell=True, capture_output=True, text=True)
-                if result.returncode != 0:
-                    logger.warning(f"Rule may already exist or failed: {result.stderr}")
-            
-            logger.info(f"Set up port forwarding: {virtual_ip}:{rtsp_port} -> {camera_ip}:{rtsp_port}")
-            return True
-            
+            unforwarded = self.firewall.remove_forwarding(list(moved.values())) if moved else {}
+            # A camera whose old rule is still in place cannot be forwarded to its new IP
+            stuck = {virtual_ip for virtual_ip in moved if not unforwarded.get(virtual_ip)}
+            results = self.firewall.apply_forwarding([m for m in mappings if m[0] not in stuck])
+            results.update({virtual_ip: False for virtual_ip in stuck})
         except Exception as e:
-            logger.error(f"Error setting up port forwarding: {e}")
-            return False
+            logger.error("Error setting up port forwarding: %s", e)
+            return {virtual_ip: False for virtual_ip, _, _ in mappings}
+        
+        if moved:
+            logger.info("Moved forwarding of %s cameras to new IPs", len(moved) - len(stuck))
+            self.flush_connections([virtual_ip for virtual_ip in moved if virtual_ip not in stuck])
+        
+        # Remember the mapping so the firewall can be reconciled later
+        changed = []
+        for virtual_ip, camera_ip, rtsp_port in mappings:
+            if results[virtual_ip]:
+                if virtual_ip in by_virtual_ip:
+                    by_virtual_ip[virtual_ip].update({'camera_ip': camera_ip, 'rtsp_port': rtsp_port})
+                    if isinstance(self.firewall, RelayForwarder) and self.firewall.bind is not None:
+                        by_virtual_ip[virtual_ip]['relay_port'] = self.firewall.port(virtual_ip)
+                    changed.append(by_virtual_ip[virtual_ip]['camera_id'])
+                logger.info("Set up port forwarding: %s:%s -> %s:%s",
+                            virtual_ip, rtsp_port, camera_ip, rtsp_port)
+            else:
+                if virtual_ip in moved and virtual_ip not in stuck:
+                    # Old forwarding is gone, so nothing is forwarded until the retry
+                    by_virtual_ip[virtual_ip].pop('camera_ip', None)
+                    changed.append(by_virtual_ip[virtual_ip]['camera_id'])
+                logger.error("Failed to set up port forwarding for %s", virtual_ip)
+        self.save_config(changed)
+        return results
+    
+    def stale_cameras(self, active_ids: Iterable[str]) -> List[str]:
+        """Cameras holding a virtual IP that are no longer in active_ids"""
+        active_ids = set(active_ids)
+        return [camera_id for camera_id in self.virtual_ips if camera_id not in active_ids]
+    
+    @traced
+    def teardown_cameras(self, camera_ids: List[str]) -> Dict[str, bool]:
+        """
+        Remove forwarding, tracked connections and virtual IPs of many cameras
+        Rules go in one firewall transaction and addresses in one round trip; the
+        IPs return to the pool. Returns True per camera that is fully gone
+        """
+        configs = {c: self.virtual_ips[c] for c in camera_ids if c in self.virtual_ips}
+        mappings = {c: (config['virtual_ip'], config['camera_ip'], config.get('rtsp_port', RTSP_PORT))
+                    for c, config in configs.items() if config.get('camera_ip')}
+        try:
+            unforwarded = self.firewall.remove_forwarding(list(mappings.values()))
+        except Exception as e:
+            logger.error("Error removing port forwarding: %s", e)
+            unforwarded = {}
+        
+        # Cameras whose rules could not be removed keep their address, to retry later
+        removable = [c for c in configs if c not in mappings or unforwarded.get(mappings[c][0])]
+        for camera_id in removable:
+            if camera_id in mappings:
+                self.virtual_ips[camera_id].pop('camera_ip', None)
+        self.flush_connections([configs[c]['virtual_ip'] for c in removable])
+        
+        removed = self.remove_virtual_ips(removable) if removable else {}
+        results = {camera_id: bool(removed.get(camera_id)) for camera_id in configs}
+        logger.info("Tore down %s of %s deactivated cameras", sum(results.values()), len(configs))
+        return results
+    
+    @traced
+    def flush_connections(self, virtual_ips: List[str]):
+        """
+        Drop conntrack entries for the virtual IPs so removed cameras stop forwarding at once
+        All deletes go to a single conntrack process reading them from stdin
+        """
+        if not virtual_ips:
+            return
+        script = "".join(f"-D -d {virtual_ip}\n" for virtual_ip in virtual_ips)
+        try:
+            result = run_command(["sudo", "conntrack", "-R", "-"], input=script)
+            # conntrack exits with 1 when nothing matched
+            if result.returncode not in (0, 1):
+                logger.debug("conntrack failed for %s addresses: %s", len(virtual_ips), result.stderr.strip())
+        except OSError as e:
+            logger.debug("conntrack unavailable: %s", e)
+    
+    def endpoint(self, camera_id: str) -> Optional[Tuple[str, int]]:
+        """Address viewers use to reach a forwarded camera"""
+        config = self.virtual_ips.get(camera_id)
+        if not config:
+            return None
+        port = config.get('rtsp_port', RTSP_PORT)
+        if isinstance(self.firewall, RelayForwarder):
+            return self.firewall.endpoint(config['virtual_ip'], port)
+        return (config['virtual_ip'], port)
+    
+    def forwarding_mappings(self) -> List[Tuple[str, str, int]]:
+        """Desired (virtual_ip, camera_ip, rtsp_port) forwarding for every known camera"""
+        return [(c['virtual_ip'], c['camera_ip'], c.get('rtsp_port', RTSP_PORT))
+                for c in self.virtual_ips.values() if c.get('camera_ip')]
+    
+    @traced
+    def reconcile_firewall(self, dry_run: bool = False) -> Optional[Dict]:
+        """
+        Bring the firewall in line with virtual_ips, removing duplicate and orphaned rules
+        Returns the reconcile report or None if the firewall could not be read
+        """
+        try:
+            report = self.firewall.reconcile(self.forwarding_mappings(), dry_run=dry_run)
+            for table, rule in report['duplicates'] + report['orphaned']:
+                logger.debug("Stale %s rule: %s", table, rule)
+            return report
+        except Exception as e:
+            logger.error("Error reconciling firewall: %s", e)
+            return None
+
+class PortalUnavailableError(Exception):
+    """Raised instead of calling the portal while its circuit breaker is open"""
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing service for a cool-down period
+    After failure_threshold consecutive failures the breaker opens; once
+    reset_timeout has passed a single trial call is let through, and its
+    outcome closes or re-opens the breaker
+    """
+    
+    def __init__(self, failure_threshold: int = PORTAL_BREAKER_THRESHOLD,
+                 reset_timeout: float = PORTAL_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+    
+    @property
+    def state(self) -> str:
+        """closed, open or half-open"""
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self.retry_after() == 0 else 'open'
+    
+    def retry_after(self) -> float:
+        """Seconds until calls are allowed again, 0 if they are allowed now"""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+    
+    def allow(self) -> bool:
+        """Whether a call may go out now"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.retry_after() > 0 or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+    
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("Portal reachable again, closing circuit breaker")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning("Portal failed %s times, pausing calls for %ss",
+                                   self.failures, self.reset_timeout)
+                self.opened_at = time.monotonic()
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter measuring connection setup (TCP connect and TLS handshake)
+    Times are kept per thread, since the pooled session is shared between threads
+    """
+    
+    def __init__(self, *args, **kwargs):
+        self.local = threading.local()
+        super().__init__(*args, **kwargs)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        local = self.local
+        
+        def timed(connection_cls):
+            class TimedConnection(connection_cls):
+                def connect(self):
+                    started = time.monotonic()
+                    try:
+                        super().connect()
+                    finally:
+                        local.connect = getattr(local, 'connect', 0.0) + time.monotonic() - started
+                        local.connections = getattr(local, 'connections', 0) + 1
+            return TimedConnection
+        
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: type(pool_cls.__name__, (pool_cls,), {'ConnectionCls': timed(pool_cls.ConnectionCls)})
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+    
+    def take_connect_time(self) -> Tuple[float, int]:
+        """Seconds this thread spent opening connections and how many, since the last call"""
+        connect = getattr(self.local, 'connect', 0.0), getattr(self.local, 'connections', 0)
+        self.local.connect, self.local.connections = 0.0, 0
+        return connect
 
 class PortalClient:
     """Handles communication with the web portal"""
     
-    def __init__(self, api_url: str, api_key: str):
+    def __init__(self, api_url: str, api_key: str, pool_size: int = PORTAL_POOL_SIZE,
+                 retries: int = PORTAL_RETRIES):
         self.api_url = api_url
         self.headers = {
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json'
         }
+        self.timeout = (PORTAL_CONNECT_TIMEOUT, PORTAL_READ_TIMEOUT)
+        self.machine_id = self._get_machine_id()
+        self.timings = {}  # Endpoint path -> timing of its last call
+        self.breaker = CircuitBreaker()
+        
+        # Local snapshot of activated cameras kept in sync with the portal
+        self.activated = {}  # Camera id -> camera
+        self.activation_etag = None
+        self.activation_cursor = None
+        
+        # One keep-alive session, so polls reuse the TCP+TLS connection.
+        # POSTs are only retried when the connection failed before they were
+        # sent; replaying them after a timeout or error status could apply them
+        # twice, the outbox retries them instead
+        retry = Retry(
+            total=retries,
+            backoff_factor=PORTAL_BACKOFF,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'GET'}),
+            raise_on_status=False
+        )
+        self.adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+    
+    def close(self):
+        """Close pooled connections"""
+        self.session.close()
+    
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Send a request over the pooled session and record its timing
+        'connect' is the time spent opening new connections (TCP and TLS, zero when
+        a pooled one was reused), 'elapsed' runs until the response headers arrived
+        and 'read' is the time spent reading the body
+        """
+        if not self.breaker.allow():
+            raise PortalUnavailableError(f"portal calls paused for {self.breaker.retry_after():.0f}s")
+        
+        self.adapter.take_connect_time()
+        started = time.monotonic()
+        try:
+            with TRACER.span('portal', method=method, path=path) as span:
+                response = self.session.request(method, f"{self.api_url}{path}",
+                                                timeout=self.timeout, **kwargs)
+                content = response.content
+                span['status'] = response.status_code
+        except requests.RequestException:
+            self.breaker.record_failure()
+            PORTAL_SECONDS.observe(time.monotonic() - started, method=method, endpoint=path)
+            PORTAL_RESPONSES.inc(endpoint=path, status='error')
+            raise
+        PORTAL_SECONDS.observe(time.monotonic() - started, method=method, endpoint=path)
+        PORTAL_RESPONSES.inc(endpoint=path, status=response.status_code)
+        if response.status_code >= 500 or response.status_code == 429:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        total = time.monotonic() - started
+        elapsed = response.elapsed.total_seconds()
+        connect, connections = self.adapter.take_connect_time()
+        PORTAL_CONNECT_SECONDS.observe(connect, endpoint=path)
+        self.timings[path] = {
+            'method': method,
+            'status': response.status_code,
+            'connect': round(connect, 4),
+            'connections': connections,
+            'elapsed': round(elapsed, 4),
+            'read': round(max(0.0, total - elapsed), 4),
+            'total': round(total, 4),
+            'bytes': len(content)
+        }
+        logger.debug("%s %s: %s in %.3fs", method, path, response.status_code, total)
+        return response
     
-    def register_cameras(self, cameras: List[Dict]) -> bool:
-        """Register discovered cameras with portal"""
+    def register_cameras(self, cameras: List[Dict], compress: bool = False) -> bool:
+        """Register discovered cameras with portal, optionally gzip-compressing the body"""
         try:
-            endpoint = f"{self.api_url}/api/cameras/register"
             payload = {
-                'machine_id': self._get_machine_id(),
+                'machine_id': self.machine_id,
                 'cameras': cameras,
                 'timestamp': datetime.now().isoformat()
             }
             
-            response = requests.post(endpoint, json=payload, headers=self.headers, timeout=10)
+            if compress:
+                body = gzip.compress(json.dumps(payload).encode(), compresslevel=5)
+                response = self._request('POST', "/api/cameras/register", data=body,
+                                         headers={'Content-Encoding': 'gzip'})
+            else:
+                response = self._request('POST', "/api/cameras/register", json=payload)
             
             if response.status_code == 200:
-                logger.info(f"Registered {len(cameras)} cameras with portal")
+                logger.info("Registered %s cameras with portal", len(cameras))
                 return True
             else:
-                logger.error(f"Failed to register cameras: {response.status_code} - {response.text}")
+                logger.error("Failed to register cameras: %s - %s", response.status_code, response.text)
                 return False
                 
         except Exception as e:
-            logger.error(f"Error registering cameras: {e}")
+            logger.error("Error registering cameras: %s", e)
             return False
     
-    def get_activated_cameras(self) -> List[Dict]:
-        """Get list of activated cameras from portal"""
+    def report_status(self, statuses: List[Dict]) -> bool:
+        """Report camera status changes to portal"""
         try:
-            endpoint = f"{self.api_url}/api/cameras/activated"
-            params = {'machine_id': self._get_machine_id()}
+            payload = {
+                'machine_id': self.machine_id,
+                'statuses': statuses,
+                'timestamp': datetime.now().isoformat()
+            }
             
-            response = requests.get(endpoint, params=params, headers=self.headers, timeout=10)
+            response = self._request('POST', "/api/cameras/status", json=payload)
             
             if response.status_code == 200:
-                return response.json().get('activated_cameras', [])
+                logger.debug("Reported %s camera statuses to portal", len(statuses))
+                return True
             else:
-                logger.error(f"Failed to get activated cameras: {response.status_code}")
-                return []
+                logger.error("Failed to report camera status: %s", response.status_code)
+                return False
                 
         except Exception as e:
-            logger.error(f"Error getting activated cameras: {e}")
+            logger.error("Error reporting camera status: %s", e)
+            return False
+    
+    def get_activated_cameras(self) -> List[Dict]:
+        """Get list of activated cameras from portal"""
+        if self.poll_activation_changes() is None:
             return []
+        return list(self.activated.values())
+    
+    def poll_activation_changes(self) -> Optional[Dict]:
+        """
+        Sync the local snapshot of activated cameras with the portal
+        Sends If-None-Match and the last cursor, so an unchanged list costs a 304
+        or an empty delta. Returns {'changed': [cameras], 'removed': [camera ids]},
+        or None if the portal could not be reached
+        """
+        try:
+            params = {'machine_id': self.machine_id}
+            headers = {'Accept-Encoding': 'gzip'}
+            if self.activation_cursor:
+                params['since'] = self.activation_cursor
+            if self.activation_etag:
+                headers['If-None-Match'] = self.activation_etag
+            
+            response = self._request('GET', "/api/cameras/activated", params=params, headers=headers)
+            
+            if response.status_code == 304:
+                return {'changed': [], 'removed': []}
+            if response.status_code != 200:
+                logger.error("Failed to get activated cameras: %s", response.status_code)
+                return None
+            
+            body = response.json()
+            cameras = [c for c in body.get('activated_cameras', []) if c.get('camera_id')]
+            if body.get('delta'):
+                # Only the cameras that changed since the cursor
+                changed = cameras
+                removed = [r.get('camera_id') if isinstance(r, dict) else r
+                           for r in body.get('removed', [])]
+                removed = [camera_id for camera_id in removed if camera_id in self.activated]
+            else:
+                # Full list, diff it against the snapshot
+                current = {c['camera_id']: c for c in cameras}
+                changed = [c for camera_id, c in current.items() if self.activated.get(camera_id) != c]
+                removed = [camera_id for camera_id in self.activated if camera_id not in current]
+            
+            for camera in changed:
+                self.activated[camera['camera_id']] = camera
+            for camera_id in removed:
+                del self.activated[camera_id]
+            self.activation_etag = response.headers.get('ETag')
+            self.activation_cursor = body.get('cursor')
+            
+            return {'changed': changed, 'removed': removed}
+                
+        except Exception as e:
+            logger.error("Error getting activated cameras: %s", e)
+            return None
     
     def _get_machine_id(self) -> str:
         """Get unique machine identifier"""
@@ -323,75 +3788,810 @@ class PortalClient:
         except:
             return socket.gethostname()
 
+class Outbox:
+    """
+    Durable queue of portal calls, so the service never waits on the portal
+    Entries are keyed per camera, so a newer registration or status replaces an
+    older one still waiting. A background thread sends them in batches, backing
+    off exponentially while the portal fails
+    """
+    
+    KINDS = ('register', 'status')
+    
+    def __init__(self, portal: PortalClient, path: str = OUTBOX_FILE,
+                 batch_size: int = OUTBOX_BATCH_SIZE, max_backoff: float = OUTBOX_MAX_BACKOFF):
+        self.portal = portal
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        # Written before enqueue returns, so an accepted call survives a crash
+        self.store = JournalStateStore(path, flush_interval=0, key='entries')
+        self.lock = threading.Lock()
+        try:
+            self.entries = self.store.load()
+        except Exception as e:
+            logger.error("Error loading outbox: %s", e)
+            self.entries = self.store.state
+        self.seq = max((e['seq'] for e in self.entries.values()), default=0)
+        self.failures = 0
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def enqueue_registration(self, cameras: List[Dict]):
+        """Queue cameras for registration, replacing queued copies of the same MAC"""
+        for camera in cameras:
+            self._put(f"register:{camera.get('mac') or camera['ip']}", 'register', camera)
+    
+    def enqueue_status(self, camera_id: str, status: Dict, topic: str = 'status'):
+        """Queue a status report, replacing an unsent one on the same topic for the camera"""
+        payload = dict(status, camera_id=camera_id, reported_at=datetime.now().isoformat())
+        self._put(f"{topic}:{camera_id}", 'status', payload)
+    
+    def _put(self, key: str, kind: str, payload: Dict):
+        with self.lock:
+            self.seq += 1
+            self.entries[key] = {'kind': kind, 'payload': payload, 'seq': self.seq,
+                                 'queued_at': time.time()}
+        self.store.record([key])
+        self.wake.set()
+    
+    def start(self):
+        """Start the background sender"""
+        self.thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self.thread.start()
+    
+    def stop(self, timeout: float = 5):
+        """
+        Stop the sender and persist whatever is still queued
+        The sender closes the store itself once a delivery still in flight ends
+        """
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is None:
+            self.store.close()
+            return
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.warning("Outbox delivery still in flight after %ss, leaving it to finish", timeout)
+    
+    def _run(self):
+        delay = 0
+        try:
+            while not self.stopping.is_set():
+                self.wake.wait(timeout=delay)
+                self.wake.clear()
+                if self.stopping.is_set():
+                    break
+                try:
+                    delay = self.flush_once()
+                except Exception as e:
+                    logger.error("Error flushing outbox: %s", e)
+                    delay = self.max_backoff
+        finally:
+            self.store.close()
+    
+    def flush_once(self) -> float:
+        """Send one batch of each kind, returns seconds to wait before the next attempt"""
+        if not self.entries:
+            return OUTBOX_IDLE_WAIT
+        if self.portal.breaker.retry_after() > 0:
+            return self.portal.breaker.retry_after()
+        
+        for kind in self.KINDS:
+            with self.lock:
+                batch = [(key, entry['seq'], entry['payload'])
+                         for key, entry in self.entries.items() if entry['kind'] == kind]
+            batch = batch[:self.batch_size]
+            if not batch:
+                continue
+            
+            payloads = [payload for _, _, payload in batch]
+            if kind == 'register':
+                ok = self.portal.register_cameras(payloads, compress=REGISTER_COMPRESS)
+            else:
+                ok = self.portal.report_status(payloads)
+            
+            if not ok:
+                self.failures += 1
+                backoff = min(self.max_backoff, OUTBOX_BASE_BACKOFF * 2 ** (self.failures - 1))
+                return backoff * random.uniform(0.5, 1.0)
+            
+            # Entries replaced while the batch was in flight stay queued
+            with self.lock:
+                sent = [key for key, seq, _ in batch
+                        if key in self.entries and self.entries[key]['seq'] == seq]
+                for key in sent:
+                    del self.entries[key]
+            self.store.record(sent)
+        
+        self.failures = 0
+        return 0 if self.entries else OUTBOX_IDLE_WAIT
+
+class RegistrationStream:
+    """
+    Registers cameras with the portal in chunks while discovery is still running
+    A chunk is sent when it is full or its time window ends; the number of
+    requests in flight is bounded, which also bounds memory on large sites
+    """
+    
+    def __init__(self, portal: PortalClient, chunk_size: int = REGISTER_CHUNK_SIZE,
+                 window: float = REGISTER_WINDOW, max_in_flight: int = REGISTER_MAX_IN_FLIGHT,
+                 compress: bool = REGISTER_COMPRESS, outbox: Optional[Outbox] = None):
+        self.portal = portal
+        self.outbox = outbox
+        self.chunk_size = chunk_size
+        self.window = window
+        self.max_in_flight = max_in_flight
+        self.compress = compress
+    
+    def run(self, cameras: Iterable[Dict]) -> Dict:
+        """Consume cameras until exhausted, returns registered/failed/chunk counts"""
+        stats = {'registered': 0, 'failed': 0, 'chunks': 0}
+        stats_lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.max_in_flight)
+        incoming = queue.Queue(maxsize=self.chunk_size * 2)
+        done = object()
+        
+        def produce():
+            try:
+                for camera in cameras:
+                    incoming.put(camera)
+            except Exception as e:
+                logger.error("Error during discovery: %s", e)
+            finally:
+                incoming.put(done)
+        
+        def send(chunk):
+            try:
+                ok = self.portal.register_cameras(chunk, compress=self.compress)
+                if not ok and self.outbox is not None:
+                    self.outbox.enqueue_registration(chunk)  # Retried in the background
+                with stats_lock:
+                    stats['registered' if ok else 'failed'] += len(chunk)
+            finally:
+                slots.release()
+        
+        # Scan and uploads carry on the caller's trace
+        threading.Thread(target=contextvars.copy_context().run, args=(produce,),
+                         name="discovery-stream", daemon=True).start()
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="register")
+        chunk = []
+        chunk_deadline = None
+        try:
+            while True:
+                timeout = None if chunk_deadline is None else max(0.0, chunk_deadline - time.monotonic())
+                try:
+                    item = incoming.get(timeout=timeout)
+                except queue.Empty:
+                    item = None  # Window ended
+                
+                if item is not None and item is not done:
+                    if not chunk:
+                        chunk_deadline = time.monotonic() + self.window
+                    chunk.append(item)
+                
+                if chunk and (item is None or item is done or len(chunk) >= self.chunk_size):
+                    slots.acquire()  # Back-pressure once max_in_flight chunks are pending
+                    stats['chunks'] += 1
+                    executor.submit(contextvars.copy_context().run, send, chunk)
+                    chunk = []
+                    chunk_deadline = None
+                
+                if item is done:
+                    break
+        finally:
+            executor.shutdown(wait=True)
+        
+        logger.info("Streamed %s cameras to portal in %s chunks (%s failed)",
+                    stats['registered'], stats['chunks'], stats['failed'])
+        return stats
+
+async def wait_event(event: asyncio.Event, timeout: Optional[float]):
+    """
+    Sleep until the event is set or the timeout passes
+    Unlike wait_for on Python 3.11, a cancellation arriving as the event is set
+    is never swallowed, so tasks sleeping here always stop when cancelled
+    """
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        await asyncio.wait({waiter}, timeout=timeout)
+    finally:
+        waiter.cancel()
+
+class LatencyHistogram:
+    """Histogram over the last window samples, with fixed buckets and O(1) updates"""
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # Upper bounds, seconds
+    
+    def __init__(self, window: int = HEALTH_HISTORY):
+        self.samples = deque(maxlen=window)  # Bucket index of each sample
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+    
+    def observe(self, seconds: float):
+        if len(self.samples) == self.samples.maxlen:
+            self.counts[self.samples[0]] -= 1
+        index = next((i for i, bound in enumerate(self.BUCKETS) if seconds <= bound), len(self.BUCKETS))
+        self.samples.append(index)
+        self.counts[index] += 1
+    
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile, None without samples"""
+        if not self.samples:
+            return None
+        rank = q * len(self.samples)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else float('inf')
+        return float('inf')
+
+class CameraHealthMonitor:
+    """
+    Checks every activated camera with a TCP connect and an RTSP OPTIONS from one event loop
+    Each camera has its own due time in a heap. Healthy cameras back off towards
+    HEALTH_MAX_INTERVAL, failing or flapping ones are rechecked after
+    HEALTH_MIN_INTERVAL. Status changes are queued in the outbox, which sends them
+    to the portal in batches
+    """
+    
+    def __init__(self, outbox: Optional['Outbox'] = None, concurrency: int = HEALTH_CONCURRENCY,
+                 timeout: float = HEALTH_TIMEOUT):
+        self.outbox = outbox
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.cameras = {}  # Camera ID -> health state
+        self.heap = []  # (due, camera ID, generation)
+        self.wake = None
+        self.checks = 0
+    
+    def track(self, camera_id: str, ip: str, port: int = RTSP_PORT):
+        """Start checking a camera right away, or update its address"""
+        state = self.cameras.get(camera_id)
+        if state is not None and (state['ip'], state['port']) == (ip, port):
+            return
+        self.cameras[camera_id] = {
+            'ip': ip, 'port': port, 'status': 'unknown', 'failures': 0,
+            'interval': HEALTH_BASE_INTERVAL, 'changes': deque(), 'generation': 0,
+            'latency': LatencyHistogram(), 'last_error': None
+        }
+        self._schedule(camera_id, 0)
+    
+    def forget(self, camera_id: str):
+        """Stop checking a camera"""
+        self.cameras.pop(camera_id, None)
+    
+    def sync(self, targets: Dict[str, Tuple[str, int]]):
+        """Check exactly the given cameras, camera ID -> (ip, port)"""
+        for camera_id in [c for c in self.cameras if c not in targets]:
+            self.forget(camera_id)
+        for camera_id, (ip, port) in targets.items():
+            self.track(camera_id, ip, port)
+    
+    def summary(self, camera_id: str) -> Optional[Dict]:
+        """Status, check interval and latency quantiles of a camera"""
+        state = self.cameras.get(camera_id)
+        if state is None:
+            return None
+        return {
+            'status': state['status'],
+            'interval': state['interval'],
+            'p50': state['latency'].quantile(0.5),
+            'p95': state['latency'].quantile(0.95),
+            'buckets': dict(zip(LatencyHistogram.BUCKETS + (float('inf'),), state['latency'].counts))
+        }
+    
+    def _schedule(self, camera_id: str, delay: float):
+        state = self.cameras[camera_id]
+        state['generation'] += 1
+        heapq.heappush(self.heap, (time.monotonic() + delay, camera_id, state['generation']))
+        if self.wake is not None:
+            self.wake.set()
+    
+    async def run(self):
+        """Run due checks until cancelled, sleeping until the next one is due"""
+        self.wake = asyncio.Event()
+        limit = asyncio.Semaphore(self.concurrency)
+        running = set()
+        
+        async def check(camera_id):
+            async with limit:
+                await self.check(camera_id)
+        
+        try:
+            while True:
+                now = time.monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    _, camera_id, generation = heapq.heappop(self.heap)
+                    state = self.cameras.get(camera_id)
+                    if state is None or state['generation'] != generation:
+                        continue  # Forgotten or rescheduled since
+                    task = asyncio.ensure_future(check(camera_id))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+                
+                timeout = self.heap[0][0] - now if self.heap else None
+                await wait_event(self.wake, timeout)
+                self.wake.clear()
+        finally:
+            # Wait for cancelled checks, so none is left pending and their semaphore slots are released
+            tasks = list(running)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def check(self, camera_id: str):
+        """Check one camera and schedule its next check"""
+        state = self.cameras.get(camera_id)
+        if state is None:
+            return
+        started = time.monotonic()
+        error = await self._probe(state['ip'], state['port'])
+        self.checks += 1
+        if self.cameras.get(camera_id) is not state:
+            return
+        
+        if error is None:
+            state['latency'].observe(time.monotonic() - started)
+            state['failures'] = 0
+            status = 'online'
+        else:
+            state['failures'] += 1
+            status = 'offline' if state['failures'] >= HEALTH_OFFLINE_AFTER else state['status']
+        state['last_error'] = error
+        
+        now = time.monotonic()
+        changes = state['changes']
+        changed = status != state['status']
+        if changed:
+            if state['status'] != 'unknown':
+                changes.append(now)
+            state['status'] = status
+            self._report(camera_id, state)
+        while changes and changes[0] < now - HEALTH_FLAP_WINDOW:
+            changes.popleft()
+        
+        if error is not None or status != 'online' or len(changes) >= HEALTH_FLAP_LIMIT:
+            state['interval'] = HEALTH_MIN_INTERVAL
+        elif changed or state['interval'] == HEALTH_MIN_INTERVAL:
+            state['interval'] = HEALTH_BASE_INTERVAL
+        else:
+            state['interval'] = min(HEALTH_MAX_INTERVAL, state['interval'] * 1.5)
+        # Jitter keeps cameras activated together from being checked together forever
+        self._schedule(camera_id, state['interval'] * random.uniform(0.9, 1.1))
+    
+    async def _probe(self, ip: str, port: int) -> Optional[str]:
+        """TCP connect and RTSP OPTIONS, returns None if the camera answered or the error"""
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), self.timeout)
+            writer.write(f"OPTIONS rtsp://{ip}:{port}/ RTSP/1.0\r\nCSeq: 1\r\n"
+                         f"User-Agent: camera-portal\r\n\r\n".encode())
+            status_line, _, _ = await asyncio.wait_for(read_rtsp_message(reader), self.timeout)
+            # Any RTSP answer, even 401, means the camera is up
+            return None if status_line.startswith('RTSP/') else "not an RTSP server"
+        except asyncio.TimeoutError:
+            return "timeout"
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            return e.strerror if isinstance(e, OSError) and e.strerror else type(e).__name__
+        finally:
+            if writer is not None:
+                writer.close()
+    
+    def _report(self, camera_id: str, state: Dict):
+        if state['last_error']:
+            logger.info("Camera %s is %s (%s)", camera_id, state['status'], state['last_error'])
+        else:
+            logger.info("Camera %s is %s", camera_id, state['status'])
+        if self.outbox is None:
+            return
+        p50 = state['latency'].quantile(0.5)
+        self.outbox.enqueue_status(camera_id, {
+            'health': state['status'],
+            'error': state['last_error'],
+            'latency_p50_ms': None if p50 is None or p50 == float('inf') else p50 * 1000
+        }, topic='health')
+
+class ActivationPipeline:
+    """
+    Activates a batch of cameras in stages, each stage covering the whole batch
+    Addresses are added in one round trip and forwarding in one firewall
+    transaction, so onboarding hundreds of cameras costs about one of each.
+    Cameras failing a later stage are rolled back and their IPs freed
+    """
+    
+    def __init__(self, network: NetworkManager, max_workers: int = ACTIVATION_WORKERS,
+                 verify: bool = ACTIVATION_VERIFY, verify_timeout: float = ACTIVATION_VERIFY_TIMEOUT,
+                 progress=None):
+        self.network = network
+        self.max_workers = max_workers
+        self.verify = verify
+        self.verify_timeout = verify_timeout
+        self.progress = progress  # Called with (camera_id, stage, ok) as cameras move on
+    
+    def run(self, cameras: List[Dict]) -> Dict[str, Optional[str]]:
+        """Activate cameras, returns the virtual IP per camera ID or None for failures"""
+        results = {}
+        pending = {}
+        for camera in cameras:
+            camera_id = camera.get('camera_id')
+            original_ip = camera.get('original_ip')
+            if not (camera_id and original_ip):
+                continue
+            config = self.network.virtual_ips.get(camera_id)
+            if config and config.get('camera_ip') == original_ip:
+                results[camera_id] = config['virtual_ip']  # Already active
+            else:
+                pending[camera_id] = camera
+        
+        if self.verify and pending:
+            with ACTIVATION_SECONDS.time(stage='verify'):
+                unreachable = self._unreachable(pending)
+            for camera_id in unreachable:
+                self._fail(results, pending.pop(camera_id), 'verify')
+        
+        # Allocate and add addresses for cameras that have none yet
+        created = [c for c in pending if c not in self.network.virtual_ips]
+        if created:
+            with ACTIVATION_SECONDS.time(stage='address'):
+                addresses = self.network.create_virtual_ips(created)
+            for camera_id, virtual_ip in addresses.items():
+                if virtual_ip is None:
+                    self._fail(results, pending.pop(camera_id), 'address')
+                else:
+                    self._report(camera_id, 'address', True)
+        
+        # Forward every camera that has an address in one transaction
+        mappings = {
+            camera_id: (self.network.virtual_ips[camera_id]['virtual_ip'], camera['original_ip'],
+                        camera.get('rtsp_port', RTSP_PORT))
+            for camera_id, camera in pending.items()
+        }
+        forwarded = {}
+        if mappings:
+            with ACTIVATION_SECONDS.time(stage='forward'):
+                forwarded = self.network.setup_port_forwarding_bulk(list(mappings.values()))
+        rollback = []
+        for camera_id, (virtual_ip, _, _) in mappings.items():
+            if forwarded.get(virtual_ip):
+                results[camera_id] = virtual_ip
+                ACTIVATIONS.inc(action='activate', result='ok')
+                self._report(camera_id, 'forward', True)
+                logger.info("Camera %s activated and ready at %s", camera_id, virtual_ip)
+            else:
+                self._fail(results, pending[camera_id], 'forward')
+                if camera_id in created:
+                    rollback.append(camera_id)
+        
+        if rollback:
+            logger.warning("Rolling back virtual IPs of %s cameras that could not be forwarded",
+                           len(rollback))
+            with ACTIVATION_SECONDS.time(stage='rollback'):
+                self.network.remove_virtual_ips(rollback)
+        return results
+    
+    def _unreachable(self, cameras: Dict[str, Dict]) -> List[str]:
+        """Cameras not accepting connections on their RTSP port, checked concurrently"""
+        def reachable(camera):
+            try:
+                with socket.create_connection((camera['original_ip'], camera.get('rtsp_port', RTSP_PORT)),
+                                              timeout=self.verify_timeout):
+                    return True
+            except OSError:
+                return False
+        
+        with TRACER.span('activation.verify', cameras=len(cameras)):
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                checks = dict(zip(cameras, executor.map(reachable, cameras.values())))
+        return [camera_id for camera_id, ok in checks.items() if not ok]
+    
+    def _fail(self, results: Dict, camera: Dict, stage: str):
+        results[camera['camera_id']] = None
+        ACTIVATIONS.inc(action='activate', result=stage)
+        logger.error("Activation of camera %s failed at the %s stage", camera['camera_id'], stage)
+        self._report(camera['camera_id'], stage, False)
+    
+    def _report(self, camera_id: str, stage: str, ok: bool):
+        if self.progress is not None:
+            try:
+                self.progress(camera_id, stage, ok)
+            except Exception as e:
+                logger.error("Error reporting activation progress: %s", e)
+
 class CameraManager:
     """Main camera management class"""
     
-    def __init__(self):
-        self.discovery = CameraDiscovery()
-        self.network = NetworkManager()
-        self.portal = PortalClient(PORTAL_API_URL, PORTAL_API_KEY)
+    def __init__(self, settings: Optional[Dict] = None, discovery=None, network=None,
+                 portal=None, outbox=None):
+        self.settings = load_settings() if settings is None else settings
+        self.discovery = discovery or CameraDiscovery(
+            arp_backend=create_arp_backend(self.settings.get('arp_backend', ARP_BACKEND)),
+            vendor_index=VendorIndex.from_settings(self.settings),
+            probe_cache=ProbeCache()
+        )
+        self.network = network or NetworkManager(self.settings)
+        self.portal = portal or PortalClient(PORTAL_API_URL, PORTAL_API_KEY)
+        self.outbox = outbox or Outbox(self.portal)
+        self.health = CameraHealthMonitor(self.outbox)
+        self.activation = ActivationPipeline(
+            self.network, verify=self.settings.get('verify_activations', ACTIVATION_VERIFY),
+            progress=self._activation_progress
+        )
+        self.executor = ThreadPoolExecutor(max_workers=SERVICE_WORKERS, thread_name_prefix="service")
         self.running = False
+        self.queued_at = {}  # Camera ID -> when its latest portal change was queued
+        self.profiler = SamplingProfiler(self.settings.get('profile_dir', PROFILE_DIR))
+        TRACER.configure(self.settings)
+        self.metrics = MetricsServer(METRICS, port=self.settings.get('metrics_port', METRICS_PORT))
+        METRICS.gauge("camera_portal_cameras", "Cameras by state", ('state',), function=self._camera_counts)
+        METRICS.gauge("camera_portal_relay", "Relay counters summed over cameras", ('counter',),
+                      function=self._relay_totals)
+        
+        # Created on the event loop by run()
+        self.loop = None
+        self.stopping = None
+        self.sync_wake = None
+        self.discovery_wake = None
+        self.activations = None
     
     def start(self):
-        """Start the camera management service"""
-        self.running = True
+        """Start the camera management service and block until it stops"""
         logger.info("Starting Camera Manager Service")
-        
-        # Initial camera discovery
-        cameras = self.discovery.scan_local_network()
-        if cameras:
-            self.portal.register_cameras(cameras)
-        
-        # Start monitoring thread
-        monitor_thread = threading.Thread(target=self._monitor_loop)
-        monitor_thread.daemon = True
-        monitor_thread.start()
-        
-        # Keep main thread alive
         try:
-            while self.running:
-                time.sleep(1)
+            asyncio.run(self.run())
         except KeyboardInterrupt:
-            self.stop()
+            pass
     
     def stop(self):
-        """Stop the camera management service"""
+        """Ask the service to shut down, safe to call from any thread or signal handler"""
         self.running = False
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+    
+    def reload(self):
+        """
+        Re-read the settings, apply the RELOADABLE_SETTINGS and rescan and resync right away
+        Other changed keys are logged and take effect after a restart
+        """
+        logger.info("Reloading settings")
+        previous, self.settings = self.settings, load_settings()
+        changed = {key for key in set(previous) | set(self.settings)
+                   if previous.get(key) != self.settings.get(key)}
+        
+        if changed & {'arp_backend', 'camera_vendors', 'camera_ouis', 'oui_file'}:
+            self.discovery.arp_backend = create_arp_backend(self.settings.get('arp_backend', ARP_BACKEND))
+            self.discovery.vendor_index = VendorIndex.from_settings(self.settings)
+        self.activation.verify = self.settings.get('verify_activations', ACTIVATION_VERIFY)
+        if 'log_level' in changed:
+            logging.getLogger().setLevel(self.settings.get('log_level', LOG_LEVEL))
+        TRACER.configure(self.settings)
+        
+        restart = sorted(changed - RELOADABLE_SETTINGS)
+        if restart:
+            logger.warning("Settings %s changed, restart the service to apply them", ", ".join(restart))
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.discovery_wake.set)
+            self.loop.call_soon_threadsafe(self.sync_wake.set)
+    
+    async def run(self):
+        """
+        Run discovery, portal sync, activation and health tasks until stop() is called
+        Tasks sleep on events with a timeout, so they cost nothing while idle and
+        react at once when another task has news for them
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.sync_wake = asyncio.Event()
+        self.discovery_wake = asyncio.Event()
+        self.activations = asyncio.Queue()
+        self.running = True
+        
+        for signum, handler in ((signal.SIGTERM, self.stop), (signal.SIGINT, self.stop),
+                                (signal.SIGHUP, self.reload), (signal.SIGUSR1, self.toggle_profiler)):
+            try:
+                self.loop.add_signal_handler(signum, handler)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass  # Not on the main thread, e.g. under tests
+        
+        # Clean up rules duplicated or orphaned by earlier runs
+        await self._call(self.network.reconcile_firewall)
+        
+        # Portal calls that fail are retried from the outbox
+        self.outbox.start()
+        TRACER.observers.append(self.profiler.cycle_done)
+        if self.metrics.port is not None:
+            self.metrics.start()
+        self._sync_health()
+        
+        tasks = [
+            asyncio.ensure_future(self._discovery_task()),
+            asyncio.ensure_future(self._sync_task()),
+            asyncio.ensure_future(self._activation_task()),
+            asyncio.ensure_future(self._address_task()),
+            asyncio.ensure_future(self.health.run())
+        ]
+        await self.stopping.wait()
+        
         logger.info("Stopping Camera Manager Service")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        # Let steps already running finish before their state is written
+        await self.loop.run_in_executor(None, self.executor.shutdown)
+        self.outbox.stop()
+        self.metrics.stop()
+        TRACER.observers.remove(self.profiler.cycle_done)
+        self.profiler.stop()
+        self.network.close()
+        self.portal.close()
+        self.loop = None
+    
+    async def _call(self, func, *args):
+        """Run a blocking call on the service worker threads, within the current trace"""
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(self.executor, context.run, func, *args)
+    
+    def toggle_profiler(self):
+        """Profile the next cycles, or stop a running profile early"""
+        self.profiler.toggle(self.settings.get('profile_cycles', PROFILE_CYCLES))
     
-    def _monitor_loop(self):
-        """Main monitoring loop"""
-        while self.running:
+    @staticmethod
+    async def _wait(event: asyncio.Event, timeout: float):
+        """Sleep until the event is set or the timeout passes"""
+        await wait_event(event, timeout)
+        event.clear()
+    
+    async def _discovery_task(self):
+        """Scan the network, register what is found and rescan periodically"""
+        while True:
             try:
-                # Check for activated cameras from portal
-                activated = self.portal.get_activated_cameras()
-                
-                for camera in activated:
-                    camera_id = camera.get('camera_id')
-                    original_ip = camera.get('original_ip')
-                    
-                    if camera_id and original_ip:
-                        # Check if virtual IP already exists
-                        if camera_id not in self.network.virtual_ips:
-                            # Create virtual IP
-                            virtual_ip = self.network.create_virtual_ip(camera_id)
-                            
-                            if virtual_ip:
-                                # Setup port forwarding
-                                success = self.network.setup_port_forwarding(
-                                    virtual_ip, original_ip
-                                )
-                                
-                                if success:
-                                    logger.info(f"Camera {camera_id} activated and ready at {virtual_ip}")
-                                else:
-                                    logger.error(f"Failed to setup port forwarding for {camera_id}")
+                with TRACER.cycle('discovery'):
+                    stream = RegistrationStream(self.portal, outbox=self.outbox)
+                    stats = await self._call(stream.run, self.discovery.iter_incremental())
+                if stats['registered']:
+                    # New cameras tend to be activated soon after they appear
+                    self.sync_wake.set()
+            except Exception as e:
+                logger.error("Error in discovery: %s", e)
+            await self._wait(self.discovery_wake, DISCOVERY_INTERVAL)
+    
+    async def _sync_task(self):
+        """
+        Poll the portal for activation changes and queue them for (de)activation
+        The interval drops to SYNC_MIN_INTERVAL after a change and doubles up to
+        SYNC_MAX_INTERVAL while nothing changes
+        """
+        interval = SYNC_MIN_INTERVAL
+        reconciled = False
+        while True:
+            with TRACER.cycle('sync'):
+                changes = await self._call(self.portal.poll_activation_changes)
+            if changes is None:
+                interval = max(SYNC_MAX_INTERVAL, self.portal.breaker.retry_after())
+            else:
+                if not reconciled:
+                    # Cameras deactivated while the service was down
+                    changes['removed'] += self.network.stale_cameras(self.portal.activated)
+                    reconciled = True
                 
-                time.sleep(30)  # Check every 30 seconds
+                for camera in changes['changed']:
+                    self.queued_at.setdefault(camera['camera_id'], time.monotonic())
+                    self.activations.put_nowait((camera['camera_id'], camera))
+                for camera_id in changes['removed']:
+                    self.activations.put_nowait((camera_id, None))
                 
+                if changes['changed'] or changes['removed']:
+                    interval = SYNC_MIN_INTERVAL
+                else:
+                    interval = min(SYNC_MAX_INTERVAL, interval * 2)
+            await self._wait(self.sync_wake, interval)
+    
+    async def _activation_task(self):
+        """
+        Activate and tear down queued cameras, taking everything queued so far as one batch
+        Entries are (camera_id, camera), camera None meaning deactivated; the latest
+        entry per camera wins
+        """
+        while True:
+            camera_id, camera = await self.activations.get()
+            pending = {camera_id: camera}
+            while not self.activations.empty():
+                camera_id, camera = self.activations.get_nowait()
+                pending[camera_id] = camera
+            
+            removed = [camera_id for camera_id, camera in pending.items() if camera is None]
+            cameras = [camera for camera in pending.values() if camera is not None]
+            for batch, func in ((removed, self._teardown_batch), (cameras, self._activate_batch)):
+                if not batch:
+                    continue
+                try:
+                    with TRACER.cycle('teardown' if func == self._teardown_batch else 'activation'):
+                        failed = await self._call(func, batch)
+                except Exception as e:
+                    logger.error("Error updating cameras: %s", e)
+                    failed = [c if isinstance(c, str) else c.get('camera_id') for c in batch]
+                for camera_id in failed:
+                    self.loop.call_later(ACTIVATION_RETRY_DELAY, self._retry, camera_id)
+                if func == self._activate_batch:
+                    # Failed cameras keep their queue time, so retries count towards the latency
+                    for camera in cameras:
+                        if camera['camera_id'] not in failed and camera['camera_id'] in self.queued_at:
+                            ACTIVATION_LATENCY.observe(time.monotonic() - self.queued_at.pop(camera['camera_id']))
+            for camera_id in removed:
+                self.queued_at.pop(camera_id, None)
+            self._sync_health()
+    
+    def _sync_health(self):
+        """Health-check exactly the cameras that are forwarded"""
+        self.health.sync({camera_id: (config['camera_ip'], config.get('rtsp_port', RTSP_PORT))
+                          for camera_id, config in list(self.network.virtual_ips.items())
+                          if config.get('camera_ip')})
+    
+    def _retry(self, camera_id: str):
+        """Queue a failed camera again in the state the portal now has it in"""
+        self.activations.put_nowait((camera_id, self.portal.activated.get(camera_id)))
+    
+    async def _address_task(self):
+        """Put back virtual IPs that vanished from their interface, e.g. after a link restart"""
+        while True:
+            await asyncio.sleep(ADDRESS_CHECK_INTERVAL)
+            try:
+                with TRACER.cycle('address'):
+                    missing = await self._call(self.network.missing_virtual_ips)
+                    if missing:
+                        logger.warning("%s virtual IPs disappeared, restoring them", len(missing))
+                        await self._call(self.network.restore_virtual_ips, missing)
             except Exception as e:
-                logger.error(f"Error in monitor loop: {e}")
-                time.sleep(60)
+                logger.error("Error checking virtual IPs: %s", e)
+    
+    def _activate_batch(self, cameras: List[Dict]) -> List[str]:
+        """Activate cameras and report the outcome to the portal, returns failed camera IDs"""
+        results = self.activation.run(cameras)
+        for camera_id, virtual_ip in results.items():
+            if virtual_ip:
+                host, port = self.network.endpoint(camera_id)
+                self.outbox.enqueue_status(camera_id, {'status': 'active', 'virtual_ip': virtual_ip,
+                                                       'endpoint': f"{host}:{port}"})
+        return [camera_id for camera_id, virtual_ip in results.items() if virtual_ip is None]
+    
+    def _teardown_batch(self, camera_ids: List[str]) -> List[str]:
+        """Tear down deactivated cameras, returns the camera IDs that could not be removed"""
+        results = self.network.teardown_cameras(camera_ids)
+        for camera_id, ok in results.items():
+            ACTIVATIONS.inc(action='teardown', result='ok' if ok else 'failed')
+            if ok:
+                self.outbox.enqueue_status(camera_id, {'status': 'deactivated'})
+        return [camera_id for camera_id, ok in results.items() if not ok]
+    
+    def _camera_counts(self) -> Dict[Tuple[str], int]:
+        """Scrape-time camera counts for the metrics endpoint"""
+        counts = {('forwarded',): len(self.network.virtual_ips), ('outbox_pending',): len(self.outbox)}
+        for status in ('online', 'offline', 'unknown'):
+            counts[(status,)] = 0
+        for state in list(self.health.cameras.values()):
+            counts[(state['status'],)] = counts.get((state['status'],), 0) + 1
+        return counts
+    
+    def _relay_totals(self) -> Dict[Tuple[str], float]:
+        """Relay counters summed over all cameras, empty unless forwarding through relays"""
+        if not isinstance(self.network.firewall, RelayForwarder):
+            return {}
+        totals = {}
+        for stats in self.network.firewall.stats().values():
+            for key, value in stats.items():
+                totals[(key,)] = totals.get((key,), 0) + value
+        return totals
+    
+    def _activation_progress(self, camera_id: str, stage: str, ok: bool):
+        """Tell the portal how far a camera got, a later report replaces an unsent one"""
+        if not ok:
+            self.outbox.enqueue_status(camera_id, {'status': 'activation_failed', 'stage': stage})
+        elif stage != 'forward':
+            self.outbox.enqueue_status(camera_id, {'status': 'activating', 'stage': stage})
 
 def setup_systemd_service():
     """Create systemd service file for automatic startup"""
@@ -450,18 +4650,20 @@ def main():
         print("This script must be run as root")
         sys.exit(1)
     
-    # Enable IP forwarding
-    with open('/proc/sys/net/ipv4/ip_forward', 'w') as f:
-        f.write('1')
-    
-    # Start camera manager
-    manager = CameraManager()
-    
+    settings = load_settings()
+    listener = setup_logging(settings)
     try:
+        # Enable IP forwarding, the userspace relay does without it
+        if settings.get('forwarding_mode', FORWARDING_MODE) != 'relay':
+            with open('/proc/sys/net/ipv4/ip_forward', 'w') as f:
+                f.write('1')
+        
+        # Start camera manager, it returns once stopped by SIGTERM or Ctrl+C
+        manager = CameraManager(settings)
         manager.start()
-    except KeyboardInterrupt:
-        manager.stop()
-        print("\nService stopped")
+    finally:
+        listener.stop()
+    print("\nService stopped")
 
 if __name__ == "__main__":
     main()
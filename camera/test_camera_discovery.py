@@ -2,7 +2,236 @@
 # test_camera_discovery.py
 
 import subprocess
+import asyncio
+import contextvars
+import gzip
 import json
+import logging
+import os
+import tempfile
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+import main
+
+class _CameraPage(BaseHTTPRequestHandler):
+    """Slow fake camera web page"""
+    delay = 0.5
+    
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = b"<html><title>IP Camera</title></html>"
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+class _FakeRtspCamera(socketserver.StreamRequestHandler):
+    """Fake camera answering OPTIONS and DESCRIBE, serving a single stream path"""
+    stream_path = "/cam/realmonitor"
+    connections = 0
+    
+    def handle(self):
+        type(self).connections += 1
+        while True:
+            request = []
+            line = self.rfile.readline()
+            while line not in (b"", b"\r\n"):
+                request.append(line.decode().strip())
+                line = self.rfile.readline()
+            if not request:
+                return
+            method, url, _ = request[0].split()
+            cseq = next(h for h in request if h.startswith("CSeq")).split(":")[1].strip()
+            if method == "OPTIONS" or url.endswith(self.stream_path):
+                body = b"v=0\r\n" if method == "DESCRIBE" else b""
+                status = "200 OK"
+            else:
+                body, status = b"", "404 Not Found"
+            self.wfile.write(f"RTSP/1.0 {status}\r\nCSeq: {cseq}\r\n"
+                             f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+
+class _ClosingRtspCamera(socketserver.StreamRequestHandler):
+    """Fake camera answering a fixed number of requests per connection, then hanging up"""
+    answers = 1
+    connections = 0
+    
+    def handle(self):
+        type(self).connections += 1
+        for _ in range(self.answers):
+            request = []
+            line = self.rfile.readline()
+            while line not in (b"", b"\r\n"):
+                request.append(line.decode().strip())
+                line = self.rfile.readline()
+            cseq = next(h for h in request if h.startswith("CSeq")).split(":")[1].strip()
+            self.wfile.write(f"RTSP/1.0 200 OK\r\nCSeq: {cseq}\r\n\r\n".encode())
+
+class _StubPortal(BaseHTTPRequestHandler):
+    """Stub portal serving activated cameras with ETags and a since cursor"""
+    protocol_version = "HTTP/1.1"
+    version = 1
+    cameras = {"cam-1": {'camera_id': "cam-1", 'original_ip': "10.0.0.5"}}
+    removed = []
+    requests_seen = []
+    connections = 0
+    posts = 0
+    post_status = 200
+    
+    def setup(self):
+        type(self).connections += 1
+        super().setup()
+    
+    def do_GET(self):
+        portal = type(self)
+        portal.requests_seen.append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == f'"v{portal.version}"':
+            self.send_response(304)
+            self.send_header('Content-Length', "0")
+            self.end_headers()
+            return
+        
+        if "since=" in self.path:
+            body = {'delta': True, 'activated_cameras': [portal.cameras["cam-2"]],
+                    'removed': portal.removed}
+        else:
+            body = {'activated_cameras': list(portal.cameras.values())}
+        body['cursor'] = str(portal.version)
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('ETag', f'"v{portal.version}"')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        type(self).posts += 1
+        if self.post_status != 200:
+            self.send_response(self.post_status)
+            self.send_header('Content-Length', "0")
+            self.end_headers()
+            return
+        if self.headers.get('Content-Encoding') == "gzip":
+            body = gzip.decompress(body)
+        body = json.loads(body)
+        if self.path.endswith("/status"):
+            type(self).statuses.extend(body['statuses'])
+        else:
+            type(self).registrations.append((time.monotonic(), body['cameras']))
+        self.send_response(200)
+        self.send_header('Content-Length', "0")
+        self.end_headers()
+    
+    registrations = []
+    statuses = []
+    
+    @classmethod
+    def reset(cls):
+        """Forget what earlier tests served and recorded"""
+        cls.version = 1
+        cls.cameras = {"cam-1": {'camera_id': "cam-1", 'original_ip': "10.0.0.5"}}
+        cls.removed = []
+        cls.requests_seen = []
+        cls.connections = 0
+        cls.posts = 0
+        cls.post_status = 200
+        cls.registrations = []
+        cls.statuses = []
+    
+    def log_message(self, *args):
+        pass
+
+def _start_server(handler):
+    """Start a local HTTP server in the background, returns (server, port)"""
+    server = ThreadingHTTPServer(('0.0.0.0', 0), handler)
+    server.request_queue_size = 128
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+class _Echo(socketserver.BaseRequestHandler):
+    """Echoes everything back until the client closes"""
+    
+    def handle(self):
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            self.request.sendall(data)
+
+class _EchoServer(socketserver.ThreadingTCPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+class _SyntheticCamera:
+    """RTSP camera streaming synthetic H.264 over interleaved TCP, a keyframe group every gop packets"""
+    SDP = ("v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=synthetic\r\nt=0 0\r\n"
+           "m=video 0 RTP/AVP 96\r\na=rtpmap:96 H264/90000\r\na=control:trackID=1\r\n")
+    # SPS, PPS, first and middle IDR fragments, then P slices
+    NALS = [b"\x67", b"\x68", b"\x7c\x85", b"\x7c\x05"]
+    
+    def __init__(self, gop=30, payload_size=1000, authorization=None):
+        self.gop = gop
+        self.payload_size = payload_size
+        self.authorization = authorization  # Required Authorization header, if any
+        self.sessions = 0
+    
+    async def handle(self, reader, writer):
+        while True:
+            request_line, headers, _ = await main.read_rtsp_message(reader)
+            method = request_line.split()[0]
+            body, extra = b"", ""
+            if self.authorization and headers.get('authorization') != self.authorization:
+                writer.write(f"RTSP/1.0 401 Unauthorized\r\nCSeq: {headers['cseq']}\r\n"
+                             f'WWW-Authenticate: Basic realm="camera"\r\n\r\n'.encode())
+                continue
+            if method == "DESCRIBE":
+                body, extra = self.SDP.encode(), "Content-Type: application/sdp\r\n"
+            elif method == "SETUP":
+                extra = "Session: 42\r\nTransport: RTP/AVP/TCP;unicast;interleaved=0-1\r\n"
+            writer.write(f"RTSP/1.0 200 OK\r\nCSeq: {headers['cseq']}\r\n{extra}"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            if method == "PLAY":
+                self.sessions += 1
+                await self.stream(writer)
+                return
+    
+    async def stream(self, writer):
+        seq = 0
+        try:
+            while True:
+                position = seq % self.gop
+                nal = self.NALS[position] if position < len(self.NALS) else b"\x41"
+                rtp = struct.pack('!BBHII', 0x80, 96, seq & 0xffff, seq * 3000, 1234) + nal
+                rtp += bytes(self.payload_size - len(rtp))
+                writer.write(b"$\x00" + struct.pack('!H', len(rtp)) + rtp)
+                await writer.drain()
+                seq += 1
+                await asyncio.sleep(0.001)
+        except ConnectionError:
+            pass
+
+class _FlakyNftables(main.NftablesFirewall):
+    """Dry-run nftables rejecting any script that mentions a bad camera"""
+    
+    def __init__(self, bad):
+        super().__init__(dry_run=True)
+        self.bad = bad
+    
+    def run_script(self, script):
+        if self.bad in script:
+            return False
+        return super().run_script(script)
 
 def test_network_scan():
     """Test network scanning"""
@@ -45,11 +274,1078 @@ def test_virtual_ip():
     # Cleanup
     subprocess.run(f"sudo ip addr del {test_ip}/24 dev eth0 label eth0:test", shell=True)
 
+def test_concurrent_probe():
+    """Test that probing time follows the slowest host, not the sum"""
+    print("\nTesting concurrent camera probing...")
+    
+    server, port = _start_server(_CameraPage)
+    hosts = [{'ip': f"127.0.0.{i}", 'mac': f"00:40:8c:00:00:{i:02x}", 'vendor': 'Axis'}
+             for i in range(1, 31)]
+    
+    engine = main.ProbeEngine(ports=[port], timeout=2, deadline=10)
+    started = time.monotonic()
+    cameras = engine.probe_hosts(hosts)
+    elapsed = time.monotonic() - started
+    server.shutdown()
+    
+    print(f"  Probed {len(cameras)} hosts in {elapsed:.2f}s")
+    assert [c['ip'] for c in cameras] == [h['ip'] for h in hosts]
+    assert all(c['model'] == 'Generic IP Camera' for c in cameras)
+    assert elapsed < len(hosts) * _CameraPage.delay / 4
+    print("✓ Hosts probed in parallel")
+
+ARP_RECORDING = [
+    "Interface: eth0, type: EN10MB, MAC: 02:00:00:00:00:01, IPv4: 127.0.0.1",
+    "Starting arp-scan 1.9.7 with 256 hosts (https://github.com/royhills/arp-scan)",
+    "127.0.0.11\t44:19:b6:00:00:01\tHangzhou Hikvision Digital Technology Co.,Ltd.",
+    "127.0.0.12\t3c:ef:8c:00:00:02\tZhejiang Dahua Technology Co., Ltd.",
+    "127.0.0.13\t00:11:22:33:44:55\tSome Printer Vendor",
+    "",
+    "Ending arp-scan 1.9.7: 256 hosts scanned in 1.912 seconds (133.89 hosts/sec). 3 responded"
+]
+
+def test_recorded_arp_scan():
+    """Test discovery against a recorded arp-scan sweep"""
+    print("\nTesting discovery with recorded ARP replies...")
+    
+    discovery = main.CameraDiscovery(
+        probe_engine=main.ProbeEngine(ports=[9], timeout=0.5, deadline=5),
+        arp_backend=main.RecordedArpBackend(ARP_RECORDING)
+    )
+    cameras = discovery.scan_local_network("eth0")
+    
+    print(f"  Found {[c['ip'] for c in cameras]}")
+    assert [c['ip'] for c in cameras] == ["127.0.0.11", "127.0.0.12"]
+    assert cameras[0]['mac'] == "44:19:b6:00:00:01"
+    print("✓ Recorded sweep parsed and filtered")
+
+def test_vendor_index():
+    """Test camera classification by MAC prefix"""
+    print("\nTesting OUI vendor index...")
+    
+    index = main.VendorIndex.from_settings({
+        'camera_ouis': {"02:AA:BB": "Lab Camera"},
+        'camera_vendors': ["reolink"],
+        'oui_file': "/nonexistent/oui.txt"
+    })
+    
+    assert index.classify("44:19:b6:00:00:01") == "Hangzhou Hikvision Digital Technology Co.,Ltd."
+    assert index.classify("02-aa-bb-00-00-01") == "Lab Camera"
+    assert index.classify("00:11:22:33:44:55", "Reolink Innovation Ltd") == "Reolink Innovation Ltd"
+    assert index.classify("00:11:22:33:44:55", "Some Printer Vendor") is None
+    assert index.classify("00:11:22:33:44:55") is None
+    print("✓ Cameras classified without vendor names")
+
+def test_incremental_scan():
+    """Test that rescans only probe new or changed cameras"""
+    print("\nTesting incremental discovery...")
+    
+    discovery = main.CameraDiscovery(
+        probe_engine=main.ProbeEngine(ports=[9], timeout=0.5, deadline=5),
+        arp_backend=main.RecordedArpBackend(ARP_RECORDING),
+        probe_cache=main.ProbeCache(path=None)
+    )
+    cameras, delta = discovery.scan_incremental("eth0")
+    assert len(cameras) == 2 and len(delta['added']) == 2
+    
+    # Same sweep again: nothing to probe, nothing changed
+    cameras, delta = discovery.scan_incremental("eth0")
+    assert len(cameras) == 2
+    assert not delta['added'] and not delta['changed'] and not delta['removed']
+    
+    # Hikvision moved to a new address and Dahua went away
+    discovery.arp_backend = main.RecordedArpBackend(
+        ["127.0.0.21\t44:19:b6:00:00:01\tHangzhou Hikvision Digital Technology Co.,Ltd."]
+    )
+    cameras, delta = discovery.scan_incremental("eth0")
+    assert [c['ip'] for c in delta['changed']] == ["127.0.0.21"]
+    assert [c['mac'] for c in delta['removed']] == ["3c:ef:8c:00:00:02"]
+    print("✓ Deltas reported from the probe cache")
+    
+    # Cut-off probes are not cached and unidentified hosts only briefly
+    cache = main.ProbeCache(path=None, retry_ttl=-1)
+    probed = {'ip': "127.0.0.31", 'vendor': "Axis", 'model': "Unknown", 'rtsp_url': None}
+    cache.store(dict(probed, mac="00:40:8c:00:00:01", probe_latency=None))
+    cache.store(dict(probed, mac="00:40:8c:00:00:02", probe_latency=0.2))
+    cache.store(dict(probed, mac="00:40:8c:00:00:03", probe_latency=0.2, model="P1375"))
+    assert "00:40:8c:00:00:01" not in cache.entries
+    assert cache.lookup("00:40:8c:00:00:02", "127.0.0.31") is None
+    assert cache.lookup("00:40:8c:00:00:03", "127.0.0.31") is not None
+    print("✓ Only finished, identified probes cached for the full TTL")
+
+def test_rtsp_path_discovery():
+    """Test RTSP path discovery against a fake camera"""
+    print("\nTesting RTSP path discovery...")
+    
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _FakeRtspCamera)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    
+    prober = main.RtspProber(port=port, timeout=2)
+    url = prober.find_stream("127.0.0.1", "Dahua", "Generic IP Camera")
+    print(f"  Found {url} over {_FakeRtspCamera.connections} connection(s)")
+    assert url == f"rtsp://127.0.0.1:{port}/cam/realmonitor"
+    assert _FakeRtspCamera.connections == 1
+    
+    # Cameras of the same type try the remembered path first
+    assert prober.candidates("Dahua", "Generic IP Camera")[0] == "/cam/realmonitor"
+    assert prober.find_stream("127.0.0.1", "Other", "Unknown") is not None
+    
+    server.shutdown()
+    server.server_close()
+    assert main.RtspProber(port=port, timeout=1).find_stream("127.0.0.1") is None
+    print("✓ Working RTSP path found and remembered")
+    
+    # A kept-alive connection the camera closed is reopened, a failed new one is not
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _ClosingRtspCamera)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection = main.RtspConnection("127.0.0.1", server.server_address[1], timeout=2)
+    assert connection.request("OPTIONS", "*") == 200
+    time.sleep(0.05)  # Let the camera hang up
+    assert connection.request("OPTIONS", "*") == 200
+    assert _ClosingRtspCamera.connections == 2
+    _ClosingRtspCamera.answers = 0
+    connection.close()
+    assert connection.request("OPTIONS", "*") is None
+    assert _ClosingRtspCamera.connections == 3
+    _ClosingRtspCamera.answers = 1
+    server.shutdown()
+    server.server_close()
+    print("✓ Closed keep-alive connections retried once, failed connections not retried")
+
+IPTABLES_SAVE = """*nat
+:PREROUTING ACCEPT [0:0]
+-A PREROUTING -d 192.168.1.200/32 -p tcp -m tcp --dport 554 -j DNAT --to-destination 10.0.0.5:554
+-A PREROUTING -d 192.168.1.200/32 -p tcp -m tcp --dport 554 -j DNAT --to-destination 10.0.0.5:554
+-A PREROUTING -d 192.168.1.209/32 -p tcp -m tcp --dport 554 -m comment --comment camera_portal -j DNAT --to-destination 10.0.0.9:554
+-A POSTROUTING -s 10.0.0.5/32 -j MASQUERADE
+-A POSTROUTING -s 172.17.0.0/16 -j MASQUERADE
+COMMIT
+*filter
+:FORWARD ACCEPT [0:0]
+-A FORWARD -d 10.0.0.5/32 -p tcp -m tcp --dport 554 -m comment --comment camera_portal -j ACCEPT
+COMMIT
+"""
+
+class _RecordedIptables(main.IptablesFirewall):
+    """Firewall reading a recorded iptables-save dump instead of the kernel"""
+    
+    def current_rules(self, known_keys=None):
+        original = main.run_command
+        main.run_command = lambda cmd, input=None: subprocess.CompletedProcess(cmd, 0, IPTABLES_SAVE, "")
+        try:
+            return super().current_rules(known_keys)
+        finally:
+            main.run_command = original
+
+def test_firewall_reconcile():
+    """Test that reconciling only touches duplicate, orphaned and missing rules"""
+    print("\nTesting firewall reconciliation...")
+    
+    report = _RecordedIptables().reconcile([("192.168.1.200", "10.0.0.5", 554)], dry_run=True)
+    
+    assert len(report['duplicates']) == 1 and "10.0.0.5:554" in report['duplicates'][0][1]
+    assert len(report['orphaned']) == 1 and "10.0.0.9:554" in report['orphaned'][0][1]
+    assert report['missing'] == [("filter", "FORWARD -s 10.0.0.5/32 -p tcp -m tcp --sport 554 "
+                                            "-m comment --comment camera_portal -j ACCEPT")]
+    print("✓ Only the difference would be changed")
+
+def test_iptables_apply():
+    """Test that a failed batch falls back to one transaction per camera"""
+    print("\nTesting iptables batch fallback...")
+    
+    scripts = []
+    
+    def run_command(cmd, input=None):
+        if cmd[1] == "iptables-save":
+            return subprocess.CompletedProcess(cmd, 0, IPTABLES_SAVE, "")
+        scripts.append(input)
+        failed = "10.0.0.7" in input
+        return subprocess.CompletedProcess(cmd, int(failed), "", "iptables-restore: line 2 failed" if failed else "")
+    
+    original = main.run_command
+    main.run_command = run_command
+    try:
+        results = main.IptablesFirewall().apply_forwarding([
+            ("192.168.1.200", "10.0.0.5", 554),
+            ("192.168.1.201", "10.0.0.6", 554),
+            ("192.168.1.202", "10.0.0.7", 554)
+        ])
+    finally:
+        main.run_command = original
+    
+    assert results == {"192.168.1.200": True, "192.168.1.201": True, "192.168.1.202": False}
+    batch, *single = scripts
+    assert len(single) == 3 and all(ip in batch for ip in ("10.0.0.5", "10.0.0.6", "10.0.0.7"))
+    assert [sum(1 for ip in ("10.0.0.5", "10.0.0.6", "10.0.0.7") if ip in s) for s in single] == [1, 1, 1]
+    
+    # The rule already in place is not appended again
+    assert single[0].count("-A ") == 3 and "FORWARD -d 10.0.0.5/32" not in single[0]
+    print("✓ Failed batch retried per camera, only the bad camera failed")
+
+def test_nftables_render():
+    """Test the nftables ruleset without root"""
+    print("\nTesting nftables dry-run rendering...")
+    
+    firewall = main.NftablesFirewall(dry_run=True)
+    report = firewall.reconcile([("192.168.1.200", "10.0.0.5", 554)])
+    ruleset = firewall.scripts[-1]
+    assert report['applied'] and len(report['missing']) == 1
+    assert "192.168.1.200 . 554 : 10.0.0.5 . 554" in ruleset
+    assert "dnat to ip daddr . tcp dport map @rtsp_dnat" in ruleset
+    
+    # Adding a camera is a single element update, not a new rule
+    assert firewall.apply_forwarding([("192.168.1.201", "10.0.0.6", 554)]) == {"192.168.1.201": True}
+    assert "chain" not in firewall.scripts[-1]
+    assert "add element ip camera_portal rtsp_dnat { 192.168.1.201 . 554 : 10.0.0.6 . 554 }" in firewall.scripts[-1]
+    print("✓ Ruleset rendered with DNAT map")
+
+def test_virtual_ip_allocator():
+    """Test that released virtual IPs are reused and pools never overflow"""
+    print("\nTesting virtual IP allocator...")
+    
+    allocator = main.VirtualIpAllocator({'eth0': ["10.20.0.0/29", "192.168.1.250-192.168.1.251"]})
+    allocator.rebuild({
+        'cam-a': {'virtual_ip': "10.20.0.1", 'base_interface': "eth0"},
+        'cam-b': {'virtual_ip': "10.20.0.3", 'base_interface': "eth0"}
+    })
+    
+    first = allocator.allocate("eth0")
+    assert first == ("10.20.0.2", 29, "eth0:cam1")
+    allocator.release("eth0", "10.20.0.1")
+    assert allocator.allocate("eth0")[0] == "10.20.0.1"
+    
+    addresses = [allocator.allocate("eth0") for _ in range(7)]
+    assert [a[0] for a in addresses[:4]] == ["10.20.0.4", "10.20.0.5", "10.20.0.6", "192.168.1.250"]
+    assert addresses[-1] is None
+    assert len({a[2] for a in addresses if a}) == 5
+    print("✓ Addresses reused and exhaustion reported")
+
+# Stand-in for `ip -force -batch -`: lines naming device fail0 fail, device crash0 ends the process
+FAKE_IP_BATCH = """
+import sys
+for number, line in enumerate(sys.stdin, 1):
+    if "crash0" in line:
+        sys.exit(1)
+    if "fail0" in line or "cpsync" in line:
+        print(f"Cannot run {line.strip()}", file=sys.stderr)
+        print(f"Command failed -:{number}", file=sys.stderr, flush=True)
+"""
+
+class _UnlistedIpBatch(main.IpBatchAddresses):
+    """Batch backend whose devices never list any address"""
+    
+    def list_addresses(self, device):
+        return {}
+
+def test_ip_batch_channel():
+    """Test that address changes share one ip -batch process, which is restarted when it exits"""
+    print("\nTesting long-lived ip -batch process...")
+    
+    addresses = _UnlistedIpBatch(command=[sys.executable, "-c", FAKE_IP_BATCH], timeout=5)
+    try:
+        assert addresses.add_addresses([("10.20.0.1", 24, "eth0", "eth0:cam1"),
+                                        ("10.20.0.2", 24, "fail0", "fail0:cam2")]) == {
+            "10.20.0.1": True, "10.20.0.2": False}
+        process = addresses.process
+        assert addresses.remove_addresses([("10.20.0.1", 24, "eth0", "eth0:cam1")]) == {"10.20.0.1": True}
+        assert addresses.process is process and process.poll() is None
+        print("✓ Change sets sent to one process, failed lines attributed")
+        
+        assert addresses.add_addresses([("10.20.0.3", 24, "crash0", "crash0:cam3")]) == {"10.20.0.3": False}
+        assert addresses.add_addresses([("10.20.0.4", 24, "eth0", "eth0:cam4")]) == {"10.20.0.4": True}
+        assert addresses.process is not process and process.poll() is not None
+        print("✓ Exited process restarted for the next change set")
+    finally:
+        addresses.close()
+    assert addresses.process is None
+
+def _network_manager(addresses, **settings):
+    """NetworkManager keeping its state in a temporary directory"""
+    original = main.CONFIG_FILE
+    main.CONFIG_FILE = os.path.join(tempfile.mkdtemp(), "config.json")
+    try:
+        return main.NetworkManager({'virtual_ip_pools': {'eth0': ["10.20.0.0/24"]}, **settings},
+                                   addresses=addresses)
+    finally:
+        main.CONFIG_FILE = original
+
+def test_bulk_addresses():
+    """Test bulk virtual IP management against the in-memory backend"""
+    print("\nTesting bulk address management...")
+    
+    addresses = main.FakeAddresses(fail=["10.20.0.3"])
+    network = _network_manager(addresses)
+    created = network.create_virtual_ips([f"cam-{i}" for i in range(5)])
+    
+    assert addresses.round_trips == 1
+    assert created["cam-2"] is None and len(network.virtual_ips) == 4
+    assert network.missing_virtual_ips() == []
+    
+    # The failed address went back to the pool and is handed out again
+    addresses.fail.clear()
+    assert network.create_virtual_ip("cam-9") == "10.20.0.3"
+    
+    network.remove_virtual_ips(["cam-0", "cam-1"])
+    assert sorted(addresses.list_addresses("eth0")) == ["10.20.0.3", "10.20.0.4", "10.20.0.5"]
+    print("✓ Addresses added and removed in bulk")
+    
+    # Relays sharing one address never configure virtual IPs, so none go missing
+    shared = _network_manager(None, forwarding_mode='relay', relay_bind="127.0.0.1")
+    assert isinstance(shared.addresses, main.NullAddresses)
+    assert shared.create_virtual_ips(["cam-0", "cam-1"]) == {"cam-0": "10.20.0.1", "cam-1": "10.20.0.2"}
+    assert shared.missing_virtual_ips() == []
+    print("✓ Shared-address relays skip address reconciliation")
+
+def test_state_store():
+    """Test that state changes are coalesced and survive a reload"""
+    print("\nTesting state stores...")
+    
+    for backend in ("json", "journal"):
+        path = os.path.join(tempfile.mkdtemp(), "config.json")
+        with open(path, 'w') as f:
+            json.dump({'portal_api_url': "https://portal.example.com"}, f)
+        
+        store = main.STATE_BACKENDS[backend](path, flush_interval=60)
+        state = store.load()
+        for i in range(500):
+            state[f"cam-{i}"] = {'virtual_ip': f"10.20.{i // 250}.{i % 250 + 1}"}
+            store.record([f"cam-{i}"])
+        del state["cam-7"]
+        store.record(["cam-7"])
+        store.close()
+        
+        assert store.writes == 1
+        reloaded = main.STATE_BACKENDS[backend](path).load()
+        assert len(reloaded) == 499 and "cam-7" not in reloaded
+        with open(path) as f:
+            assert json.load(f).get('portal_api_url') == "https://portal.example.com"
+        print(f"✓ {backend} store wrote 500 changes in {store.writes} write")
+    
+    # A failed background write is logged and retried
+    blocker = os.path.join(tempfile.mkdtemp(), "not-a-directory")
+    open(blocker, 'w').close()
+    store = main.JsonStateStore(os.path.join(blocker, "config.json"), flush_interval=0.05)
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    main.logger.addHandler(handler)
+    try:
+        store.load()["cam-1"] = {'virtual_ip': "10.20.0.1"}
+        store.record(["cam-1"])
+        deadline = time.monotonic() + 5
+        while not records and time.monotonic() < deadline:
+            time.sleep(0.01)
+        store.path = os.path.join(os.path.dirname(blocker), "config.json")
+        while store.dirty and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        main.logger.removeHandler(handler)
+        store.close()
+    assert records and records[0].exc_info and "retrying" in records[0].getMessage()
+    with open(store.path) as f:
+        assert json.load(f)['virtual_ips'] == {"cam-1": {'virtual_ip': "10.20.0.1"}}
+    print("✓ Failed background write logged and retried")
+
+def test_activation_delta_sync():
+    """Test conditional polling of activated cameras"""
+    print("\nTesting activation delta sync...")
+    
+    _StubPortal.reset()
+    server, port = _start_server(_StubPortal)
+    portal = main.PortalClient(f"http://127.0.0.1:{port}", "test-key")
+    
+    changes = portal.poll_activation_changes()
+    assert [c['camera_id'] for c in changes['changed']] == ["cam-1"]
+    
+    # Nothing changed: the portal answers 304 and nothing is touched
+    assert portal.poll_activation_changes() == {'changed': [], 'removed': []}
+    assert _StubPortal.requests_seen[-1][1] == '"v1"'
+    
+    _StubPortal.version = 2
+    _StubPortal.cameras["cam-2"] = {'camera_id': "cam-2", 'original_ip': "10.0.0.6"}
+    _StubPortal.removed = ["cam-1"]
+    changes = portal.poll_activation_changes()
+    assert "since=1" in _StubPortal.requests_seen[-1][0]
+    assert [c['camera_id'] for c in changes['changed']] == ["cam-2"]
+    assert changes['removed'] == ["cam-1"]
+    assert list(portal.activated) == ["cam-2"]
+    
+    server.shutdown()
+    portal.close()
+    print("✓ Only changed cameras reported")
+
+def test_portal_session():
+    """Test that portal calls share one keep-alive connection, record timings and never replay POSTs"""
+    print("\nTesting pooled portal session...")
+    
+    _StubPortal.reset()
+    server, port = _start_server(_StubPortal)
+    portal = main.PortalClient(f"http://127.0.0.1:{port}", "test-key")
+    try:
+        assert portal.get_activated_cameras()
+        assert portal.get_activated_cameras()
+        assert portal.register_cameras([{'ip': "10.0.0.5", 'mac': "00:40:8c:00:00:01"}])
+        assert _StubPortal.connections == 1
+        print("✓ Three calls over one connection")
+        
+        timing = portal.timings["/api/cameras/activated"]
+        assert timing['method'] == 'GET' and timing['status'] == 304
+        assert timing['total'] >= timing['elapsed']
+        assert portal.timings["/api/cameras/register"]['status'] == 200
+        assert timing['connections'] == 0 and timing['connect'] == 0
+        portal.session.close()  # Drop the pooled connection
+        assert portal.get_activated_cameras()
+        reconnected = portal.timings["/api/cameras/activated"]
+        assert reconnected['connections'] == 1 and 0 < reconnected['connect'] <= reconnected['elapsed']
+        print(f"✓ Timings recorded, new connection took {reconnected['connect'] * 1000:.2f} ms")
+        
+        _StubPortal.post_status = 503
+        sent = _StubPortal.posts
+        assert not portal.register_cameras([{'ip': "10.0.0.5", 'mac': "00:40:8c:00:00:01"}])
+        assert _StubPortal.posts == sent + 1
+        print("✓ Failed POST not replayed")
+    finally:
+        portal.close()
+        server.shutdown()
+
+def test_streaming_registration():
+    """Test that cameras reach the portal while discovery is still running"""
+    print("\nTesting streaming registration...")
+    
+    _StubPortal.reset()
+    server, port = _start_server(_StubPortal)
+    portal = main.PortalClient(f"http://127.0.0.1:{port}", "test-key")
+    finished = {}
+    
+    def discovery():
+        for i in range(7):
+            yield {'ip': f"10.0.0.{i}", 'mac': f"44:19:b6:00:00:{i:02x}"}
+        time.sleep(1)
+        yield {'ip': "10.0.0.99", 'mac': "44:19:b6:00:00:99"}
+        finished['at'] = time.monotonic()
+    
+    stats = main.RegistrationStream(portal, chunk_size=5, window=0.2).run(discovery())
+    server.shutdown()
+    portal.close()
+    
+    chunks = [cameras for _, cameras in _StubPortal.registrations]
+    assert stats == {'registered': 8, 'failed': 0, 'chunks': 3}
+    assert [len(c) for c in chunks] == [5, 2, 1]
+    assert _StubPortal.registrations[1][0] < finished['at']
+    print("✓ Early cameras registered before discovery finished")
+
+def test_portal_outbox():
+    """Test that queued portal calls survive an outage and are deduplicated"""
+    print("\nTesting portal outbox...")
+    
+    path = os.path.join(tempfile.mkdtemp(), "outbox.json")
+    down = main.PortalClient("http://127.0.0.1:9", "test-key", retries=0)
+    down.breaker = main.CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    outbox = main.Outbox(down, path=path)
+    
+    outbox.enqueue_registration([{'ip': "10.0.0.1", 'mac': "44:19:b6:00:00:01"},
+                                 {'ip': "10.0.0.2", 'mac': "44:19:b6:00:00:02"}])
+    outbox.enqueue_registration([{'ip': "10.0.0.9", 'mac': "44:19:b6:00:00:01"}])
+    outbox.enqueue_status("cam-1", {'status': "activation_failed"})
+    outbox.enqueue_status("cam-1", {'status': "active", 'virtual_ip': "192.168.100.10"})
+    assert len(outbox) == 3
+    assert len(main.Outbox(down, path=path)) == 3  # On disk before enqueue returned
+    
+    # The portal is down: the breaker opens and further flushes make no calls
+    assert outbox.flush_once() > 0
+    assert down.breaker.state == 'open'
+    started = time.monotonic()
+    assert outbox.flush_once() > 0
+    assert time.monotonic() - started < 0.1
+    outbox.stop()
+    down.close()
+    print("✓ Calls paused while the portal is down")
+    
+    _StubPortal.reset()
+    server, port = _start_server(_StubPortal)
+    portal = main.PortalClient(f"http://127.0.0.1:{port}", "test-key")
+    outbox = main.Outbox(portal, path=path)
+    assert len(outbox) == 3
+    assert outbox.flush_once() == main.OUTBOX_IDLE_WAIT
+    outbox.stop()
+    server.shutdown()
+    portal.close()
+    
+    assert len(outbox) == 0 and len(main.Outbox(portal, path=path)) == 0
+    sent = _StubPortal.registrations[-1][1]
+    assert sorted(c['ip'] for c in sent) == ["10.0.0.2", "10.0.0.9"]
+    assert _StubPortal.statuses == [{'status': "active", 'virtual_ip': "192.168.100.10",
+                                     'camera_id': "cam-1",
+                                     'reported_at': _StubPortal.statuses[0]['reported_at']}]
+    print("✓ Queued calls delivered after restart, superseded entries dropped")
+
+def test_settings_reload():
+    """Test that a reload applies reloadable settings and flags the others"""
+    print("\nTesting settings reload...")
+    
+    network = _network_manager(main.FakeAddresses())
+    portal = main.PortalClient("http://127.0.0.1:9", "test-key")
+    manager = main.CameraManager(
+        settings={'metrics_port': 0}, network=network, portal=portal,
+        discovery=main.CameraDiscovery(arp_backend=main.RecordedArpBackend([])),
+        outbox=main.Outbox(portal, path=os.path.join(tempfile.mkdtemp(), "outbox.json"))
+    )
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    main.logger.addHandler(handler)
+    original = main.CONFIG_FILE
+    main.CONFIG_FILE = os.path.join(tempfile.mkdtemp(), "config.json")
+    try:
+        with open(main.CONFIG_FILE, 'w') as f:
+            json.dump({'metrics_port': 0, 'verify_activations': True, 'camera_ouis': {"02:AA:BB": "Lab Camera"},
+                       'forwarding_mode': 'relay'}, f)
+        manager.reload()
+    finally:
+        main.CONFIG_FILE = original
+        main.logger.removeHandler(handler)
+        manager.executor.shutdown()
+        portal.close()
+    
+    assert manager.activation.verify
+    assert manager.discovery.vendor_index.classify("02:aa:bb:00:00:01") == "Lab Camera"
+    warnings = [r.getMessage() for r in records if r.levelno == logging.WARNING]
+    assert warnings == ["Settings forwarding_mode changed, restart the service to apply them"]
+    print("✓ Reloadable settings applied, forwarding_mode flagged for a restart")
+
+def test_service_loop():
+    """Test that the service tasks activate cameras right away and shut down cleanly"""
+    print("\nTesting service event loop...")
+    
+    network = _network_manager(main.FakeAddresses())
+    network.firewall = main.NftablesFirewall(dry_run=True)
+    _StubPortal.reset()
+    server, port = _start_server(_StubPortal)
+    portal = main.PortalClient(f"http://127.0.0.1:{port}", "test-key")
+    manager = main.CameraManager(
+        settings={'metrics_port': 0}, network=network, portal=portal,
+        discovery=main.CameraDiscovery(arp_backend=main.RecordedArpBackend([])),
+        outbox=main.Outbox(portal, path=os.path.join(tempfile.mkdtemp(), "outbox.json"))
+    )
+    
+    started = time.monotonic()
+    service = threading.Thread(target=manager.start)
+    service.start()
+    while "cam-1" not in network.virtual_ips and time.monotonic() - started < 5:
+        time.sleep(0.01)
+    latency = time.monotonic() - started
+    scrape = requests.get(f"http://127.0.0.1:{manager.metrics.server.server_address[1]}/metrics", timeout=5)
+    
+    manager.stop()
+    service.join(5)
+    server.shutdown()
+    
+    assert network.virtual_ips["cam-1"]['camera_ip'] == "10.0.0.5"
+    assert latency < 1
+    assert not service.is_alive()
+    print(f"✓ Camera activated {latency * 1000:.0f} ms after start, service stopped cleanly")
+    
+    assert scrape.status_code == 200
+    assert f'camera_portal_cameras{{state="forwarded"}} {len(network.virtual_ips)}' in scrape.text
+    assert 'camera_portal_portal_responses_total{endpoint="/api/cameras/activated",status="200"}' in scrape.text
+    assert manager.metrics.server is None
+    print("✓ Metrics endpoint served while running and closed on stop")
+
+def test_metrics_registry():
+    """Test Prometheus rendering of counters, gauges and histograms"""
+    print("\nTesting metrics registry...")
+    
+    registry = main.MetricsRegistry()
+    counter = registry.counter("test_requests_total", "Requests", ('path',))
+    counter.inc(path="/a")
+    counter.inc(2, path='/"b"')
+    assert registry.counter("test_requests_total", "Requests", ('path',)) is counter
+    registry.gauge("test_queue", "Queue length", function=lambda: 7)
+    histogram = registry.histogram("test_seconds", "Durations", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+    with histogram.time():
+        pass
+    
+    lines = registry.render().splitlines()
+    assert "# TYPE test_requests_total counter" in lines
+    assert 'test_requests_total{path="/a"} 1' in lines
+    assert 'test_requests_total{path="/\\"b\\""} 2' in lines
+    assert "test_queue 7" in lines
+    assert 'test_seconds_bucket{le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{le="1.0"} 3' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 4' in lines
+    assert "test_seconds_count 4" in lines
+    print("✓ Labels escaped, histogram buckets cumulative")
+    
+    metrics = main.MetricsServer(registry, port=0)
+    port = metrics.start()
+    try:
+        assert "test_queue 7" in requests.get(f"http://127.0.0.1:{port}/metrics", timeout=5).text
+        assert requests.get(f"http://127.0.0.1:{port}/other", timeout=5).status_code == 404
+    finally:
+        metrics.stop()
+    print("✓ Registry scraped over HTTP")
+
+def test_rtsp_fanout():
+    """Test that viewers share one camera session, start at a keyframe and slow ones are dropped"""
+    print("\nTesting RTSP fan-out...")
+    
+    async def scenario():
+        camera = _SyntheticCamera()
+        server = await asyncio.start_server(camera.handle, '127.0.0.1', 0)
+        relay = main.FanoutRelay(buffer_size=256 * 1024, client_limit=128 * 1024, socket_buffer=32 * 1024)
+        bound = await relay.add_route(('127.0.0.1', 0), server.sockets[0].getsockname())
+        url = f"rtsp://127.0.0.1:{bound[1]}/stream"
+        
+        async def viewer(rcvbuf=None):
+            sock = socket.socket()
+            if rcvbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            sock.connect(bound)
+            reader, writer = await asyncio.open_connection(sock=sock)
+            for cseq, (method, target, extra) in enumerate([
+                    ("DESCRIBE", url, ""),
+                    ("SETUP", url + "/trackID=1", "Transport: RTP/AVP/TCP;unicast;interleaved=0-1\r\n"),
+                    ("PLAY", url, "Session: 1\r\n")], 1):
+                writer.write(f"{method} {target} RTSP/1.0\r\nCSeq: {cseq}\r\n{extra}\r\n".encode())
+                status, _, _ = await main.read_rtsp_message(reader)
+                assert " 200 " in status, status
+            return reader, writer
+        
+        async def packets(reader, count):
+            received = []
+            for _ in range(count):
+                header = await reader.readexactly(4)
+                received.append(await reader.readexactly(struct.unpack('!H', header[2:])[0]))
+            return received
+        
+        first, first_writer = await viewer()
+        await packets(first, 50)
+        slow, slow_writer = await viewer(rcvbuf=4096)
+        await asyncio.sleep(0.1)
+        late, late_writer = await viewer()
+        late_packets = await packets(late, 1)
+        late_writer.close()
+        
+        # The first viewer keeps a gapless stream while the slow one is dropped
+        sequence = [struct.unpack('!H', p[2:4])[0] for p in await packets(first, 1000)]
+        gapless = all(b == (a + 1) & 0xffff for a, b in zip(sequence, sequence[1:]))
+        stats = dict(relay.stats[bound])
+        
+        for writer in (first_writer, slow_writer):
+            writer.close()
+        await relay.close()
+        server.close()
+        await asyncio.sleep(0.05)  # Let the camera notice its session ended
+        return camera.sessions, late_packets[0], gapless, stats
+    
+    sessions, late_first, gapless, stats = asyncio.run(scenario())
+    assert sessions == 1 and stats['sessions'] == 1
+    assert main.is_h264_keyframe(late_first) and late_first[12] & 0x1f == 7
+    assert gapless and stats['dropped'] == 1
+    print(f"✓ 3 viewers on 1 camera session, late viewer started at SPS, "
+          f"{stats['dropped']} slow viewer dropped")
+
+def test_fanout_auth():
+    """Test that viewers only join a shared session with credentials the camera accepted"""
+    print("\nTesting RTSP fan-out authentication...")
+    
+    good = "Basic dXNlcjpwYXNz"
+    
+    async def scenario():
+        camera = _SyntheticCamera(authorization=good)
+        server = await asyncio.start_server(camera.handle, '127.0.0.1', 0)
+        relay = main.FanoutRelay()
+        bound = await relay.add_route(('127.0.0.1', 0), server.sockets[0].getsockname())
+        url = f"rtsp://127.0.0.1:{bound[1]}/stream"
+        
+        async def describe(reader, writer, authorization=None):
+            extra = f"Authorization: {authorization}\r\n" if authorization else ""
+            writer.write(f"DESCRIBE {url} RTSP/1.0\r\nCSeq: 1\r\n{extra}\r\n".encode())
+            status, headers, _ = await main.read_rtsp_message(reader)
+            return status.split()[1], headers.get('www-authenticate')
+        
+        owner = await asyncio.open_connection(*bound)
+        stranger = await asyncio.open_connection(*bound)
+        results = [await describe(*owner, good),
+                   await describe(*stranger),
+                   await describe(*stranger, "Basic d3Jvbmc6d3Jvbmc="),
+                   await describe(*stranger, good)]
+        fanouts = len(relay.routes[bound]['fanouts'])
+        for _, writer in (owner, stranger):
+            writer.close()
+        await relay.close()
+        server.close()
+        return results, fanouts
+    
+    results, fanouts = asyncio.run(scenario())
+    assert results[0] == ("200", None)
+    assert results[1] == results[2] == ("401", 'Basic realm="camera"')
+    assert results[3] == ("200", None) and fanouts == 1
+    print("✓ Viewers without valid credentials challenged, not attached to the shared session")
+
+class _StatusRecorder:
+    """Outbox stand-in recording queued status reports"""
+    
+    def __init__(self):
+        self.statuses = {}
+    
+    def enqueue_status(self, camera_id, status, topic='status'):
+        self.statuses[(topic, camera_id)] = status
+
+def test_health_monitor():
+    """Test that one event loop checks a thousand cameras and adapts its intervals"""
+    print("\nTesting camera health monitor...")
+    
+    async def answer(reader, writer):
+        await main.read_rtsp_message(reader)
+        writer.write(b"RTSP/1.0 200 OK\r\nCSeq: 1\r\n\r\n")
+        await writer.drain()
+        writer.close()
+    
+    async def scenario():
+        server = await asyncio.start_server(answer, '127.0.0.1', 0, backlog=1024)
+        port = server.sockets[0].getsockname()[1]
+        with socket.socket() as unused:
+            unused.bind(('127.0.0.1', 0))
+            closed_port = unused.getsockname()[1]
+        
+        outbox = _StatusRecorder()
+        monitor = main.CameraHealthMonitor(outbox)
+        monitor.sync({f"cam-{i}": ('127.0.0.1', port if i % 5 else closed_port) for i in range(1000)})
+        threads = threading.active_count()
+        task = asyncio.ensure_future(monitor.run())
+        started = time.monotonic()
+        while time.monotonic() - started < 5:
+            await asyncio.sleep(0.05)
+            if len(outbox.statuses) == 1000:
+                break
+        elapsed = time.monotonic() - started
+        assert threading.active_count() == threads
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert not [t for t in asyncio.all_tasks() if not t.done()
+                    and t.get_coro().__qualname__.endswith("run.<locals>.check")]
+        server.close()
+        return monitor, outbox, elapsed
+    
+    original = main.HEALTH_MIN_INTERVAL
+    main.HEALTH_MIN_INTERVAL = 0.05
+    try:
+        monitor, outbox, elapsed = asyncio.run(scenario())
+    finally:
+        main.HEALTH_MIN_INTERVAL = original
+    
+    online = monitor.summary("cam-1")
+    offline = monitor.summary("cam-0")
+    assert online['status'] == 'online' and online['interval'] == main.HEALTH_BASE_INTERVAL
+    assert online['p50'] is not None and sum(online['buckets'].values()) == 1
+    assert offline['status'] == 'offline' and offline['interval'] == 0.05
+    assert outbox.statuses[('health', "cam-0")]['health'] == 'offline'
+    assert sum(1 for s in outbox.statuses.values() if s['health'] == 'online') == 800
+    
+    histogram = main.LatencyHistogram(window=4)
+    for seconds in (0.001, 0.001, 0.2, 3.0, 3.0):
+        histogram.observe(seconds)
+    assert histogram.quantile(0.5) == 0.25 and histogram.quantile(1.0) == 5.0
+    print(f"✓ 1000 cameras checked in {elapsed:.2f}s from one event loop, "
+          f"{len(outbox.statuses)} status changes queued")
+
+def test_activation_pipeline():
+    """Test that a large batch is activated in bulk and failures are rolled back"""
+    print("\nTesting staged activation...")
+    
+    addresses = main.FakeAddresses()
+    network = _network_manager(addresses)
+    network.firewall = _FlakyNftables(bad="10.1.9.99")
+    progress = []
+    pipeline = main.ActivationPipeline(network, progress=lambda *p: progress.append(p))
+    
+    cameras = [{'camera_id': f"cam-{i}", 'original_ip': f"10.1.{i // 200}.{i % 200 + 1}"}
+               for i in range(250)]
+    cameras[100]['original_ip'] = "10.1.9.99"
+    results = pipeline.run(cameras)
+    
+    assert results["cam-100"] is None and "cam-100" not in network.virtual_ips
+    assert sum(1 for ip in results.values() if ip) == 249
+    assert ("cam-100", 'forward', False) in progress
+    assert addresses.round_trips == 2  # One add for the batch, one rollback
+    
+    # Active cameras are left alone and the retry adds a single address
+    network.firewall.bad = "none"
+    again = pipeline.run(cameras[99:102])
+    assert addresses.round_trips == 3
+    assert again["cam-99"] == results["cam-99"] and again["cam-100"]
+    assert len(addresses.list_addresses("eth0")) == 250
+    print("✓ 250 cameras activated in one address round trip, failure rolled back")
+
+def test_activation_ip_change():
+    """Test that a camera moving to a new IP loses its old forwarding"""
+    print("\nTesting activation after a camera IP change...")
+    
+    network = _network_manager(main.FakeAddresses())
+    network.firewall = main.NftablesFirewall(dry_run=True)
+    pipeline = main.ActivationPipeline(network)
+    virtual_ip = pipeline.run([{'camera_id': "c1", 'original_ip': "10.0.0.5"}])["c1"]
+    
+    commands = []
+    original = main.run_command
+    main.run_command = lambda cmd, input=None: commands.append(input) or subprocess.CompletedProcess(cmd, 0, "", "")
+    try:
+        assert pipeline.run([{'camera_id': "c1", 'original_ip': "10.0.0.6"}]) == {"c1": virtual_ip}
+    finally:
+        main.run_command = original
+    
+    removed, added = network.firewall.scripts[-2:]
+    assert f"delete element ip camera_portal rtsp_dnat {{ {virtual_ip} . 554 : 10.0.0.5 . 554 }}" in removed
+    assert f"add element ip camera_portal rtsp_dnat {{ {virtual_ip} . 554 : 10.0.0.6 . 554 }}" in added
+    assert network.forwarding_mappings() == [(virtual_ip, "10.0.0.6", 554)]
+    assert commands == [f"-D -d {virtual_ip}\n"]
+    print("✓ Old mapping removed before the new one was added")
+
+def test_teardown():
+    """Test that deactivated cameras lose their rules, connections and addresses in bulk"""
+    print("\nTesting camera teardown...")
+    
+    addresses = main.FakeAddresses()
+    network = _network_manager(addresses)
+    network.firewall = main.NftablesFirewall(dry_run=True)
+    main.ActivationPipeline(network).run(
+        [{'camera_id': f"cam-{i}", 'original_ip': f"10.1.0.{i + 1}"} for i in range(3)]
+    )
+    freed = network.virtual_ips["cam-0"]['virtual_ip']
+    
+    commands = []
+    original = main.run_command
+    main.run_command = lambda cmd, input=None: commands.append((cmd, input)) or subprocess.CompletedProcess(cmd, 1, "", "")
+    try:
+        stale = network.stale_cameras(["cam-2"])
+        results = network.teardown_cameras(stale)
+    finally:
+        main.run_command = original
+    
+    assert stale == ["cam-0", "cam-1"] and results == {"cam-0": True, "cam-1": True}
+    assert list(network.virtual_ips) == ["cam-2"] and addresses.round_trips == 2
+    assert commands == [(["sudo", "conntrack", "-R", "-"], f"-D -d {freed}\n-D -d 10.20.0.2\n")]
+    script = network.firewall.scripts[-1]
+    assert script.startswith("delete element") and "10.1.0.1" in script and "10.1.0.3" not in script
+    assert network.create_virtual_ip("cam-9") == freed
+    print("✓ Stale cameras removed in one firewall, one conntrack and one address transaction")
+    
+    # iptables: every copy of the camera's rules goes, other rules stay
+    class Recorder(_RecordedIptables):
+        def restore(self, changes):
+            self.changes = changes
+            return True
+    firewall = Recorder()
+    firewall.remove_forwarding([("192.168.1.200", "10.0.0.5", 554)])
+    assert len(firewall.changes) == 4 and all(c.startswith("-D ") for _, c in firewall.changes)
+    assert not any("10.0.0.9" in c or "172.17" in c for _, c in firewall.changes)
+    print("✓ iptables rules deleted, duplicates included")
+
+def test_tcp_relay():
+    """Test the userspace relay with many concurrent sessions"""
+    print("\nTesting userspace TCP relay...")
+    
+    server = _EchoServer(('127.0.0.1', 0), _Echo)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    
+    forwarder = main.RelayForwarder()
+    assert forwarder.apply_forwarding([("127.0.0.2", "127.0.0.1", port)]) == {"127.0.0.2": True}
+    payload = os.urandom(256 * 1024)
+    echoed = {}
+    
+    def session(n):
+        with socket.create_connection(("127.0.0.2", port), timeout=10) as sock:
+            sender = threading.Thread(target=lambda: (sock.sendall(payload), sock.shutdown(socket.SHUT_WR)))
+            sender.start()
+            chunks = []
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            sender.join()
+            echoed[n] = b"".join(chunks)
+    
+    clients = [threading.Thread(target=session, args=(n,)) for n in range(20)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join(30)
+    
+    # Sessions are closed by the relay thread just after the clients see EOF
+    deadline = time.monotonic() + 2
+    while forwarder.stats()["127.0.0.2"]['active'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stats = forwarder.stats()["127.0.0.2"]
+    assert len(echoed) == 20 and all(data == payload for data in echoed.values())
+    assert stats['bytes_up'] == stats['bytes_down'] == 20 * len(payload)
+    assert stats['connections'] == 20 and stats['active'] == 0
+    
+    # A listener already relaying to one camera is never pointed at another
+    assert forwarder.apply_forwarding([("127.0.0.2", "127.0.0.9", port)]) == {"127.0.0.2": False}
+    assert forwarder.relay.routes[("127.0.0.2", port)]['target'] == ("127.0.0.1", port)
+    
+    # Removing the mapping closes the listener
+    forwarder.remove_forwarding([("127.0.0.2", "127.0.0.1", port)])
+    try:
+        socket.create_connection(("127.0.0.2", port), timeout=1).close()
+        assert False, "relay still listening"
+    except ConnectionRefusedError:
+        pass
+    forwarder.close()
+    server.shutdown()
+    
+    shared = main.RelayForwarder(bind="0.0.0.0", base_port=20000)
+    assert shared.endpoint("10.20.0.5") == ("0.0.0.0", 20000)
+    assert shared.endpoint("10.20.39.21") == ("0.0.0.0", 20001)
+    assert shared.endpoint("10.20.0.5") == ("0.0.0.0", 20000)
+    restarted = main.RelayForwarder(bind="0.0.0.0", base_port=20000)
+    restarted.reserve({"10.20.39.21": 20001})
+    assert restarted.endpoint("10.20.0.6") == ("0.0.0.0", 20000)
+    assert restarted.endpoint("10.20.0.7") == ("0.0.0.0", 20002)
+    print(f"✓ 20 sessions relayed {stats['bytes_up'] * 2 // 1024} KiB "
+          f"({'splice' if forwarder.relay.use_splice else 'copy'})")
+
+def test_tracing():
+    """Test span tracing per cycle, slow-cycle sampling and cycle-bounded profiling"""
+    print("\nTesting tracing and profiling...")
+    
+    directory = tempfile.mkdtemp()
+    tracer = main.Tracer(path=os.path.join(directory, "traces.jsonl"), slow=0.05)
+    profiler = main.SamplingProfiler(directory, interval=0.001)
+    tracer.observers.append(profiler.cycle_done)
+    
+    original = main.TRACER
+    main.TRACER = tracer
+    try:
+        profiler.start(cycles=2)
+        with tracer.cycle('fast'):
+            pass
+        with tracer.cycle('slow') as trace:
+            with tracer.span('outer', cameras=2):
+                main.run_command(["true"])
+                worker = threading.Thread(target=contextvars.copy_context().run,
+                                          args=(main.run_command, ["sleep", "0.1"]))
+                worker.start()
+                worker.join()
+        with tracer.span('outside'):
+            pass  # No cycle, nothing recorded
+    finally:
+        main.TRACER = original
+    
+    with open(tracer.path) as f:
+        records = [json.loads(line) for line in f]
+    assert [record['cycle'] for record in records] == ['slow']
+    spans = {span['name'] + span.get('attrs', {}).get('command', ''): span for span in records[0]['spans']}
+    assert records[0]['trace_id'] == trace.trace_id
+    assert spans['exectrue']['parent'] == spans['outer']['id']
+    assert spans['execsleep']['parent'] == spans['outer']['id']
+    assert spans['execsleep']['duration'] >= 0.1
+    print(f"✓ Slow cycle sampled with {len(spans)} spans, child thread joined its trace")
+    
+    assert not profiler.running
+    profiles = [name for name in os.listdir(directory) if name.endswith(".folded")]
+    with open(os.path.join(directory, profiles[0])) as f:
+        lines = f.read().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    print(f"✓ Profiler stopped after 2 cycles, {len(lines)} stacks written")
+
+def test_benchmark_smoke():
+    """Test that the simulated-network benchmark runs end to end on a small fleet"""
+    print("\nTesting benchmark harness...")
+    
+    import benchmark_camera_manager
+    level = main.logger.level
+    try:
+        report = benchmark_camera_manager.main_benchmark(
+            ['--sizes', "20", '--failure-rate', "0", '--error-rate', "0",
+             '--output', os.path.join(tempfile.mkdtemp(), "bench.json")])
+    finally:
+        main.logger.setLevel(level)
+    
+    run = report['runs'][0]
+    assert run['discovery']['cold']['cameras'] == 20
+    assert run['discovery']['warm']['registered'] == 20
+    assert run['activation']['activated'] == 20
+    assert run['monitor']['statuses'] == {'online': 20}
+    assert run['teardown']['removed'] == 20
+    print(f"✓ 20 cameras discovered in {run['discovery']['cold']['seconds']:.2f}s, "
+          f"activated, checked and torn down")
+
+def test_logging_pipeline():
+    """Test queued JSON logging to a rotating file with rate-limited repeats"""
+    print("\nTesting logging pipeline...")
+    
+    path = os.path.join(tempfile.mkdtemp(), "service.log")
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    listener = main.setup_logging({'log_file': path, 'log_format': "json", 'log_level': "INFO",
+                                   'log_rate_limit': 3, 'log_rate_window': 0.2})
+    try:
+        for _ in range(10):
+            main.logger.info("Camera %s is %s", "cam-1", "offline")
+        main.logger.info("Camera %s is %s", "cam-2", "online")
+        time.sleep(0.3)
+        main.logger.info("Camera %s is %s", "cam-1", "online")
+    finally:
+        listener.stop()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in handlers:
+            root.addHandler(handler)
+        root.setLevel(level)
+        for handler in listener.handlers:
+            handler.close()
+    
+    with open(path) as f:
+        entries = [json.loads(line) for line in f]
+    messages = [entry['message'] for entry in entries]
+    assert messages[:4] == ["Camera cam-1 is offline"] * 3 + ["Camera cam-2 is online"]
+    assert messages[4] == "Camera cam-1 is online (7 similar messages suppressed)"
+    assert entries[4]['suppressed'] == 7 and entries[0]['level'] == "INFO"
+    print(f"✓ {len(entries)} of 12 records written as JSON, repeats of one camera suppressed")
+
 if __name__ == "__main__":
     print("IP Camera Portal Manager - Test Script")
     print("=" * 50)
     
     test_network_scan()
     test_virtual_ip()
+    test_concurrent_probe()
+    test_recorded_arp_scan()
+    test_vendor_index()
+    test_incremental_scan()
+    test_rtsp_path_discovery()
+    test_firewall_reconcile()
+    test_iptables_apply()
+    test_nftables_render()
+    test_virtual_ip_allocator()
+    test_ip_batch_channel()
+    test_bulk_addresses()
+    test_state_store()
+    test_activation_delta_sync()
+    test_portal_session()
+    test_streaming_registration()
+    test_portal_outbox()
+    test_service_loop()
+    test_settings_reload()
+    test_activation_pipeline()
+    test_activation_ip_change()
+    test_teardown()
+    test_tcp_relay()
+    test_rtsp_fanout()
+    test_fanout_auth()
+    test_health_monitor()
+    test_metrics_registry()
+    test_tracing()
+    test_benchmark_smoke()
+    test_logging_pipeline()
     
     print("\nTest complete!")